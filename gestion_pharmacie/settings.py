@@ -29,6 +29,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',  # lookups pg_trgm de la recherche produits
      'corsheaders',
     'rest_framework',
     'rest_framework.authtoken', 
@@ -184,6 +185,34 @@ LOGGING = {
     },
 }
 
+# Imprimante thermique (spouleur d'impression pharmacie.utils.spouleur_impression)
+# BACKEND : 'usb' (caisse), 'fichier' ou 'dummy' (tests sans matériel)
+IMPRIMANTE = {
+    'BACKEND': config('IMPRIMANTE_BACKEND', default='usb'),
+    'ID_FABRICANT': 0x1fc9,
+    'ID_PRODUIT': 0x2016,
+    'FICHIER': config('IMPRIMANTE_FICHIER', default='/tmp/tickets.escpos'),
+}
+
+# Cache (analyses et rapports, pharmacie.utils.analyse_en_cache)
+# Mémoire locale par défaut (propre à chaque worker) ; CACHE_REDIS_URL pour un cache
+# partagé entre workers, ex. redis://127.0.0.1:6379/1 (nécessite le paquet redis)
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'pharmacie',
+        }
+    }
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
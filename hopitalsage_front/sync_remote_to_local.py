@@ -38,7 +38,12 @@ from pharmacie.models import (
     Requisition,
     PublicitePharmacie,
     Depense,
+    VenteJournaliere,
+    StatistiqueJournaliere,
+    VenteUtilisateurJournaliere,
+    ValorisationStock,
 )
+from pharmacie.utils import invalider_analyses
 
 # ============================
 # CONFIGURATION
@@ -119,8 +124,9 @@ def get_last_sync(model, direction):
 # CHAMP DE SYNC
 # ============================
 def get_sync_field(model):
-    if model.__name__ in ["VenteProduit", "VenteLigne"]:
-        return "date_vente"
+    # Pas date_vente pour les ventes : c'est l'heure de la caisse, antérieure à la
+    # dernière synchro pour une vente hors ligne envoyée plus tard.
+    # updated_at est posé par le serveur à la réception.
     return "updated_at"
 
 # ============================
@@ -197,10 +203,10 @@ def chunked_queryset(qs):
 # ============================
 # CORE SYNC
 # ============================
-def sync_model(source_db, target_db, model, pharmacie=None):
-    direction = f"{source_db}→{target_db}"
-    print(f"\n🔄 {model.__name__} [{direction}]")
-
+def get_sync_queryset(source_db, model, direction, pharmacie=None):
+    """
+    Lignes à copier : celles de la pharmacie modifiées depuis la dernière synchro
+    """
     qs = model.objects.using(source_db)
 
     lookup = PHARMACIE_LOOKUP.get(model.__name__)
@@ -210,6 +216,14 @@ def sync_model(source_db, target_db, model, pharmacie=None):
     sync_field = get_sync_field(model)
     if hasattr(model, sync_field):
         qs = qs.filter(**{f"{sync_field}__gt": get_last_sync(model, direction)})
+    return qs
+
+def sync_model(source_db, target_db, model, pharmacie=None):
+    direction = f"{source_db}→{target_db}"
+    print(f"\n🔄 {model.__name__} [{direction}]")
+
+    qs = get_sync_queryset(source_db, model, direction, pharmacie)
+    sync_field = get_sync_field(model)
 
     total_synced = 0
     last_synced_value = None
@@ -289,6 +303,39 @@ def sync_model(source_db, target_db, model, pharmacie=None):
 
     if last_synced_value:
         SYNC_TIMES[f"{model.__name__}_{direction}"] = last_synced_value.isoformat()
+    return total_synced
+
+# ============================
+# TABLES D'AGRÉGATS
+# ============================
+def reconstruire_agregats(pharmacie, db, synchronises):
+    """
+    Cumuls journaliers et valorisation du stock : tenus à jour par la vente et les
+    signaux, que bulk_create / bulk_update contournent. Recalculés sur la base cible
+    pour la pharmacie dès que ses ventes ou ses produits ont été copiés.
+    synchronises : {nom du modèle: lignes copiées}
+    """
+    ventes = synchronises.get("VenteProduit") or synchronises.get("VenteLigne")
+    produits = synchronises.get("ProduitPharmacie")
+    if not (ventes or produits):
+        return
+
+    with transaction.atomic(using=db):
+        if ventes:
+            VenteJournaliere.reconstruire(pharmacie.id, using=db)
+            StatistiqueJournaliere.reconstruire(pharmacie.id, using=db)
+            VenteUtilisateurJournaliere.reconstruire(pharmacie.id, using=db)
+        if produits:
+            ValorisationStock.reconstruire(pharmacie.id, using=db)
+    invalider_analyses(pharmacie.id)
+    print(f"   📊 Agrégats recalculés [{db}]")
+
+def sync_pharmacie(source_db, target_db, pharmacie):
+    synchronises = {
+        m.__name__: sync_model(source_db, target_db, m, pharmacie)
+        for m in MODELS_PAR_PHARMACIE
+    }
+    reconstruire_agregats(pharmacie, target_db, synchronises)
 
 # ============================
 # MAIN
@@ -303,15 +350,13 @@ def run():
 
     ensure_pharmacie_remote(pharmacie, "remote")
 
-    for m in MODELS_PAR_PHARMACIE:
-        sync_model("default", "remote", m, pharmacie)
+    sync_pharmacie("default", "remote", pharmacie)
 
     print("\n=== 🔽 REMOTE → LOCAL ===")
     for m in MODELS_GLOBAL:
         sync_model("remote", "default", m)
 
-    for m in MODELS_PAR_PHARMACIE:
-        sync_model("remote", "default", m, pharmacie)
+    sync_pharmacie("remote", "default", pharmacie)
 
     save_sync_times(SYNC_TIMES)
     print("\n✅ Synchronisation terminée avec succès.")
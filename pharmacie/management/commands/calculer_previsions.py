@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from comptes.models import Pharmacie
+from pharmacie.utils import compute_forecasts
+
+
+class Command(BaseCommand):
+    help = (
+        "Calcule les prévisions de demande (lissage exponentiel / Croston, saisonnalité) "
+        "utilisées par les suggestions de commande. À planifier la nuit (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacie', help="UUID d'une seule pharmacie à traiter")
+        parser.add_argument('--jours', type=int, default=180, help="Historique de ventes utilisé (jours)")
+
+    def handle(self, *args, **options):
+        if options['jours'] < 7:
+            raise CommandError("--jours doit être d'au moins 7")
+
+        pharmacies = Pharmacie.objects.all()
+        if options['pharmacie']:
+            pharmacies = pharmacies.filter(pk=options['pharmacie'])
+            if not pharmacies.exists():
+                raise CommandError("Pharmacie introuvable")
+
+        for pharmacie in pharmacies.only('id', 'nom_pharm'):
+            nombre = compute_forecasts(pharmacie, history_days=options['jours'])
+            self.stdout.write(f"{pharmacie.nom_pharm} : {nombre} produits prévus")
+
+        self.stdout.write(self.style.SUCCESS("✅ Prévisions de demande calculées"))
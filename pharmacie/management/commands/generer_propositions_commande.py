@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from comptes.models import Pharmacie
+from pharmacie.utils import generer_propositions_commande
+
+
+class Command(BaseCommand):
+    help = (
+        "Crée les commandes brouillon (une par fabricant) à partir des suggestions de commande "
+        "du rapport de stock. Remplace les brouillons générés précédemment, pas ceux créés ou modifiés à la main."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacie', help="UUID d'une seule pharmacie à traiter")
+        parser.add_argument('--jours', type=int, default=30, help="Période d'analyse des ventes (jours)")
+
+    def handle(self, *args, **options):
+        pharmacies = Pharmacie.objects.all()
+        if options['pharmacie']:
+            pharmacies = pharmacies.filter(pk=options['pharmacie'])
+            if not pharmacies.exists():
+                raise CommandError("Pharmacie introuvable")
+
+        for pharmacie in pharmacies:
+            try:
+                commandes = generer_propositions_commande(pharmacie, period_days=options['jours'])
+            except ValueError as e:
+                raise CommandError(f"{pharmacie.nom_pharm} : {e}")
+            self.stdout.write(f"{pharmacie.nom_pharm} : {len(commandes)} commandes brouillon")
+
+        self.stdout.write(self.style.SUCCESS("✅ Propositions de commande générées"))
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum, Max
+from django.db.models.functions import Floor
+
+from comptes.models import Pharmacie
+from pharmacie.models import Client, ClientPurchase, VenteProduit
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcule total_depense, dernier_achat et score_fidelite de tous les clients "
+        "(un GROUP BY par pharmacie, mise à jour groupée)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacie', help="UUID d'une seule pharmacie à traiter")
+        parser.add_argument('--taille-lot', type=int, default=500, help="Clients par UPDATE groupé")
+
+    def handle(self, *args, **options):
+        pharmacies = Pharmacie.objects.all()
+        if options['pharmacie']:
+            pharmacies = pharmacies.filter(pk=options['pharmacie'])
+            if not pharmacies.exists():
+                raise CommandError("Pharmacie introuvable")
+
+        for pharmacie in pharmacies.only('id', 'nom_pharm'):
+            nombre = self.recalculer(pharmacie, options['taille_lot'])
+            self.stdout.write(f"{pharmacie.nom_pharm} : {nombre} clients recalculés")
+
+        self.stdout.write(self.style.SUCCESS("✅ Statistiques clients recalculées"))
+
+    @transaction.atomic
+    def recalculer(self, pharmacie, taille_lot):
+        # 🔹 Une ligne par client : total, dernière vente, points (1 par unité monétaire, par vente)
+        ventes = {
+            ligne['client']: ligne
+            for ligne in VenteProduit.objects
+            .filter(pharmacie=pharmacie, client__isnull=False)
+            .values('client')
+            .annotate(total=Sum('montant_total'), dernier=Max('date_vente'), points=Sum(Floor('montant_total')))
+        }
+        # Points des achats fidélité enregistrés hors vente
+        points_achats = dict(
+            ClientPurchase.objects
+            .filter(client__pharmacie=pharmacie)
+            .values('client')
+            .annotate(points=Sum('points_gagnes'))
+            .values_list('client', 'points')
+        )
+
+        clients = list(Client.objects.filter(pharmacie=pharmacie).only('id'))
+        for client in clients:
+            stats = ventes.get(client.id, {})
+            client.total_depense = stats.get('total') or 0
+            client.dernier_achat = stats.get('dernier')
+            client.score_fidelite = int(stats.get('points') or 0) + (points_achats.get(client.id) or 0)
+
+        Client.objects.bulk_update(
+            clients, ['total_depense', 'dernier_achat', 'score_fidelite'], batch_size=taille_lot
+        )
+        return len(clients)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from comptes.models import Pharmacie
+from pharmacie.models import ValorisationStock
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcule la valorisation du stock (ValorisationStock) depuis les produits de la pharmacie "
+        "et affiche l'écart avec la valeur tenue à jour. À lancer caisses fermées."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacie', help="UUID d'une seule pharmacie à traiter")
+
+    def handle(self, *args, **options):
+        pharmacies = Pharmacie.objects.all()
+        if options['pharmacie']:
+            pharmacies = pharmacies.filter(pk=options['pharmacie'])
+            if not pharmacies.exists():
+                raise CommandError("Pharmacie introuvable")
+
+        for pharmacie in pharmacies.only('id', 'nom_pharm'):
+            with transaction.atomic():
+                avant = ValorisationStock.objects.filter(pharmacie=pharmacie).aggregate(
+                    total=Sum('valeur_vente')
+                )['total'] or 0
+                apres = sum(v.valeur_vente for v in ValorisationStock.reconstruire(pharmacie.id))
+            self.stdout.write(f"{pharmacie.nom_pharm} : {apres} (écart {apres - avant})")
+
+        self.stdout.write(self.style.SUCCESS("✅ Valorisation du stock réconciliée"))
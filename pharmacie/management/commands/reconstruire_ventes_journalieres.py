@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from comptes.models import Pharmacie
+from pharmacie.models import VenteJournaliere, StatistiqueJournaliere, VenteUtilisateurJournaliere
+from pharmacie.utils import invalider_analyses
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstruit la table VenteJournaliere (ventes par produit et par jour) depuis les lignes de vente, "
+        "puis les compteurs du tableau de bord et des caissiers (StatistiqueJournaliere, VenteUtilisateurJournaliere). "
+        "À lancer caisses fermées : une vente enregistrée pendant la reconstruction peut être perdue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacie', help="UUID d'une seule pharmacie à traiter")
+
+    def handle(self, *args, **options):
+        pharmacies = Pharmacie.objects.all()
+        if options['pharmacie']:
+            pharmacies = pharmacies.filter(pk=options['pharmacie'])
+            if not pharmacies.exists():
+                raise CommandError("Pharmacie introuvable")
+
+        for pharmacie in pharmacies.only('id', 'nom_pharm'):
+            with transaction.atomic():
+                nombre = VenteJournaliere.reconstruire(pharmacie.id)
+                jours = StatistiqueJournaliere.reconstruire(pharmacie.id)
+                VenteUtilisateurJournaliere.reconstruire(pharmacie.id)
+            invalider_analyses(pharmacie.id)
+            self.stdout.write(f"{pharmacie.nom_pharm} : {nombre} lignes produit/jour, {jours} jours")
+
+        self.stdout.write(self.style.SUCCESS("✅ Ventes journalières reconstruites"))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0005_alter_rapportmensuel_croissance_benefice_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='venteproduit',
+            name='ticket_escpos',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0006_venteproduit_ticket_escpos'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='venteproduit',
+            name='cle_idempotence',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='venteproduit',
+            constraint=models.UniqueConstraint(fields=('pharmacie', 'cle_idempotence'), name='unique_cle_idempotence_par_pharmacie'),
+        ),
+    ]
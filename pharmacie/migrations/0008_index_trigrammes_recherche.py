@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+INDEX = [
+    ("pharmacie_produitpharmacie", "nom_medicament", "produitpharmacie_nom_trgm"),
+    ("pharmacie_produitfabricant", "nom", "produitfabricant_nom_trgm"),
+]
+
+
+def creer_index_trigrammes(apps, schema_editor):
+    # Index GIN trigrammes : seulement sur PostgreSQL (SQLite utilise l'index en mémoire)
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, colonne, nom in INDEX:
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {nom} ON {table} USING gin ({colonne} gin_trgm_ops)"
+        )
+
+
+def supprimer_index_trigrammes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, colonne, nom in INDEX:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {nom}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0007_venteproduit_cle_idempotence'),
+    ]
+
+    operations = [
+        migrations.RunPython(creer_index_trigrammes, supprimer_index_trigrammes),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:34
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0008_index_trigrammes_recherche'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VenteJournaliere',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('jour', models.DateField()),
+                ('quantite', models.PositiveIntegerField(default=0)),
+                ('chiffre_affaires', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cout', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('nombre_ventes', models.PositiveIntegerField(default=0)),
+                ('premiere_vente', models.DateTimeField(blank=True, null=True)),
+                ('derniere_vente', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ventes_journalieres', to='comptes.pharmacie')),
+                ('produit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ventes_journalieres', to='pharmacie.produitpharmacie')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['pharmacie', 'jour'], name='pharmacie_v_pharmac_ca3e85_idx')],
+                'constraints': [models.UniqueConstraint(fields=('produit', 'jour'), name='unique_vente_journaliere_produit_jour')],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import TruncDate
+
+
+def remplir_ventes_journalieres(apps, schema_editor):
+    VenteLigne = apps.get_model('pharmacie', 'VenteLigne')
+    VenteJournaliere = apps.get_model('pharmacie', 'VenteJournaliere')
+
+    lignes = (
+        VenteLigne.objects
+        .annotate(jour=TruncDate('vente__date_vente'))
+        .values('vente__pharmacie', 'produit', 'jour')
+        .annotate(
+            total_quantite=Sum('quantite'),
+            total_montant=Sum('total'),
+            total_cout=Sum(F('quantite') * F('produit__prix_achat')),
+            nb_ventes=Count('vente', distinct=True),
+            premiere=Min('vente__date_vente'),
+            derniere=Max('vente__date_vente'),
+        )
+    )
+    VenteJournaliere.objects.bulk_create(
+        [
+            VenteJournaliere(
+                pharmacie_id=l['vente__pharmacie'], produit_id=l['produit'], jour=l['jour'],
+                quantite=l['total_quantite'] or 0, chiffre_affaires=l['total_montant'] or 0,
+                cout=l['total_cout'] or 0, nombre_ventes=l['nb_ventes'],
+                premiere_vente=l['premiere'], derniere_vente=l['derniere'],
+            )
+            for l in lignes.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0009_ventejournaliere'),
+    ]
+
+    operations = [
+        migrations.RunPython(remplir_ventes_journalieres, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:37
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0010_remplir_ventes_journalieres'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrevisionDemande',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('methode', models.CharField(choices=[('lissage', 'Lissage exponentiel simple'), ('croston', 'Croston (demande intermittente)')], max_length=10)),
+                ('demande_journaliere', models.DecimalField(decimal_places=3, max_digits=12)),
+                ('coefficient_saisonnier', models.DecimalField(decimal_places=2, default=1, max_digits=5)),
+                ('calcule_le', models.DateTimeField(auto_now=True)),
+                ('pharmacie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='previsions_demande', to='comptes.pharmacie')),
+                ('produit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='prevision_demande', to='pharmacie.produitpharmacie')),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:48
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0011_previsiondemande'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatistiqueJournaliere',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('jour', models.DateField()),
+                ('nombre_ventes', models.PositiveIntegerField(default=0)),
+                ('total_ventes', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('chiffre_affaires', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cout', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('quantite_plus_vendu', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistiques_journalieres', to='comptes.pharmacie')),
+                ('produit_plus_vendu', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pharmacie.produitpharmacie')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('pharmacie', 'jour'), name='unique_statistique_journaliere')],
+            },
+        ),
+    ]
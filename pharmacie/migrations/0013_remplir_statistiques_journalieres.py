@@ -0,0 +1,46 @@
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def remplir_statistiques_journalieres(apps, schema_editor):
+    VenteProduit = apps.get_model('pharmacie', 'VenteProduit')
+    VenteJournaliere = apps.get_model('pharmacie', 'VenteJournaliere')
+    StatistiqueJournaliere = apps.get_model('pharmacie', 'StatistiqueJournaliere')
+
+    stats = {}
+    ventes = (
+        VenteProduit.objects
+        .annotate(jour=TruncDate('date_vente'))
+        .values('pharmacie', 'jour')
+        .annotate(nb=Count('id'), total=Sum('montant_total'))
+    )
+    for v in ventes:
+        stats[(v['pharmacie'], v['jour'])] = StatistiqueJournaliere(
+            pharmacie_id=v['pharmacie'], jour=v['jour'], nombre_ventes=v['nb'], total_ventes=v['total'] or 0
+        )
+
+    for f in VenteJournaliere.objects.values('pharmacie', 'jour').annotate(ca=Sum('chiffre_affaires'), cout=Sum('cout')):
+        stat = stats.setdefault(
+            (f['pharmacie'], f['jour']), StatistiqueJournaliere(pharmacie_id=f['pharmacie'], jour=f['jour'])
+        )
+        stat.chiffre_affaires, stat.cout = f['ca'] or 0, f['cout'] or 0
+
+    faits = VenteJournaliere.objects.order_by('pharmacie', 'jour', '-quantite')
+    for pharmacie_id, jour, produit_id, quantite in faits.values_list('pharmacie', 'jour', 'produit', 'quantite').iterator():
+        stat = stats[(pharmacie_id, jour)]
+        if stat.produit_plus_vendu_id is None:
+            stat.produit_plus_vendu_id, stat.quantite_plus_vendu = produit_id, quantite
+
+    StatistiqueJournaliere.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0012_statistiquejournaliere'),
+    ]
+
+    operations = [
+        migrations.RunPython(remplir_statistiques_journalieres, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:50
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0013_remplir_statistiques_journalieres'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValorisationStock',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('categorie', models.CharField(max_length=100)),
+                ('localisation', models.CharField(max_length=255)),
+                ('quantite', models.BigIntegerField(default=0)),
+                ('valeur_vente', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('valeur_achat', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='valorisations_stock', to='comptes.pharmacie')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('pharmacie', 'categorie', 'localisation'), name='unique_valorisation_stock_groupe')],
+            },
+        ),
+    ]
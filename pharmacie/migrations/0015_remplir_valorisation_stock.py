@@ -0,0 +1,41 @@
+from django.db import migrations
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def remplir_valorisation_stock(apps, schema_editor):
+    ProduitPharmacie = apps.get_model('pharmacie', 'ProduitPharmacie')
+    ValorisationStock = apps.get_model('pharmacie', 'ValorisationStock')
+
+    montant = DecimalField(max_digits=16, decimal_places=2)
+    groupes = (
+        ProduitPharmacie.objects
+        .values('pharmacie', 'categorie', 'localisation')
+        .annotate(
+            total_quantite=Sum('quantite'),
+            total_vente=Sum(F('quantite') * Coalesce('prix_vente', Value(0), output_field=montant), output_field=montant),
+            total_achat=Sum(F('quantite') * F('prix_achat'), output_field=montant),
+        )
+    )
+    ValorisationStock.objects.bulk_create(
+        [
+            ValorisationStock(
+                pharmacie_id=g['pharmacie'], categorie=g['categorie'], localisation=g['localisation'],
+                quantite=g['total_quantite'] or 0, valeur_vente=g['total_vente'] or 0,
+                valeur_achat=g['total_achat'] or 0,
+            )
+            for g in groupes.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0014_valorisationstock'),
+    ]
+
+    operations = [
+        migrations.RunPython(remplir_valorisation_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def remplir_ventes_utilisateurs_journalieres(apps, schema_editor):
+    VenteProduit = apps.get_model('pharmacie', 'VenteProduit')
+    VenteUtilisateurJournaliere = apps.get_model('pharmacie', 'VenteUtilisateurJournaliere')
+
+    cumuls = (
+        VenteProduit.objects
+        .filter(utilisateur__isnull=False)
+        .annotate(jour=TruncDate('date_vente'))
+        .values('pharmacie', 'utilisateur', 'jour')
+        .annotate(nb=Count('id'), montant=Sum('montant_total'))
+    )
+    VenteUtilisateurJournaliere.objects.bulk_create(
+        [
+            VenteUtilisateurJournaliere(
+                pharmacie_id=c['pharmacie'], utilisateur_id=c['utilisateur'], jour=c['jour'],
+                nombre_ventes=c['nb'], total=c['montant'] or 0,
+            )
+            for c in cumuls.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0016_venteutilisateurjournaliere'),
+    ]
+
+    operations = [
+        migrations.RunPython(remplir_ventes_utilisateurs_journalieres, migrations.RunPython.noop),
+    ]
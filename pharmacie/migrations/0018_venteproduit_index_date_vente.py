@@ -0,0 +1,20 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comptes', '0002_usersession'),
+        ('pharmacie', '0017_remplir_ventes_utilisateurs_journalieres'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='venteproduit',
+            index=models.Index(fields=['pharmacie', 'date_vente'], name='pharmacie_v_pharmac_5cde77_idx'),
+        ),
+    ]
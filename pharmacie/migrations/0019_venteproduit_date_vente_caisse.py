@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-17 01:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0018_venteproduit_index_date_vente'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='venteproduit',
+            name='date_vente',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0019_venteproduit_date_vente_caisse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='venteligne',
+            name='prix_achat_unitaire',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+    ]
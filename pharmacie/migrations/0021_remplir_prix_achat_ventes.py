@@ -0,0 +1,25 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def remplir_prix_achat_ventes(apps, schema_editor):
+    # Ventes passées : le prix d'achat d'alors n'est pas connu, on reprend le prix actuel du produit
+    VenteLigne = apps.get_model('pharmacie', 'VenteLigne')
+    ProduitPharmacie = apps.get_model('pharmacie', 'ProduitPharmacie')
+
+    prix_achat = ProduitPharmacie.objects.filter(pk=OuterRef('produit_id')).values('prix_achat')[:1]
+    VenteLigne.objects.filter(prix_achat_unitaire__isnull=True).update(
+        prix_achat_unitaire=Coalesce(Subquery(prix_achat), Value(0))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0020_venteligne_prix_achat_unitaire'),
+    ]
+
+    operations = [
+        migrations.RunPython(remplir_prix_achat_ventes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 01:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacie', '0021_remplir_prix_achat_ventes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandeproduit',
+            name='auto_genere',
+            field=models.BooleanField(default=False, help_text='Brouillon créé par generer_propositions_commande'),
+        ),
+    ]
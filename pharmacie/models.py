@@ -71,6 +71,8 @@ class ProduitFabricant(models.Model):
 
 # 4. Enregistrement du produit dans la pharmacie
 from decimal import Decimal, InvalidOperation
+from django.db.models import F
+from django.utils import timezone
 
 class ProduitPharmacie(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -117,6 +119,29 @@ class ProduitPharmacie(models.Model):
 
         super().save(*args, **kwargs)
 
+    @classmethod
+    def decrementer_stock(cls, quantites):
+        """
+        Décrémente le stock de plusieurs produits sans perte de mise à jour
+        entre caisses concurrentes.
+        - quantites : {produit_id: quantite}
+        - Un UPDATE conditionnel (quantite >= demande) par produit, exécuté dans
+          un ordre stable (par id) : deux ventes verrouillent leurs lignes dans
+          le même ordre et ne peuvent pas s'interbloquer.
+        Retourne la liste des produit_id dont le stock était insuffisant ;
+        à l'appelant d'annuler la transaction si elle n'est pas vide.
+        """
+        echecs = []
+        maintenant = timezone.now()
+        for produit_id in sorted(quantites, key=str):
+            quantite = quantites[produit_id]
+            modifie = cls.objects.filter(pk=produit_id, quantite__gte=quantite).update(
+                quantite=F('quantite') - quantite,
+                updated_at=maintenant,
+            )
+            if not modifie:
+                echecs.append(produit_id)
+        return echecs
 
     def __str__(self):
         return f"{self.nom_medicament} - {self.pharmacie.nom_pharm}"
@@ -174,6 +199,7 @@ class CommandeProduit(models.Model):
     date_commande = models.DateTimeField(auto_now_add=True)
     etat = models.CharField(max_length=50, default="en_attente")
     fabricant = models.ForeignKey(Fabricant, on_delete=models.CASCADE)
+    auto_genere = models.BooleanField(default=False, help_text="Brouillon créé par generer_propositions_commande")
     updated_at = models.DateTimeField(auto_now=True)
 
 from decimal import Decimal, ROUND_HALF_UP
@@ -223,6 +249,8 @@ class ReceptionLigne(models.Model):
         return f"{self.ligne_commande.produit_fabricant.nom} reçu : {self.quantite_recue}"
 
 from django.core.validators import RegexValidator
+from django.db.models import Sum, Max, Value
+from django.db.models.functions import Coalesce, Greatest
 class Client(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     pharmacie = models.ForeignKey(
@@ -259,24 +287,37 @@ class Client(models.Model):
         ]
     
     def update_stats(self):
-        """Met à jour les statistiques du client"""
-        ventes = self.ventes.all()
-        total = sum(v.montant_total for v in ventes)
-        derniere_vente = ventes.order_by('-date_vente').first()
-        
-        self.total_depense = total
-        self.dernier_achat = derniere_vente.date_vente if derniere_vente else None
+        """Recalcule total_depense et dernier_achat depuis les ventes (une requête d'agrégat)"""
+        stats = self.ventes.aggregate(total=Sum('montant_total'), dernier=Max('date_vente'))
+
+        self.total_depense = stats['total'] or 0
+        self.dernier_achat = stats['dernier']
         self.save(update_fields=['total_depense', 'dernier_achat'])
 
+    @classmethod
+    def enregistrer_achat(cls, client_id, montant, date_achat):
+        """
+        Ajoute une vente aux statistiques du client sans relire son historique :
+        UPDATE atomique (sûr entre caisses concurrentes), 1 point de fidélité
+        par unité monétaire dépensée, dernier_achat ne recule jamais.
+        """
+        return cls.objects.filter(pk=client_id).update(
+            total_depense=F('total_depense') + montant,
+            score_fidelite=F('score_fidelite') + int(montant),
+            dernier_achat=Greatest(Coalesce('dernier_achat', Value(date_achat)), Value(date_achat)),
+            updated_at=timezone.now(),
+        )
+
 from django.db import models
 from django.core.validators import MinValueValidator
 
 class VenteProduit(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name='ventes')
-    date_vente = models.DateTimeField(auto_now_add=True)
+    # Heure réelle de la vente : celle de la caisse pour les ventes synchronisées hors ligne
+    date_vente = models.DateTimeField(default=timezone.now, editable=False)
     utilisateur = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)  # réception par le serveur : champ de synchro (pas date_vente)
     client = models.ForeignKey(  # Nouveau champ
         Client, 
         on_delete=models.SET_NULL, 
@@ -290,6 +331,22 @@ class VenteProduit(models.Model):
         default=0,
         validators=[MinValueValidator(0)]
     )
+    # Ticket ESC/POS tel qu'imprimé, pour une réimpression sans nouveau rendu
+    ticket_escpos = models.BinaryField(null=True, blank=True, editable=False)
+    # Clé générée par la caisse : un renvoi de la même vente (hors ligne, timeout) ne la duplique pas
+    cle_idempotence = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['pharmacie', 'cle_idempotence'],
+                name='unique_cle_idempotence_par_pharmacie'
+            )
+        ]
+        indexes = [
+            # Rapports par période : filtres date_vente >= début / < fin
+            models.Index(fields=['pharmacie', 'date_vente']),
+        ]
 
     def __str__(self):
         return f"Vente #{self.id} - {self.date_vente.strftime('%d/%m/%Y')}"
@@ -307,15 +364,394 @@ class VenteLigne(models.Model):
     quantite = models.PositiveIntegerField()
     prix_unitaire = models.DecimalField(max_digits=10, decimal_places=2)
     total = models.DecimalField(max_digits=12, decimal_places=2, editable=False)
+    # Prix d'achat du produit au moment de la vente : coût et bénéfice ne changent plus avec le prix
+    prix_achat_unitaire = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
         self.total = self.quantite * self.prix_unitaire
+        if self.prix_achat_unitaire is None:
+            self.prix_achat_unitaire = self.produit.prix_achat or 0
         super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.produit.nom_medicament} x {self.quantite}"
 
+
+from django.db.models import Case, When, Count, Min, DecimalField, Q
+from django.db.models.functions import Least, TruncDate
+
+class VenteJournaliere(models.Model):
+    """
+    Table de faits : ventes cumulées par produit et par jour.
+    Tenue à jour à chaque vente (VenteProduitSerializer.create), avec les compteurs
+    du jour de la pharmacie (StatistiqueJournaliere) et du caissier
+    (VenteUtilisateurJournaliere), et reconstructible
+    depuis VenteLigne (commande reconstruire_ventes_journalieres).
+    Les analyses la lisent à la place de VenteLigne : leur coût dépend du
+    nombre de couples produit/jour, pas du nombre de lignes de vente.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name='ventes_journalieres')
+    produit = models.ForeignKey(ProduitPharmacie, on_delete=models.CASCADE, related_name='ventes_journalieres')
+    jour = models.DateField()
+    quantite = models.PositiveIntegerField(default=0)
+    chiffre_affaires = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cout = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # prix d'achat au moment de la vente
+    nombre_ventes = models.PositiveIntegerField(default=0)
+    premiere_vente = models.DateTimeField(null=True, blank=True)
+    derniere_vente = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['produit', 'jour'], name='unique_vente_journaliere_produit_jour')
+        ]
+        indexes = [
+            models.Index(fields=['pharmacie', 'jour']),
+        ]
+
+    def __str__(self):
+        return f"{self.produit.nom_medicament} - {self.jour} : {self.quantite}"
+
+    @classmethod
+    def enregistrer_vente(cls, vente, lignes):
+        """
+        Ajoute une vente aux cumuls du jour : lignes par produit (enregistrer_lignes)
+        puis compteurs de la pharmacie et du caissier (enregistrer_compteurs).
+        """
+        cls.enregistrer_compteurs(vente, cls.enregistrer_lignes(vente, lignes))
+
+    @classmethod
+    def enregistrer_compteurs(cls, vente, cumuls):
+        """
+        Compteurs du jour de la pharmacie (StatistiqueJournaliere) et du caissier
+        (VenteUtilisateurJournaliere). Une seule ligne par pharmacie et par jour :
+        son verrou dure jusqu'au commit, la vente l'appelle donc en dernier.
+        """
+        if not cumuls:
+            return
+        jour = timezone.localdate(vente.date_vente)
+        StatistiqueJournaliere.enregistrer_vente(vente, jour, cumuls)
+        VenteUtilisateurJournaliere.enregistrer_vente(vente, jour)
+
+    @classmethod
+    def enregistrer_lignes(cls, vente, lignes):
+        """
+        Ajoute les lignes d'une vente au jour de la vente, en deux requêtes quel
+        que soit le nombre de produits : création des lignes manquantes
+        (ignore_conflicts), puis un seul UPDATE avec des incréments F() par produit.
+        Retourne les cumuls {produit_id: (quantite, montant, cout)} pour enregistrer_compteurs.
+        """
+        jour = timezone.localdate(vente.date_vente)
+        cumuls = {}
+        for ligne in lignes:
+            quantite, montant, cout = cumuls.get(ligne.produit_id, (0, 0, 0))
+            cumuls[ligne.produit_id] = (
+                quantite + ligne.quantite,
+                montant + ligne.total,
+                cout + ligne.quantite * (ligne.prix_achat_unitaire or 0),
+            )
+        if not cumuls:
+            return cumuls
+
+        cls.objects.bulk_create(
+            [cls(pharmacie_id=vente.pharmacie_id, produit_id=pid, jour=jour) for pid in cumuls],
+            ignore_conflicts=True,
+        )
+
+        def par_produit(rang, output_field):
+            return Case(
+                *[When(produit_id=pid, then=Value(valeurs[rang])) for pid, valeurs in cumuls.items()],
+                default=Value(0),
+                output_field=output_field,
+            )
+
+        montant = DecimalField(max_digits=14, decimal_places=2)
+        cls.objects.filter(produit_id__in=cumuls.keys(), jour=jour).update(
+            quantite=F('quantite') + par_produit(0, models.PositiveIntegerField()),
+            chiffre_affaires=F('chiffre_affaires') + par_produit(1, montant),
+            cout=F('cout') + par_produit(2, montant),
+            nombre_ventes=F('nombre_ventes') + 1,
+            premiere_vente=Least(Coalesce('premiere_vente', Value(vente.date_vente)), Value(vente.date_vente)),
+            derniere_vente=Greatest(Coalesce('derniere_vente', Value(vente.date_vente)), Value(vente.date_vente)),
+            updated_at=timezone.now(),
+        )
+        return cumuls
+
+    @classmethod
+    def reconstruire(cls, pharmacie_id, taille_lot=1000, using='default'):
+        """Recalcule toutes les lignes d'une pharmacie depuis VenteLigne (un GROUP BY produit/jour)."""
+        lignes = (
+            VenteLigne.objects.using(using)
+            .filter(vente__pharmacie_id=pharmacie_id)
+            .annotate(jour=TruncDate('vente__date_vente'))
+            .values('produit', 'jour')
+            .annotate(
+                total_quantite=Sum('quantite'),
+                total_montant=Sum('total'),
+                total_cout=Sum(F('quantite') * F('prix_achat_unitaire')),
+                nb_ventes=Count('vente', distinct=True),
+                premiere=Min('vente__date_vente'),
+                derniere=Max('vente__date_vente'),
+            )
+        )
+        faits = [
+            cls(
+                pharmacie_id=pharmacie_id, produit_id=l['produit'], jour=l['jour'],
+                quantite=l['total_quantite'] or 0, chiffre_affaires=l['total_montant'] or 0,
+                cout=l['total_cout'] or 0, nombre_ventes=l['nb_ventes'],
+                premiere_vente=l['premiere'], derniere_vente=l['derniere'],
+            )
+            for l in lignes
+        ]
+        cls.objects.using(using).filter(pharmacie_id=pharmacie_id).delete()
+        cls.objects.using(using).bulk_create(faits, batch_size=taille_lot)
+        return len(faits)
+
+class StatistiqueJournaliere(models.Model):
+    """
+    Compteurs du jour d'une pharmacie pour le tableau de bord (statistiques_du_jour) :
+    une ligne par pharmacie et par jour, incrémentée dans la transaction de chaque vente
+    (VenteJournaliere.enregistrer_compteurs, en fin de vente). Le tableau de bord lit cette seule ligne.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name='statistiques_journalieres')
+    jour = models.DateField()
+    nombre_ventes = models.PositiveIntegerField(default=0)
+    total_ventes = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # somme des montant_total
+    chiffre_affaires = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # somme des lignes
+    cout = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    produit_plus_vendu = models.ForeignKey(
+        ProduitPharmacie, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    quantite_plus_vendu = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pharmacie', 'jour'], name='unique_statistique_journaliere')
+        ]
+
+    def __str__(self):
+        return f"{self.pharmacie_id} - {self.jour} : {self.chiffre_affaires}"
+
+    @property
+    def benefice(self):
+        return self.chiffre_affaires - self.cout
+
+    @classmethod
+    def enregistrer_vente(cls, vente, jour, cumuls):
+        """
+        Ajoute une vente aux compteurs du jour (cumuls = {produit_id: (quantite, montant, cout)}).
+        Le produit le plus vendu n'est remplacé que si un produit de cette vente
+        dépasse sa quantité du jour (UPDATE conditionnel, sûr en concurrence).
+        """
+        cls.objects.bulk_create([cls(pharmacie_id=vente.pharmacie_id, jour=jour)], ignore_conflicts=True)
+
+        # Quantités du jour déjà incrémentées par cette vente (lignes verrouillées par la transaction)
+        produit_id, quantite = (
+            VenteJournaliere.objects
+            .filter(produit_id__in=cumuls.keys(), jour=jour)
+            .order_by('-quantite')
+            .values_list('produit_id', 'quantite')
+            .first()
+        )
+
+        montant = DecimalField(max_digits=14, decimal_places=2)
+        cls.objects.filter(pharmacie_id=vente.pharmacie_id, jour=jour).update(
+            nombre_ventes=F('nombre_ventes') + 1,
+            total_ventes=F('total_ventes') + Value(vente.montant_total or 0, output_field=montant),
+            chiffre_affaires=F('chiffre_affaires') + Value(sum(c[1] for c in cumuls.values()), output_field=montant),
+            cout=F('cout') + Value(sum(c[2] for c in cumuls.values()), output_field=montant),
+            produit_plus_vendu=Case(
+                When(quantite_plus_vendu__lt=quantite, then=Value(produit_id)),
+                default=F('produit_plus_vendu'),
+                output_field=models.UUIDField(),
+            ),
+            quantite_plus_vendu=Greatest('quantite_plus_vendu', Value(quantite)),
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def reconstruire(cls, pharmacie_id, using='default'):
+        """Recalcule les compteurs d'une pharmacie depuis VenteProduit et VenteJournaliere."""
+        stats = {}
+        for v in (VenteProduit.objects.using(using).filter(pharmacie_id=pharmacie_id)
+                  .annotate(jour=TruncDate('date_vente')).values('jour')
+                  .annotate(nb=Count('id'), total=Sum('montant_total'))):
+            stats[v['jour']] = cls(
+                pharmacie_id=pharmacie_id, jour=v['jour'], nombre_ventes=v['nb'], total_ventes=v['total'] or 0
+            )
+
+        # Cumuls par jour, puis produit le plus vendu (premier de chaque jour par quantité décroissante)
+        faits = VenteJournaliere.objects.using(using).filter(pharmacie_id=pharmacie_id)
+        for f in faits.values('jour').annotate(ca=Sum('chiffre_affaires'), total_cout=Sum('cout')):
+            stat = stats.setdefault(f['jour'], cls(pharmacie_id=pharmacie_id, jour=f['jour']))
+            stat.chiffre_affaires, stat.cout = f['ca'] or 0, f['total_cout'] or 0
+        for jour, produit_id, quantite in faits.order_by('jour', '-quantite').values_list('jour', 'produit_id', 'quantite'):
+            stat = stats[jour]
+            if stat.produit_plus_vendu_id is None:
+                stat.produit_plus_vendu_id, stat.quantite_plus_vendu = produit_id, quantite
+
+        cls.objects.using(using).filter(pharmacie_id=pharmacie_id).delete()
+        cls.objects.using(using).bulk_create(stats.values(), batch_size=1000)
+        return len(stats)
+
+class VenteUtilisateurJournaliere(models.Model):
+    """
+    Ventes cumulées par utilisateur (caissier) et par jour, tenues à jour à chaque vente
+    (VenteJournaliere.enregistrer_compteurs). Alimentent les séries jour/semaine/mois
+    de l'historique d'un caissier sans relire ses ventes.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name='ventes_utilisateurs_journalieres')
+    utilisateur = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ventes_journalieres')
+    jour = models.DateField()
+    nombre_ventes = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # Par pharmacie : un utilisateur qui change de pharmacie repart sur de nouvelles lignes
+            models.UniqueConstraint(
+                fields=['pharmacie', 'utilisateur', 'jour'], name='unique_vente_pharmacie_utilisateur_jour'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.utilisateur_id} - {self.jour} : {self.total}"
+
+    @classmethod
+    def enregistrer_vente(cls, vente, jour):
+        if not vente.utilisateur_id:
+            return
+        cls.objects.bulk_create(
+            [cls(pharmacie_id=vente.pharmacie_id, utilisateur_id=vente.utilisateur_id, jour=jour)],
+            ignore_conflicts=True,
+        )
+        cls.objects.filter(pharmacie_id=vente.pharmacie_id, utilisateur_id=vente.utilisateur_id, jour=jour).update(
+            nombre_ventes=F('nombre_ventes') + 1,
+            total=F('total') + Value(vente.montant_total or 0, output_field=DecimalField(max_digits=14, decimal_places=2)),
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def reconstruire(cls, pharmacie_id, using='default'):
+        """Recalcule les cumuls des utilisateurs d'une pharmacie depuis VenteProduit (un GROUP BY)."""
+        cumuls = (
+            VenteProduit.objects.using(using)
+            .filter(pharmacie_id=pharmacie_id, utilisateur__isnull=False)
+            .annotate(jour=TruncDate('date_vente'))
+            .values('utilisateur', 'jour')
+            .annotate(nb=Count('id'), montant=Sum('montant_total'))
+        )
+        faits = [
+            cls(pharmacie_id=pharmacie_id, utilisateur_id=c['utilisateur'], jour=c['jour'],
+                nombre_ventes=c['nb'], total=c['montant'] or 0)
+            for c in cumuls
+        ]
+        cls.objects.using(using).filter(pharmacie_id=pharmacie_id).delete()
+        cls.objects.using(using).bulk_create(faits, batch_size=1000)
+        return len(faits)
+
+class ValorisationStock(models.Model):
+    """
+    Valeur du stock d'une pharmacie (au prix de vente et au prix d'achat), tenue à jour
+    par catégorie et localisation : ajustée à chaque mouvement de stock ou changement de prix
+    (signaux ProduitPharmacie, ventes), recalculable d'un seul SUM
+    (commande reconcilier_valorisation_stock).
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name='valorisations_stock')
+    categorie = models.CharField(max_length=100)
+    localisation = models.CharField(max_length=255)
+    quantite = models.BigIntegerField(default=0)
+    valeur_vente = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    valeur_achat = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['pharmacie', 'categorie', 'localisation'], name='unique_valorisation_stock_groupe'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.categorie} / {self.localisation} : {self.valeur_vente}"
+
+    @classmethod
+    def ajuster(cls, pharmacie_id, mouvements, creer_groupes=True):
+        """
+        Applique des mouvements de stock signés :
+        mouvements = [(categorie, localisation, quantite, prix_vente, prix_achat), ...]
+        En deux requêtes quel que soit le nombre de mouvements (lignes manquantes, puis un UPDATE F()).
+        creer_groupes=False pour une sortie de stock pure (suppression) : rien à créer.
+        """
+        cumuls = {}
+        for categorie, localisation, quantite, prix_vente, prix_achat in mouvements:
+            q, vente, achat = cumuls.get((categorie, localisation), (0, 0, 0))
+            cumuls[(categorie, localisation)] = (
+                q + quantite,
+                vente + quantite * (prix_vente or 0),
+                achat + quantite * (prix_achat or 0),
+            )
+        cumuls = {groupe: valeurs for groupe, valeurs in cumuls.items() if any(valeurs)}
+        if not cumuls:
+            return
+
+        if creer_groupes:
+            cls.objects.bulk_create(
+                [cls(pharmacie_id=pharmacie_id, categorie=c, localisation=l) for c, l in cumuls],
+                ignore_conflicts=True,
+            )
+
+        def par_groupe(rang, output_field):
+            return Case(
+                *[When(categorie=c, localisation=l, then=Value(valeurs[rang])) for (c, l), valeurs in cumuls.items()],
+                default=Value(0),
+                output_field=output_field,
+            )
+
+        groupes = Q()
+        for c, l in cumuls:
+            groupes |= Q(categorie=c, localisation=l)
+
+        montant = DecimalField(max_digits=16, decimal_places=2)
+        cls.objects.filter(groupes, pharmacie_id=pharmacie_id).update(
+            quantite=F('quantite') + par_groupe(0, models.BigIntegerField()),
+            valeur_vente=F('valeur_vente') + par_groupe(1, montant),
+            valeur_achat=F('valeur_achat') + par_groupe(2, montant),
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def reconstruire(cls, pharmacie_id, using='default'):
+        """Recalcule la valorisation d'une pharmacie depuis ProduitPharmacie (un GROUP BY)."""
+        montant = DecimalField(max_digits=16, decimal_places=2)
+        groupes = (
+            ProduitPharmacie.objects.using(using)
+            .filter(pharmacie_id=pharmacie_id)
+            .values('categorie', 'localisation')
+            .annotate(
+                total_quantite=Sum('quantite'),
+                total_vente=Sum(F('quantite') * Coalesce('prix_vente', Value(0), output_field=montant), output_field=montant),
+                total_achat=Sum(F('quantite') * F('prix_achat'), output_field=montant),
+            )
+        )
+        valorisations = [
+            cls(
+                pharmacie_id=pharmacie_id, categorie=g['categorie'], localisation=g['localisation'],
+                quantite=g['total_quantite'] or 0, valeur_vente=g['total_vente'] or 0, valeur_achat=g['total_achat'] or 0,
+            )
+            for g in groupes
+        ]
+        cls.objects.using(using).filter(pharmacie_id=pharmacie_id).delete()
+        cls.objects.using(using).bulk_create(valorisations)
+        return valorisations
+
 ######################### ENREGISTREMENT CLIENT ET TOUT CE QUI LUI CONCERNE##################
 from django.db import models
 from django.contrib.auth.models import User
@@ -537,3 +973,35 @@ class RapportMensuel(models.Model):
         import calendar
         return calendar.month_name[self.mois]
 
+
+
+######################## Prévision de la demande ########################
+class PrevisionDemande(models.Model):
+    """
+    Dernière prévision de demande d'un produit, calculée en lot
+    (commande calculer_previsions) et lue par l'écran des suggestions de commande.
+    La quantité à commander n'est pas stockée : elle se calcule à la lecture,
+    avec le stock du moment.
+    """
+    METHODE_CHOICES = [
+        ('lissage', 'Lissage exponentiel simple'),
+        ('croston', 'Croston (demande intermittente)'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacie = models.ForeignKey(Pharmacie, on_delete=models.CASCADE, related_name="previsions_demande")
+    produit = models.OneToOneField('ProduitPharmacie', on_delete=models.CASCADE, related_name="prevision_demande")
+    methode = models.CharField(max_length=10, choices=METHODE_CHOICES)
+
+    demande_journaliere = models.DecimalField(max_digits=12, decimal_places=3)  # hors saisonnalité
+    coefficient_saisonnier = models.DecimalField(max_digits=5, decimal_places=2, default=1)
+
+    calcule_le = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.produit.nom_medicament} : {self.demande_journaliere}/jour ({self.methode})"
+
+    @property
+    def demande_prevue(self):
+        """Demande journalière prévue, saisonnalité comprise."""
+        return self.demande_journaliere * self.coefficient_saisonnier
@@ -103,7 +103,7 @@ class ProduitPharmacieSerializer(serializers.ModelSerializer):
 
 # serializers.py
 from rest_framework import serializers
-from .models import LotProduitPharmacie
+from .models import LotProduitPharmacie, VenteJournaliere
 
 class LotProduitPharmacieSerializer(serializers.ModelSerializer):
     nom_medicament = serializers.CharField(source='produit.nom_medicament', read_only=True)
@@ -424,7 +424,21 @@ class PharmacieSerializer(serializers.ModelSerializer):
         model = Pharmacie
         fields = '__all__'  # ✅ Affiche tous les champs du modèle
 
+class ProduitPanierField(serializers.PrimaryKeyRelatedField):
+    """
+    Résout le produit d'une ligne depuis les produits du panier préchargés
+    par VenteProduitSerializer (une seule requête au lieu d'un .get() par ligne).
+    """
+    def to_internal_value(self, data):
+        produit = self.context.get('produits_panier', {}).get(str(data))
+        if produit is not None:
+            return produit
+        return super().to_internal_value(data)
+
+
 class VenteLigneSerializer(serializers.ModelSerializer):
+    produit = ProduitPanierField(queryset=ProduitPharmacie.objects.all())
+
     class Meta:
         model = VenteLigne
         fields = ['produit', 'quantite']  # prix_unitaire n'est plus requis
@@ -459,7 +473,7 @@ from .serializers import VenteLignessSerializer  # Assurez-vous que ce serialize
 
 class HistoriqueVenteSerializer(serializers.ModelSerializer):
     utilisateur = serializers.CharField(source='utilisateur.username', default=None)
-    client = serializers.CharField(source='client.nom', default=None)
+    client = serializers.CharField(source='client.nom_complet', default=None)
     lignes = VenteLignessSerializer(many=True, read_only=True)
 
     class Meta:
@@ -493,6 +507,11 @@ class CurrentPharmacieDefault:
 
 # 🔽 Import de la fonction d’impression thermique
 from .utils import imprimer_ticket_vente
+from .signals import creer_requisition_automatique
+from .utils import index_codes_barres, publier_evenement, publier_mouvements_stock
+from .models import LotProduitPharmacie, ValorisationStock
+from django.utils import timezone
+import uuid
 
 
 class VenteProduitSerializer(serializers.ModelSerializer):
@@ -522,22 +541,38 @@ class VenteProduitSerializer(serializers.ModelSerializer):
         model = VenteProduit
         fields = [
             'id', 'pharmacie', 'pharmacie_detail', 'date_vente',
-            'utilisateur', 'client', 'lignes', 'montant_total'
+            'utilisateur', 'client', 'lignes', 'montant_total', 'cle_idempotence'
         ]
         read_only_fields = ['date_vente', 'utilisateur', 'montant_total']
+        # Les doublons de cle_idempotence sont traités par les vues (vente existante renvoyée)
+        validators = []
+
+    def to_internal_value(self, data):
+        # 🔹 Charge tous les produits du panier en une seule requête
+        ids = []
+        lignes = data.get('lignes') if hasattr(data, 'get') else None
+        for ligne in lignes if isinstance(lignes, list) else []:
+            try:
+                ids.append(uuid.UUID(str(ligne.get('produit'))))
+            except (AttributeError, TypeError, ValueError):
+                continue
+        self.context['produits_panier'] = {
+            str(p.pk): p for p in ProduitPharmacie.objects.filter(pk__in=ids)
+        }
+        return super().to_internal_value(data)
 
     def validate(self, data):
         pharmacie = data['pharmacie']
         client = data.get('client')
 
-        if client and client.pharmacie != pharmacie:
+        if client and client.pharmacie_id != pharmacie.id:
             raise serializers.ValidationError(
                 "Le client n'appartient pas à cette pharmacie"
             )
 
         for ligne in data['lignes']:
             produit = ligne['produit']
-            if produit.pharmacie != pharmacie:
+            if produit.pharmacie_id != pharmacie.id:
                 raise serializers.ValidationError(
                     f"Le produit {produit.nom_medicament} n'appartient pas à cette pharmacie"
                 )
@@ -555,56 +590,110 @@ class VenteProduitSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         lignes_data = validated_data.pop('lignes')
         client = validated_data.pop('client', None)
+        maintenant = timezone.now()
 
-        vente = VenteProduit.objects.create(client=client, **validated_data)
-
-        total_vente = 0
+        # Regroupe les quantités par produit (un produit peut figurer sur plusieurs lignes)
+        produits = {}
+        quantites = {}
+        for ligne_data in lignes_data:
+            produit = ligne_data['produit']
+            produits[produit.pk] = produit
+            quantites[produit.pk] = quantites.get(produit.pk, 0) + ligne_data['quantite']
+
+        # ✅ Réduction atomique du stock global (sûre entre caisses concurrentes)
+        echecs = ProduitPharmacie.decrementer_stock(quantites)
+        if echecs:
+            stocks = dict(ProduitPharmacie.objects.filter(pk__in=echecs).values_list('pk', 'quantite'))
+            raise serializers.ValidationError([
+                f"Stock insuffisant pour {produits[produit_id].nom_medicament}. "
+                f"Stock: {stocks.get(produit_id, 0)}, Demande: {quantites[produit_id]}"
+                for produit_id in echecs
+            ])
+
+        # Lignes de vente préparées en mémoire, insérées en une seule requête
         lignes_instances = []  # Pour conserver les lignes de vente créées
-
         for ligne_data in lignes_data:
             produit = ligne_data['produit']
             quantite = ligne_data['quantite']
             prix_unitaire = produit.prix_vente
-            total_ligne = quantite * prix_unitaire
-
-            # Création de la ligne de vente
-            ligne = VenteLigne.objects.create(
-                vente=vente,
+            lignes_instances.append(VenteLigne(
                 produit=produit,
                 quantite=quantite,
                 prix_unitaire=prix_unitaire,
-                total=total_ligne
-            )
-            lignes_instances.append(ligne)
-
-            # ✅ Réduction du stock global
-            produit.quantite -= quantite
-            produit.save()
-
-            # ✅ Réduction du stock dans les lots FIFO
-            quantite_restante = quantite
-            lots = produit.lots.filter(quantite__gt=0).order_by('date_entree')
-
-            for lot in lots:
-                if quantite_restante <= 0:
-                    break
-
-                quantite_a_retirer = min(lot.quantite, quantite_restante)
-                lot.quantite -= quantite_a_retirer
-                lot.save()
-
-                quantite_restante -= quantite_a_retirer
-
-            total_vente += total_ligne
-
-        vente.montant_total = total_vente
-        vente.save(update_fields=['montant_total'])
-
-        # ✅ Impression du ticket (placé après la sauvegarde complète)
-        imprimer_ticket_vente(vente, lignes_instances)
+                total=quantite * prix_unitaire,
+                prix_achat_unitaire=produit.prix_achat or 0,  # bulk_create n'appelle pas save()
+            ))
+
+        total_vente = sum(ligne.total for ligne in lignes_instances)
+        vente = VenteProduit.objects.create(client=client, montant_total=total_vente, **validated_data)
+
+        for ligne in lignes_instances:
+            ligne.vente = vente
+        VenteLigne.objects.bulk_create(lignes_instances)
+
+        # 📊 Cumuls du jour par produit (table de faits des analyses)
+        cumuls = VenteJournaliere.enregistrer_lignes(vente, lignes_instances)
+
+        # ✅ Réduction du stock dans les lots FIFO (une lecture + une mise à jour groupée)
+        # Les lignes produit sont déjà verrouillées par l'UPDATE ci-dessus : les lots
+        # sont lus après le commit d'une vente concurrente du même produit.
+        restant = dict(quantites)
+        lots_modifies = []
+        lots = LotProduitPharmacie.objects.select_for_update().filter(
+            produit_id__in=quantites.keys(), quantite__gt=0
+        ).order_by('date_entree', 'id')
+
+        for lot in lots:
+            quantite_restante = restant[lot.produit_id]
+            if quantite_restante <= 0:
+                continue
+
+            quantite_a_retirer = min(lot.quantite, quantite_restante)
+            lot.quantite -= quantite_a_retirer
+            lot.updated_at = maintenant
+            lots_modifies.append(lot)
+
+            restant[lot.produit_id] = quantite_restante - quantite_a_retirer
+
+        LotProduitPharmacie.objects.bulk_update(lots_modifies, ['quantite', 'updated_at'])
+
+        # Stock réel après vente (l'UPDATE ne passe pas par save() ni par le signal)
+        stocks = dict(ProduitPharmacie.objects.filter(pk__in=quantites.keys()).values_list('pk', 'quantite'))
+        mouvements = []
+        for produit_id, quantite in stocks.items():
+            produit = produits[produit_id]
+            mouvements.append((produit, produit.quantite))
+            produit.quantite = quantite
+            creer_requisition_automatique(produit)
+        transaction.on_commit(lambda: index_codes_barres.ajuster_stocks(vente.pharmacie_id, stocks))
+
+        # 📡 Tableaux de bord en direct : la vente (à ajouter aux compteurs du jour) et les stocks touchés
+        cout = sum(quantites[pk] * (p.prix_achat or 0) for pk, p in produits.items())
+        publier_evenement(vente.pharmacie_id, 'vente', {
+            'id': str(vente.pk),
+            'date_vente': vente.date_vente,
+            'montant_total': total_vente,
+            'benefice': total_vente - cout,
+            'caissier': vente.utilisateur.username if vente.utilisateur else None,
+        })
+        publier_mouvements_stock(vente.pharmacie_id, mouvements)
+
+        # ✅ Impression du ticket : mise en file seulement après le commit de la vente
+        # (pas pour les ventes hors ligne synchronisées : le ticket a déjà été remis)
+        if self.context.get('imprimer_ticket', True):
+            transaction.on_commit(lambda: imprimer_ticket_vente(vente, lignes_instances))
 
         if client:
-            client.update_stats()
+            Client.enregistrer_achat(client.pk, total_vente, vente.date_vente)
+
+        # 📊 Lignes partagées par toutes les caisses, verrouillées jusqu'au commit : mises à jour
+        # en dernier pour ne pas sérialiser le reste de la vente (lots, réquisitions, client)
+        # - valorisation du stock par catégorie/localisation (decrementer_stock ne passe pas par le signal)
+        # - compteurs du jour de la pharmacie et du caissier
+        ValorisationStock.ajuster(vente.pharmacie_id, [
+            (p.categorie, p.localisation, -quantites[pk], p.prix_vente, p.prix_achat) for pk, p in produits.items()
+        ])
+        VenteJournaliere.enregistrer_compteurs(vente, cumuls)
 
         return vente
 
@@ -80,19 +80,19 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from pharmacie.models import ProduitPharmacie, Requisition
 
-@receiver(post_save, sender=ProduitPharmacie)
-def verifier_stock_et_creer_requisition(sender, instance, **kwargs):
+def creer_requisition_automatique(produit):
     """
     ✅ Crée automatiquement une réquisition quand le stock est sous alerte
+    (appelée par le signal et par la vente, qui met le stock à jour sans save())
     """
     try:
         # Vérifie la condition d’alerte
-        if instance.quantite <= instance.alerte_quantite:
+        if produit.quantite <= produit.alerte_quantite:
             requisition, created = Requisition.objects.get_or_create(
-                produit_fabricant=instance.produit_fabricant,
-                pharmacie=instance.pharmacie,
+                produit_fabricant_id=produit.produit_fabricant_id,
+                pharmacie_id=produit.pharmacie_id,
                 defaults={
-                    "nom_personnalise": instance.nom_medicament,
+                    "nom_personnalise": produit.nom_medicament,
                     "nombre_demandes": 1,
                     "auto_genere": True,  # 🔰 Distinction visuelle (ex: point vert dans React)
                 },
@@ -103,7 +103,116 @@ def verifier_stock_et_creer_requisition(sender, instance, **kwargs):
                 requisition.nombre_demandes += 1
                 requisition.save()
 
-            print(f"✅ Réquisition automatique créée pour {instance.nom_medicament}")
+            print(f"✅ Réquisition automatique créée pour {produit.nom_medicament}")
 
     except Exception as e:
         print(f"⚠️ Erreur lors de la création de la réquisition automatique : {e}")
+
+
+@receiver(post_save, sender=ProduitPharmacie)
+def verifier_stock_et_creer_requisition(sender, instance, **kwargs):
+    creer_requisition_automatique(instance)
+
+
+# 🔎 Index des codes-barres de la caisse : suit les modifications des produits
+from django.db import transaction
+from django.db.models.signals import post_delete
+from pharmacie.utils import index_codes_barres, index_recherche
+
+@receiver(post_save, sender=ProduitPharmacie)
+def maj_index_codes_barres(sender, instance, **kwargs):
+    transaction.on_commit(lambda: index_codes_barres.mettre_a_jour(instance))
+
+
+@receiver(post_delete, sender=ProduitPharmacie)
+def retirer_de_index_codes_barres(sender, instance, **kwargs):
+    transaction.on_commit(lambda: index_codes_barres.retirer(instance.pharmacie_id, instance.pk))
+
+
+# 🔎 Index de recherche par nom : reconstruit à la prochaine recherche
+@receiver(post_save, sender=ProduitPharmacie)
+@receiver(post_delete, sender=ProduitPharmacie)
+def invalider_index_recherche(sender, instance, **kwargs):
+    transaction.on_commit(lambda: index_recherche.invalider(instance.pharmacie_id))
+
+
+@receiver(post_save, sender=ProduitFabricant)
+def invalider_index_recherche_fabricant(sender, instance, **kwargs):
+    # Le nom fabricant est partagé par toutes les pharmacies
+    transaction.on_commit(index_recherche.invalider)
+
+
+# 📊 Analyses en cache : nouvelle version à chaque mouvement de stock, vente ou dépense
+from pharmacie.models import ReceptionProduit
+from pharmacie.utils import invalider_analyses
+
+@receiver(post_save, sender=ProduitPharmacie)
+def invalider_analyses_produit(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalider_analyses(instance.pharmacie_id))
+
+
+@receiver(post_save, sender=ReceptionProduit)
+def invalider_analyses_reception(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: invalider_analyses(instance.commande.pharmacie_id))
+
+
+from pharmacie.models import VenteProduit, Depense
+
+@receiver(post_save, sender=VenteProduit)
+@receiver(post_delete, sender=VenteProduit)
+@receiver(post_save, sender=Depense)
+@receiver(post_delete, sender=Depense)
+def invalider_analyses_vente_depense(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalider_analyses(instance.pharmacie_id))
+
+
+# 💰 Valorisation du stock : différence avant/après de chaque produit, dans la même transaction
+from django.db.models.signals import pre_save
+from pharmacie.models import ValorisationStock
+
+CHAMPS_VALORISATION = ('categorie', 'localisation', 'quantite', 'prix_vente', 'prix_achat')
+
+@receiver(pre_save, sender=ProduitPharmacie)
+def memoriser_valorisation_produit(sender, instance, **kwargs):
+    instance._valorisation_avant = (
+        ProduitPharmacie.objects.filter(pk=instance.pk).values_list(*CHAMPS_VALORISATION).first()
+    )
+
+
+@receiver(post_save, sender=ProduitPharmacie)
+def ajuster_valorisation_produit(sender, instance, **kwargs):
+    mouvements = [tuple(getattr(instance, champ) for champ in CHAMPS_VALORISATION)]
+    avant = getattr(instance, '_valorisation_avant', None)
+    if avant:
+        categorie, localisation, quantite, prix_vente, prix_achat = avant
+        mouvements.append((categorie, localisation, -quantite, prix_vente, prix_achat))
+    ValorisationStock.ajuster(instance.pharmacie_id, mouvements)
+
+
+@receiver(post_delete, sender=ProduitPharmacie)
+def retirer_valorisation_produit(sender, instance, **kwargs):
+    ValorisationStock.ajuster(instance.pharmacie_id, [
+        (instance.categorie, instance.localisation, -instance.quantite, instance.prix_vente, instance.prix_achat)
+    ], creer_groupes=False)
+
+
+# 📡 Événements en direct (SSE) : stock modifié par save() et réceptions
+from pharmacie.utils import publier_evenement, publier_mouvements_stock
+
+@receiver(post_save, sender=ProduitPharmacie)
+def publier_stock_produit(sender, instance, **kwargs):
+    avant = getattr(instance, '_valorisation_avant', None)
+    quantite_avant = avant[CHAMPS_VALORISATION.index('quantite')] if avant else None
+    if avant and quantite_avant == instance.quantite:
+        return  # ex. prix recalculés par le taux de change : rien à pousser aux tableaux de bord
+    publier_mouvements_stock(instance.pharmacie_id, [(instance, quantite_avant)])
+
+
+@receiver(post_save, sender=ReceptionProduit)
+def publier_reception(sender, instance, created, **kwargs):
+    if created:
+        publier_evenement(instance.commande.pharmacie_id, 'reception', {
+            'id': str(instance.pk),
+            'commande': str(instance.commande_id),
+        })
@@ -35,4 +35,1290 @@ class ReceptionTest(TestCase):
 
         # Vérifiez que l'état de la commande a été modifié
         commande = CommandeProduit.objects.get(id=self.commande.id)
-        self.assertEqual(commande.etat, "confirmee")
\ No newline at end of file
+        self.assertEqual(commande.etat, "confirmee")
+
+############################ Vente au comptoir ############################
+from datetime import date, timedelta
+from io import StringIO
+from decimal import Decimal
+import uuid
+from unittest import mock
+from unittest import skipIf
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .utils import rechercher_produits
+from rest_framework.test import APIClient
+from comptes.models import User
+from .models import LotProduitPharmacie, VenteProduit, VenteLigne
+
+
+class VenteBaseMixin:
+    def creer_pharmacie(self):
+        self.pharmacie = Pharmacie.objects.create(
+            nom_pharm="Pharmacie Test", ville_pharm="Kinshasa", commune_pharm="Gombe",
+            adresse_pharm="Av. Test", ni="NI-1", telephone="0990000000"
+        )
+        self.user = User.objects.create_user(
+            username="caissier", password="secret", pharmacie=self.pharmacie, role="comptable"
+        )
+        self.fabricant = Fabricant.objects.create(nom="Fabricant Test", pays_origine="RDC")
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def creer_produit(self, nom, quantite=100, prix_achat=100, alerte=3, lots=()):
+        pf = ProduitFabricant.objects.create(fabricant=self.fabricant, nom=nom, prix_achat=prix_achat)
+        produit = ProduitPharmacie.objects.create(
+            pharmacie=self.pharmacie, produit_fabricant=pf, code_barre=f"CB-{nom}",
+            nom_medicament=nom, localisation="A0", conditionnement="boîte",
+            date_peremption=date.today() + timedelta(days=365), categorie="generique",
+            alerte_quantite=alerte, quantite=quantite, prix_achat=0, marge_beneficiaire=20
+        )
+        for i, qte in enumerate(lots):
+            lot = LotProduitPharmacie.objects.create(
+                produit=produit, quantite=qte, date_peremption=date.today() + timedelta(days=300)
+            )
+            LotProduitPharmacie.objects.filter(pk=lot.pk).update(
+                date_entree=date.today() - timedelta(days=len(lots) - i)
+            )
+        return produit
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class VenteComptoirTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+
+    def vendre(self, lignes):
+        return self.api.post('/api/ventes/', {
+            'lignes': [{'produit': str(p.id), 'quantite': q} for p, q in lignes]
+        }, format='json')
+
+    def test_vente_decremente_stock_et_lots_fifo(self, _imprimer):
+        produit = self.creer_produit("Paracetamol", quantite=10, lots=(4, 6))
+
+        response = self.vendre([(produit, 3), (produit, 2)])
+
+        self.assertEqual(response.status_code, 201, response.data)
+        produit.refresh_from_db()
+        self.assertEqual(produit.quantite, 5)
+        lots = list(produit.lots.order_by('date_entree').values_list('quantite', flat=True))
+        self.assertEqual(lots, [0, 5])
+        vente = VenteProduit.objects.get()
+        self.assertEqual(vente.lignes.count(), 2)
+        self.assertEqual(vente.montant_total, 5 * produit.prix_vente)
+
+    def test_stock_insuffisant_refuse_la_vente(self, _imprimer):
+        produit = self.creer_produit("Amoxicilline", quantite=2)
+
+        response = self.vendre([(produit, 3)])
+
+        self.assertEqual(response.status_code, 400)
+        produit.refresh_from_db()
+        self.assertEqual(produit.quantite, 2)
+        self.assertFalse(VenteLigne.objects.exists())
+
+    def test_nombre_de_requetes_independant_du_nombre_de_lignes(self, _imprimer):
+        petits = [self.creer_produit(f"P{i}", lots=(50, 50)) for i in range(3)]
+        grands = [self.creer_produit(f"G{i}", lots=(50, 50)) for i in range(9)]
+
+        with CaptureQueriesContext(connection) as petit_panier:
+            self.assertEqual(self.vendre([(p, 1) for p in petits]).status_code, 201)
+        with CaptureQueriesContext(connection) as grand_panier:
+            self.assertEqual(self.vendre([(p, 1) for p in grands]).status_code, 201)
+
+        # Seul l'UPDATE conditionnel du stock dépend du nombre de produits
+        self.assertEqual(len(grand_panier) - len(petit_panier), len(grands) - len(petits))
+
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class VenteHorsLigneTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Ibuprofene", quantite=5, lots=(5,))
+
+    def vente(self, cle, quantite):
+        return {'cle_idempotence': cle, 'lignes': [{'produit': str(self.produit.id), 'quantite': quantite}]}
+
+    def test_lot_de_ventes_dedoublonne_au_renvoi(self, imprimer):
+        ventes = [self.vente("caisse1-1", 2), self.vente("caisse1-2", 9), self.vente("caisse1-3", 3)]
+
+        premier = self.api.post('/api/ventes/lot/', {'ventes': ventes}, format='json')
+        renvoi = self.api.post('/api/ventes/lot/', {'ventes': ventes}, format='json')
+
+        self.assertEqual(premier.status_code, 200)
+        self.assertEqual([r['statut'] for r in premier.data['resultats']], ['cree', 'erreur', 'cree'])
+        self.assertEqual([r['statut'] for r in renvoi.data['resultats']], ['doublon', 'erreur', 'doublon'])
+        self.assertEqual(renvoi.data['resultats'][0]['vente_id'], premier.data['resultats'][0]['vente_id'])
+
+        self.produit.refresh_from_db()
+        self.assertEqual(self.produit.quantite, 0)
+        self.assertEqual(VenteProduit.objects.count(), 2)
+        imprimer.assert_not_called()
+
+    def test_lot_garde_l_heure_de_la_caisse(self, _imprimer):
+        hier = timezone.now() - timedelta(days=1)
+        ventes = [
+            dict(self.vente("caisse1-4", 1), date_vente=hier.isoformat()),
+            dict(self.vente("caisse1-5", 1), date_vente=(timezone.now() + timedelta(hours=2)).isoformat()),
+            dict(self.vente("caisse1-6", 1), date_vente=(timezone.now() - timedelta(days=30)).isoformat()),
+            dict(self.vente("caisse1-7", 1), date_vente="pas une date"),
+        ]
+
+        reponse = self.api.post('/api/ventes/lot/', {'ventes': ventes}, format='json')
+
+        self.assertEqual([r['statut'] for r in reponse.data['resultats']], ['cree', 'erreur', 'erreur', 'erreur'])
+        vente = VenteProduit.objects.get(cle_idempotence="caisse1-4")
+        self.assertEqual(vente.date_vente, hier)
+        self.assertTrue(VenteJournaliere.objects.filter(produit=self.produit, jour=timezone.localdate(hier)).exists())
+
+    def test_vente_unique_renvoyee_avec_la_meme_cle(self, _imprimer):
+        premiere = self.api.post('/api/ventes/', self.vente("caisse1-9", 1), format='json')
+        seconde = self.api.post('/api/ventes/', self.vente("caisse1-9", 1), format='json')
+
+        self.assertEqual((premiere.status_code, seconde.status_code), (201, 200))
+        self.assertEqual(premiere.data['id'], seconde.data['id'])
+        self.produit.refresh_from_db()
+        self.assertEqual(self.produit.quantite, 4)
+
+
+
+from django.core.management import call_command
+from .models import Client, VenteJournaliere
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class StatistiquesClientTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Vitamine C", quantite=50)
+        self.client_fidele = Client.objects.create(
+            pharmacie=self.pharmacie, nom_complet="Client Fidèle", telephone="0990000001"
+        )
+
+    def vendre(self, quantite):
+        return self.api.post('/api/ventes/', {
+            'client': str(self.client_fidele.id),
+            'lignes': [{'produit': str(self.produit.id), 'quantite': quantite}]
+        }, format='json')
+
+    def test_vente_met_a_jour_les_statistiques_sans_relire_l_historique(self, _imprimer):
+        self.vendre(2)
+        with CaptureQueriesContext(connection) as requetes:
+            self.vendre(3)
+
+        # Aucune requête ne relit les ventes du client
+        self.assertFalse([q for q in requetes.captured_queries
+                          if 'SUM' in q['sql'] and 'pharmacie_venteproduit' in q['sql']])
+        self.client_fidele.refresh_from_db()
+        total = 5 * self.produit.prix_vente
+        self.assertEqual(self.client_fidele.total_depense, total)
+        self.assertEqual(self.client_fidele.score_fidelite, 2 * int(self.produit.prix_vente) + int(3 * self.produit.prix_vente))
+        self.assertEqual(self.client_fidele.dernier_achat, VenteProduit.objects.latest('date_vente').date_vente)
+
+    def test_commande_recalcule_les_statistiques(self, _imprimer):
+        self.vendre(2)
+        self.vendre(3)
+        attendu = Client.objects.values('total_depense', 'score_fidelite', 'dernier_achat').get()
+        Client.objects.update(total_depense=0, score_fidelite=0, dernier_achat=None)
+
+        call_command('recalculer_stats_clients', pharmacie=str(self.pharmacie.id), stdout=StringIO())
+
+        self.assertEqual(Client.objects.values('total_depense', 'score_fidelite', 'dernier_achat').get(), attendu)
+
+
+
+from .utils import index_codes_barres
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class CodeBarreTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Quinine", quantite=10)
+        index_codes_barres.invalider()
+
+    def scanner(self, code):
+        return self.api.get(f'/api/produits-pharmacie/code-barre/{code}/')
+
+    def test_scan_servi_depuis_l_index(self, _imprimer):
+        self.scanner("CB-Quinine")
+        with CaptureQueriesContext(connection) as requetes:
+            response = self.scanner("CB-Quinine")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], str(self.produit.id))
+        self.assertEqual(response.data['quantite'], 10)
+        # Seule l'authentification touche la base, pas la recherche du produit
+        self.assertFalse([q for q in requetes.captured_queries if 'pharmacie_produitpharmacie' in q['sql']])
+
+    def test_index_suit_les_modifications_et_les_ventes(self, _imprimer):
+        self.scanner("CB-Quinine")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produit.code_barre = "CB-NOUVEAU"
+            self.produit.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api.post('/api/ventes/', {
+                'lignes': [{'produit': str(self.produit.id), 'quantite': 4}]
+            }, format='json')
+
+        self.assertEqual(self.scanner("CB-Quinine").status_code, 404)
+        self.assertEqual(self.scanner("CB-NOUVEAU").data['quantite'], 6)
+
+    def test_code_absent_de_l_index_lu_en_base(self, _imprimer):
+        self.scanner("CB-Quinine")
+        # Produit inséré sans signal (import en masse) : inconnu de l'index
+        autre = ProduitPharmacie.objects.get(pk=self.produit.pk)
+        autre.pk, autre.code_barre = uuid.uuid4(), "CB-IMPORT"
+        ProduitPharmacie.objects.bulk_create([autre])
+
+        self.assertEqual(self.scanner("CB-IMPORT").data['id'], str(autre.pk))
+        self.assertEqual(self.scanner("CB-INCONNU").status_code, 404)
+
+
+
+from .utils import index_recherche
+
+class RechercheProduitTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        for nom in ("Paracétamol 500mg", "Paracétamol sirop", "Amoxicilline", "Ibuprofène"):
+            self.creer_produit(nom)
+        index_recherche.invalider()
+
+    def chercher(self, terme, **params):
+        return self.api.get('/api/produits-pharmacie/recherche/', {'q': terme, **params})
+
+    def test_recherche_tolere_les_fautes_et_classe_les_resultats(self):
+        response = self.chercher("paracetmol")
+
+        self.assertEqual(response.status_code, 200)
+        noms = [r['nom_medicament'] for r in response.data]
+        self.assertEqual(sorted(noms), ["Paracétamol 500mg", "Paracétamol sirop"])
+        self.assertEqual(self.chercher("amoxiciline").data[0]['nom_medicament'], "Amoxicilline")
+        self.assertEqual(len(self.chercher("paracetamol", limite=1).data), 1)
+
+    def test_index_reconstruit_apres_ajout_de_produit(self):
+        self.chercher("quinine")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.creer_produit("Quinine")
+
+        self.assertEqual([r['nom_medicament'] for r in self.chercher("quinin").data], ["Quinine"])
+
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+@skipIf(connection.vendor != 'postgresql', "Recherche pg_trgm : PostgreSQL uniquement")
+class RechercheProduitPostgresTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        for nom in ("Amoxicilline", "Ibuprofene", "Metronidazole"):
+            self.creer_produit(nom)
+
+    def test_filtre_par_operateur_trigramme_et_classe_par_similarite(self):
+        with CaptureQueriesContext(connection) as requetes:
+            resultats = rechercher_produits(self.pharmacie.id, "amoxiciline")
+
+        self.assertEqual([r['nom_medicament'] for r in resultats], ["Amoxicilline"])
+        self.assertGreaterEqual(resultats[0]['score'], 0.4)
+        self.assertIn('%>', requetes[-1]['sql'])
+
+    def test_recherche_sur_le_nom_fabricant(self):
+        ProduitFabricant.objects.filter(nom="Metronidazole").update(nom="Flagyl")
+
+        self.assertEqual([r['nom_medicament'] for r in rechercher_produits(self.pharmacie.id, "flagil")], ["Metronidazole"])
+
+
+
+from django.utils import timezone
+from .utils import (
+    aggregate_received, analyse_rotation_reelle, compute_metrics, estimate_times_in_pharmacy, generate_report,
+    flags_for_product, recommend_order_qty, seasonal_analysis, seasonal_profile, version_analyses,
+    fenetre_mois_complets, seasonal_coefficients,
+)
+from .models import Depense, StatistiqueJournaliere
+
+class AnalyseStockTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+
+    # Les mouvements sont « commités » : les analyses en cache sont invalidées comme en production
+    def receptionner(self, produit, quantite, il_y_a_jours):
+        with self.captureOnCommitCallbacks(execute=True):
+            commande = CommandeProduit.objects.create(pharmacie=self.pharmacie, fabricant=self.fabricant)
+            ligne = CommandeProduitLigne.objects.create(
+                commande=commande, produit_fabricant=produit.produit_fabricant, quantite_commandee=quantite
+            )
+            reception = ReceptionProduit.objects.create(commande=commande)
+            ReceptionLigne.objects.create(reception=reception, ligne_commande=ligne, quantite_recue=quantite)
+            ReceptionProduit.objects.filter(pk=reception.pk).update(
+                date_reception=timezone.now() - timedelta(days=il_y_a_jours)
+            )
+
+    def vendre(self, produit, quantite, il_y_a_jours):
+        with self.captureOnCommitCallbacks(execute=True):
+            vente = VenteProduit.objects.create(pharmacie=self.pharmacie, utilisateur=self.user)
+            ligne = VenteLigne.objects.create(vente=vente, produit=produit, quantite=quantite, prix_unitaire=100)
+            vente.date_vente = timezone.now() - timedelta(days=il_y_a_jours)
+            VenteProduit.objects.filter(pk=vente.pk).update(date_vente=vente.date_vente)
+            VenteJournaliere.enregistrer_vente(vente, [ligne])
+
+    def catalogue(self, nombre):
+        for i in range(nombre):
+            produit = self.creer_produit(f"Produit {nombre}-{i}")
+            self.receptionner(produit, 20, il_y_a_jours=20)
+            self.vendre(produit, 2, il_y_a_jours=5)
+            self.vendre(produit, 3, il_y_a_jours=1)
+
+    def test_temps_moyen_en_pharmacie(self):
+        produit = self.creer_produit("Doliprane")
+        self.receptionner(produit, 10, il_y_a_jours=10)
+        self.vendre(produit, 1, il_y_a_jours=4)
+        self.vendre(produit, 1, il_y_a_jours=2)
+
+        self.assertEqual(estimate_times_in_pharmacy(self.pharmacie)[str(produit.id)], Decimal('7.0'))
+
+    def test_quantites_recues_par_produit_et_periode(self):
+        produit = self.creer_produit("Doliprane")
+        jamais_recu = self.creer_produit("Amoxicilline")
+        self.receptionner(produit, 10, il_y_a_jours=40)
+        self.receptionner(produit, 5, il_y_a_jours=3)
+
+        with CaptureQueriesContext(connection) as requetes:
+            recu = aggregate_received(self.pharmacie)
+        self.assertEqual(len(requetes), 1)
+        self.assertEqual(recu, {str(produit.id): 15, str(jamais_recu.id): 0})
+        self.assertEqual(aggregate_received(self.pharmacie, period_days=30)[str(produit.id)], 5)
+
+    def test_profil_saisonnier_du_catalogue_en_une_requete(self):
+        doliprane = self.creer_produit("Doliprane")
+        amoxicilline = self.creer_produit("Amoxicilline")
+        for il_y_a_jours, quantite in ((40, 10), (75, 2), (110, 3)):
+            self.vendre(doliprane, quantite, il_y_a_jours)
+        self.vendre(amoxicilline, 4, il_y_a_jours=40)
+
+        with CaptureQueriesContext(connection) as requetes:
+            profil = seasonal_profile(self.pharmacie)
+        self.assertEqual(len(requetes), 1)
+
+        for produit in (doliprane, amoxicilline):
+            i = profil['produit_ids'].index(str(produit.id))
+            attendu = seasonal_analysis(self.pharmacie, produit_obj=produit)
+            self.assertEqual(profil['matrix'][i].sum(), sum(float(m['total']) for m in attendu['monthly']))
+            self.assertAlmostEqual(profil['multiplier'][i], attendu['multiplier'])
+
+    def test_saisonnalite_sur_des_mois_complets(self):
+        self.assertEqual(fenetre_mois_complets(12, date(2026, 10, 17)), (date(2025, 10, 1), date(2026, 9, 30)))
+        self.assertEqual(fenetre_mois_complets(1, date(2026, 1, 5)), (date(2025, 12, 1), date(2025, 12, 31)))
+
+        # Vente régulière (1 par jour depuis 400 jours) : coefficient proche de 1, pas sous-estimé
+        produit = self.creer_produit("Doliprane")
+        aujourd_hui = timezone.localdate()
+        VenteJournaliere.objects.bulk_create([
+            VenteJournaliere(pharmacie=self.pharmacie, produit=produit, jour=aujourd_hui - timedelta(days=j),
+                             quantite=1, chiffre_affaires=100, nombre_ventes=1)
+            for j in range(400)
+        ])
+        coefficient = seasonal_coefficients(self.pharmacie, [produit.id])[0]
+        self.assertAlmostEqual(coefficient, 1.0, delta=0.1)
+
+    def test_nombre_de_requetes_constant_quelle_que_soit_la_taille_du_catalogue(self):
+        self.catalogue(2)
+        with CaptureQueriesContext(connection) as petit:
+            self.assertEqual(len(compute_metrics(self.pharmacie)), 2)
+
+        self.catalogue(8)
+        with CaptureQueriesContext(connection) as grand:
+            metriques = compute_metrics(self.pharmacie)
+
+        self.assertEqual(len(metriques), 10)
+        self.assertEqual(len(grand), len(petit))
+        self.assertEqual(metriques[0]['received_qty'], 20)
+        self.assertEqual(metriques[0]['time_in_pharm'], Decimal('17.0'))
+
+    def test_rapports_de_rotation_en_nombre_de_requetes_constant(self):
+        self.catalogue(2)
+        with CaptureQueriesContext(connection) as petit:
+            generate_report(self.pharmacie)
+            analyse_rotation_reelle(self.pharmacie)
+
+        self.catalogue(8)
+        with CaptureQueriesContext(connection) as grand:
+            rapport = generate_report(self.pharmacie)
+            rotation = analyse_rotation_reelle(self.pharmacie)
+
+        self.assertEqual(len(grand), len(petit))
+        hier = str((timezone.now() - timedelta(days=1)).date())
+        self.assertEqual({r['last_sale_date'] for r in rapport}, {hier})
+        self.assertEqual(len(rotation), 10)
+        self.assertEqual({(r['delai_rotation_jours'], r['statut']) for r in rotation}, {(-5, "✅ Actif")})
+
+    def test_periode_de_ventes_compte_exactement_period_days_jours(self):
+        produit = self.creer_produit("Doliprane")
+        self.vendre(produit, 30, il_y_a_jours=29)
+        self.vendre(produit, 12, il_y_a_jours=30)  # hors des 30 derniers jours
+
+        self.assertEqual(compute_metrics(self.pharmacie, period_days=30)[0]['avg_daily'], Decimal('1.00'))
+        self.assertEqual(generate_report(self.pharmacie, period_days=30)[0]['avg_daily'], 1.0)
+
+    def test_rapport_vectorise_identique_au_calcul_produit_par_produit(self):
+        quantites = [40, 25, 12, 7, 3, 1, 1]
+        for i, q in enumerate(quantites):
+            produit = self.creer_produit(f"Produit {i}", quantite=5 * i, alerte=4)
+            self.receptionner(produit, 30, il_y_a_jours=120)
+            self.vendre(produit, q, il_y_a_jours=i + 1)
+
+        rapport = {r['produit_id']: r for r in generate_report(self.pharmacie, rounding_unit=5)}
+
+        metriques = compute_metrics(self.pharmacie)
+        self.assertEqual(list(rapport), [m['produit_id'] for m in metriques])
+        for m in metriques:
+            r = rapport[m['produit_id']]
+            self.assertEqual(r['categorie'], m['categorie'])
+            self.assertEqual(r['contribution_vente_pct'], float(m['percent']))
+            self.assertEqual(r['avg_daily'], float(m['avg_daily']))
+            self.assertEqual(r['days_of_stock'], float(m['days_of_stock']) if m['days_of_stock'] is not None else None)
+            self.assertEqual(r['quantite_achetee'], int(m['received_qty']))
+            self.assertAlmostEqual(r['taux_rotation_pct'], float(m['sold_qty'] / m['received_qty'] * 100))
+            self.assertEqual(r['flags'], flags_for_product(m))
+            self.assertEqual(r['suggestion_commande'], recommend_order_qty(m['produit'], m['avg_daily'], rounding_unit=5))
+
+    def analyse_stock(self, **params):
+        return self.api.get(f'/api/rapport-stock/{self.pharmacie.id}/', params)
+
+    def test_analyse_stock_reservee_a_la_pharmacie_de_l_utilisateur(self):
+        autre = Pharmacie.objects.create(
+            nom_pharm="Autre", ville_pharm="Kinshasa", commune_pharm="Lemba",
+            adresse_pharm="Av. 2", ni="NI-2", telephone="0990000002"
+        )
+        self.assertEqual(self.api.get(f'/api/rapport-stock/{autre.id}/').status_code, 403)
+        self.assertEqual(APIClient().get(f'/api/rapport-stock/{self.pharmacie.id}/').status_code, 401)
+
+    def test_analyse_stock_groupee_en_cache_et_invalidee_par_une_vente(self):
+        self.catalogue(2)
+        with CaptureQueriesContext(connection) as petit:
+            self.analyse_stock(days=7)
+        self.catalogue(8)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.creer_produit("Nouveau")  # invalide le cache
+        with CaptureQueriesContext(connection) as grand:
+            premier = self.analyse_stock(days=7).json()
+        with CaptureQueriesContext(connection) as en_cache:
+            self.analyse_stock(days=7)
+
+        self.assertEqual(len(grand), len(petit))
+        self.assertEqual(premier['count'], 11)
+        self.assertFalse([q for q in en_cache.captured_queries if 'pharmacie_venteligne' in q['sql']])
+
+        produit = ProduitPharmacie.objects.get(nom_medicament="Nouveau")
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch('pharmacie.serializers.imprimer_ticket_vente'):
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 7}]}, format='json')
+
+        ligne = next(p for p in self.analyse_stock(days=7).json()['produits'] if p['produit_id'] == str(produit.id))
+        self.assertEqual(ligne['total_ventes'], 7)
+
+    def test_compteurs_du_jour_lus_en_une_requete(self):
+        doliprane = self.creer_produit("Doliprane")
+        aspirine = self.creer_produit("Aspirine")
+        self.vendre(doliprane, 2, il_y_a_jours=0)
+        self.vendre(aspirine, 1, il_y_a_jours=0)
+
+        with CaptureQueriesContext(connection) as requetes:
+            stats = self.api.get('/api/statistiques-du-jour/').json()
+        self.assertEqual(len(requetes), 1)
+        self.assertEqual((stats['chiffre_affaire'], stats['nombre_ventes'], stats['produit_plus_vendu']),
+                         (300, 2, "Doliprane"))
+
+        # Le produit le plus vendu ne change que quand un autre le dépasse
+        self.vendre(aspirine, 1, il_y_a_jours=0)
+        self.assertEqual(self.api.get('/api/statistiques-du-jour/').json()['produit_plus_vendu'], "Doliprane")
+        self.vendre(aspirine, 1, il_y_a_jours=0)
+        self.assertEqual(self.api.get('/api/statistiques-du-jour/').json()['produit_plus_vendu'], "Aspirine")
+
+        attendu = list(StatistiqueJournaliere.objects.filter(pharmacie=self.pharmacie).values())
+        StatistiqueJournaliere.reconstruire(self.pharmacie.id)
+        recalcule = list(StatistiqueJournaliere.objects.filter(pharmacie=self.pharmacie).values())
+        champs = ('jour', 'nombre_ventes', 'chiffre_affaires', 'cout', 'produit_plus_vendu_id', 'quantite_plus_vendu')
+        self.assertEqual([[s[c] for c in champs] for s in recalcule], [[s[c] for c in champs] for s in attendu])
+
+    def test_version_des_analyses_change_avec_une_depense(self):
+        version = version_analyses(self.pharmacie.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Depense.objects.create(pharmacie=self.pharmacie, categorie='transport', montant=10)
+        self.assertEqual(version_analyses(self.pharmacie.id), version + 1)
+
+    def test_analyse_stock_limitee_a_la_periode_demandee(self):
+        produit = self.creer_produit("Doliprane")
+        self.vendre(produit, 2, il_y_a_jours=3)
+        self.vendre(produit, 5, il_y_a_jours=20)
+
+        def total(days):
+            return self.analyse_stock(days=days).json()['produits'][0]['total_ventes']
+
+        self.assertEqual((total(7), total(30)), (2, 7))
+        self.assertEqual(self.analyse_stock(days=7).json()['period_days'], 7)
+
+    def test_analyse_stock_triee_et_paginee(self):
+        self.catalogue(3)
+        self.vendre(self.creer_produit("Best-seller"), 50, il_y_a_jours=2)
+
+        data = self.analyse_stock(ordering='nom', page=2, page_size=2).json()
+
+        self.assertEqual((data['count'], data['page'], data['num_pages']), (4, 2, 2))
+        self.assertEqual([p['nom'] for p in data['produits']],
+                         ["Produit 3-1 - Pharmacie Test", "Produit 3-2 - Pharmacie Test"])
+        self.assertEqual(self.analyse_stock(ordering='-total_ventes').json()['produits'][0]['total_ventes'], 50)
+        self.assertEqual(self.analyse_stock(ordering='mot_de_passe').status_code, 400)
+
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class VenteJournaliereTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.a = self.creer_produit("Aspirine", quantite=50)
+        self.b = self.creer_produit("Bétadine", quantite=50)
+
+    def faits(self):
+        return {
+            (f.produit_id, f.jour): (f.quantite, f.chiffre_affaires, f.cout, f.nombre_ventes)
+            for f in VenteJournaliere.objects.all()
+        }
+
+    def test_ventes_cumulees_par_produit_et_par_jour(self, _imprimer):
+        for lignes in ([(self.a, 2), (self.a, 1), (self.b, 4)], [(self.a, 5)]):
+            self.api.post('/api/ventes/', {
+                'lignes': [{'produit': str(p.id), 'quantite': q} for p, q in lignes]
+            }, format='json')
+
+        jour = timezone.localdate()
+        self.assertEqual(self.faits(), {
+            (self.a.id, jour): (8, 8 * self.a.prix_vente, 8 * self.a.prix_achat, 2),
+            (self.b.id, jour): (4, 4 * self.b.prix_vente, 4 * self.b.prix_achat, 1),
+        })
+
+        attendu = self.faits()
+        call_command('reconstruire_ventes_journalieres', stdout=StringIO())
+        self.assertEqual(self.faits(), attendu)
+
+
+import numpy as np
+from .models import PrevisionDemande
+from .utils import forecast_daily_demand, compute_forecasts, generate_report, suggestion_prevision, _quantize
+
+
+class PrevisionDemandeTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+
+    def vendre(self, produit, quantite, il_y_a_jours):
+        vente = VenteProduit.objects.create(pharmacie=self.pharmacie, utilisateur=self.user)
+        ligne = VenteLigne.objects.create(vente=vente, produit=produit, quantite=quantite, prix_unitaire=100)
+        vente.date_vente = timezone.now() - timedelta(days=il_y_a_jours)
+        VenteProduit.objects.filter(pk=vente.pk).update(date_vente=vente.date_vente)
+        VenteJournaliere.enregistrer_vente(vente, [ligne])
+
+    def test_methode_choisie_selon_la_regularite_des_ventes(self):
+        reguliere = np.full(60, 4.0)
+        intermittente = np.zeros(60)
+        intermittente[::10] = 20.0
+
+        prevision, croston = forecast_daily_demand(np.vstack([reguliere, intermittente]))
+
+        self.assertEqual(list(croston), [False, True])
+        self.assertAlmostEqual(prevision[0], 4.0)
+        # Croston SBA : 20 unités tous les 10 jours, corrigé de (1 - α/2)
+        self.assertAlmostEqual(prevision[1], 0.95 * 20 / 10, places=1)
+
+    def test_suggestions_enregistrees_et_servies_par_l_api(self):
+        produit = self.creer_produit("Doliprane", quantite=10)
+        bien_stocke = self.creer_produit("Amoxicilline", quantite=1000)
+        for jour in range(30):
+            self.vendre(produit, 2, il_y_a_jours=jour)
+            self.vendre(bien_stocke, 1, il_y_a_jours=jour)
+
+        self.assertEqual(compute_forecasts(self.pharmacie), 2)
+
+        prevision = PrevisionDemande.objects.get(produit=produit)
+        self.assertEqual(prevision.methode, 'croston')  # 30 jours de vente sur 180
+        attendu = recommend_order_qty(produit, _quantize(prevision.demande_prevue))
+        self.assertGreater(attendu, 0)
+        self.assertEqual(suggestion_prevision(PrevisionDemande.objects.get(produit=bien_stocke)), 0)
+        rapport = {r['produit_id']: r for r in generate_report(self.pharmacie)}
+        self.assertEqual(rapport[str(produit.id)]['suggestion_commande'], attendu)
+
+        # La suggestion suit le stock actuel, sans nouveau calcul des prévisions
+        with self.captureOnCommitCallbacks(execute=True):
+            produit.quantite = 10 + attendu
+            produit.save()
+        rapport = {r['produit_id']: r for r in generate_report(self.pharmacie)}
+        self.assertEqual(rapport[str(produit.id)]['suggestion_commande'], 0)
+        self.assertEqual(self.api.get('/api/previsions/suggestions/').json(), [])
+        produit.quantite = 10
+        produit.save()
+
+        # Un nouveau calcul remplace les prévisions précédentes
+        compute_forecasts(self.pharmacie, history_days=30)
+        self.assertEqual(PrevisionDemande.objects.filter(pharmacie=self.pharmacie).count(), 2)
+        self.assertEqual(PrevisionDemande.objects.get(produit=produit).methode, 'lissage')
+
+        reponse = self.api.get('/api/previsions/suggestions/')
+        self.assertEqual(reponse.status_code, 200)
+        self.assertEqual([p['produit_id'] for p in reponse.json()], [str(produit.id)])
+
+
+from .models import TauxChange
+from .utils import generer_propositions_commande
+
+
+class PropositionsCommandeTest(VenteBaseMixin, TestCase):
+    vendre = AnalyseStockTest.vendre
+
+    def setUp(self):
+        self.creer_pharmacie()
+
+    def test_brouillons_par_fabricant_en_une_insertion(self):
+        TauxChange.objects.create(taux=2800)
+        premier = self.creer_produit("Doliprane", quantite=0)
+        ProduitFabricant.objects.filter(pk=premier.produit_fabricant_id).update(
+            nombre_plaquettes_par_boite=10, devise='USD', prix_achat=2
+        )
+        self.fabricant = Fabricant.objects.create(nom="Autre fabricant", pays_origine="Inde")
+        second = self.creer_produit("Amoxicilline", quantite=0)
+        for jour in range(30):
+            self.vendre(premier, 2, il_y_a_jours=jour)
+            self.vendre(second, 1, il_y_a_jours=jour)
+
+        with CaptureQueriesContext(connection) as requetes:
+            commandes = generer_propositions_commande(self.pharmacie)
+        insertions = [q for q in requetes if q['sql'].startswith('INSERT') and 'commandeproduitligne' in q['sql']]
+        self.assertEqual(len(insertions), 1)
+        self.assertEqual(len(commandes), 2)
+
+        ligne = CommandeProduitLigne.objects.get(produit_fabricant=premier.produit_fabricant)
+        self.assertEqual(ligne.commande.etat, 'brouillon')
+        self.assertEqual(ligne.quantite_commandee, 6)  # 60 plaquettes, boîtes de 10
+        self.assertEqual(ligne.prix_achat, Decimal('5600.00'))
+
+        # Relancer remplace les brouillons au lieu de les empiler
+        reponse = self.api.post('/api/commandes/propositions/')
+        self.assertEqual(reponse.status_code, 201)
+        self.assertEqual(CommandeProduit.objects.filter(pharmacie=self.pharmacie, etat='brouillon').count(), 2)
+
+    def test_brouillons_manuels_conserves_et_hors_reception(self):
+        produit = self.creer_produit("Doliprane", quantite=0)
+        for jour in range(30):
+            self.vendre(produit, 2, il_y_a_jours=jour)
+        manuel = CommandeProduit.objects.create(pharmacie=self.pharmacie, fabricant=self.fabricant, etat='brouillon')
+        repris = generer_propositions_commande(self.pharmacie)[0]
+        self.assertEqual(self.api.patch(f'/api/commandes-produits/{repris.id}/', {'etat': 'brouillon'}).status_code, 200)
+
+        nouveaux = generer_propositions_commande(self.pharmacie)
+
+        brouillons = set(CommandeProduit.objects.filter(etat='brouillon').values_list('pk', flat=True))
+        self.assertEqual(brouillons, {manuel.pk, repris.pk, nouveaux[0].pk})
+
+        # Un brouillon n'est ni réceptionnable ni dans l'historique des mouvements
+        ligne = repris.lignes.get()
+        reponse = self.api.post('/api/reception/confirm/', {
+            'commande': str(repris.pk), 'lignes': [{'ligne_commande': str(ligne.pk), 'quantite_recue': 1}],
+        }, format='json')
+        self.assertEqual(reponse.status_code, 400)
+        self.assertFalse(ReceptionProduit.objects.exists())
+        self.assertEqual(self.api.get('/api/historique-mouvements/').json(), [])
+
+
+import csv
+import json
+from django.http import StreamingHttpResponse
+
+
+class ExportTest(VenteBaseMixin, TestCase):
+    vendre = AnalyseStockTest.vendre
+
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Bétadine")
+        self.vendre(self.produit, 2, il_y_a_jours=40)
+        self.vendre(self.produit, 3, il_y_a_jours=1)
+
+    def contenu(self, reponse):
+        self.assertIsInstance(reponse, StreamingHttpResponse)
+        return b''.join(reponse.streaming_content).decode('utf-8-sig')
+
+    def test_export_ventes_csv_filtre_par_date(self):
+        depuis = (date.today() - timedelta(days=7)).isoformat()
+        reponse = self.api.get('/api/export/ventes/', {'type': 'csv', 'date_debut': depuis})
+
+        self.assertEqual(reponse['Content-Type'], 'text/csv; charset=utf-8')
+        with CaptureQueriesContext(connection) as requetes:
+            lignes = list(csv.DictReader(self.contenu(reponse).splitlines()))
+        # Bornes en datetimes sur date_vente (indexable), sans conversion en date
+        self.assertNotIn('cast_date', requetes[0]['sql'])
+        self.assertEqual(len(lignes), 1)
+        self.assertEqual((lignes[0]['produit'], lignes[0]['quantite'], lignes[0]['utilisateur']),
+                         ("Bétadine", "3", "caissier"))
+
+    def test_export_ventes_ndjson_et_rapport_stock(self):
+        lignes = [json.loads(l) for l in self.contenu(self.api.get('/api/export/ventes/', {'type': 'ndjson'})).splitlines()]
+        self.assertEqual([l['quantite'] for l in lignes], [2, 3])
+
+        rapport = self.contenu(self.api.get('/api/export/rapport-stock/', {'type': 'ndjson', 'days': 7}))
+        self.assertEqual(json.loads(rapport)['quantite_vendue'], 3)
+
+    def test_export_parametres_invalides(self):
+        self.assertEqual(self.api.get('/api/export/ventes/', {'type': 'xlsx'}).status_code, 400)
+        self.assertEqual(self.api.get('/api/export/ventes/', {'date_fin': '2025-02-30'}).status_code, 400)
+        self.assertEqual(APIClient().get('/api/export/ventes/').status_code, 401)
+
+
+from .models import ValorisationStock
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class ValorisationStockTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+
+    def valeurs(self):
+        return {
+            (v.categorie, v.localisation): (v.quantite, v.valeur_vente, v.valeur_achat)
+            for v in ValorisationStock.objects.filter(pharmacie=self.pharmacie)
+        }
+
+    def test_valorisation_tenue_a_jour_et_egale_au_recalcul(self, _imprimer):
+        doliprane = self.creer_produit("Doliprane", quantite=10, prix_achat=100)
+        aspirine = self.creer_produit("Aspirine", quantite=5, prix_achat=100)
+        aspirine.categorie = "antalgique"
+        aspirine.save()  # changement de catégorie : la valeur suit le produit
+
+        self.api.post('/api/ventes/', {'lignes': [{'produit': str(doliprane.id), 'quantite': 4}]}, format='json')
+
+        doliprane.refresh_from_db()
+        doliprane.marge_beneficiaire = 50
+        doliprane.save()
+        self.creer_produit("Retiré", quantite=3).delete()
+
+        tenue = self.valeurs()
+        ValorisationStock.reconstruire(self.pharmacie.id)
+        self.assertEqual(
+            {g: v for g, v in tenue.items() if any(v)},
+            {g: v for g, v in self.valeurs().items() if any(v)},
+        )
+        self.assertEqual(tenue[("generique", "A0")][0], 6)
+
+        with CaptureQueriesContext(connection) as requetes:
+            data = self.api.get('/api/stock-total/', {'par': 'categorie'}).json()
+        self.assertEqual(len(requetes), 2)
+        self.assertEqual(data['montant_stock'], 6 * 150 + 5 * 120)
+        self.assertEqual([c['categorie'] for c in data['par_categorie']], ["generique", "antalgique"])
+
+        sortie = StringIO()
+        call_command('reconcilier_valorisation_stock', pharmacie=str(self.pharmacie.id), stdout=sortie)
+        self.assertIn("écart 0", sortie.getvalue())
+
+    def test_valorisation_ajustee_en_fin_de_vente(self, _imprimer):
+        produit = self.creer_produit("Aspirine", quantite=10, lots=(10,))
+        with CaptureQueriesContext(connection) as requetes:
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 1}]}, format='json')
+
+        # Après le verrou de la ligne de valorisation, plus que les autres lignes partagées
+        sql = [q['sql'] for q in requetes.captured_queries]
+        premier = next(i for i, q in enumerate(sql) if 'pharmacie_valorisationstock' in q)
+        partagees = (
+            'pharmacie_valorisationstock', 'pharmacie_statistiquejournaliere', 'pharmacie_venteutilisateurjournaliere'
+        )
+        ecritures = [q for q in sql[premier:] if q.startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertTrue(all(any(t in q for t in partagees) for q in ecritures), ecritures)
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class HistoriqueVentesPaginationTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produits = [self.creer_produit(f"Produit {i}", quantite=100) for i in range(4)]
+        client = Client.objects.create(pharmacie=self.pharmacie, nom_complet="Client Fidèle", telephone="0990000001")
+        for i in range(7):
+            lignes = [{'produit': str(p.id), 'quantite': 1} for p in self.produits[:1 + i % 4]]
+            self.api.post('/api/ventes/', {'client': str(client.id), 'lignes': lignes}, format='json')
+
+    def test_pages_par_curseur_en_nombre_de_requetes_constant(self, _imprimer):
+        with CaptureQueriesContext(connection) as premiere:
+            page = self.api.get('/api/historique-ventes/', {'page_size': 3}).json()
+        ventes = page['results']
+
+        with CaptureQueriesContext(connection) as suivante:
+            page = self.api.get(page['next']).json()
+        ventes += page['results']
+        ventes += self.api.get(page['next']).json()['results']
+
+        self.assertEqual(len(premiere), len(suivante))
+        self.assertEqual(len({v['id'] for v in ventes}), 7)
+        self.assertEqual([v['date_vente'] for v in ventes], sorted((v['date_vente'] for v in ventes), reverse=True))
+        self.assertEqual(ventes[0]['client'], "Client Fidèle")
+        self.assertEqual(ventes[0]['utilisateur'], "caissier")
+
+
+from .models import VenteUtilisateurJournaliere
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class HistoriqueCaissierTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        produit = self.creer_produit("Doliprane", quantite=100)
+        for _ in range(5):
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 2}]}, format='json')
+        # Vente ancienne, hors de la période par défaut
+        ancienne = VenteProduit.objects.create(pharmacie=self.pharmacie, utilisateur=self.user, montant_total=1000)
+        VenteProduit.objects.filter(pk=ancienne.pk).update(date_vente=timezone.now() - timedelta(days=90))
+        VenteUtilisateurJournaliere.reconstruire(self.pharmacie.id)
+
+    def historique(self, **params):
+        return self.api.get('/api/historique-ventes/caissier/', {'utilisateur': self.user.id, **params})
+
+    def test_historique_borne_et_pagine(self, _imprimer):
+        with CaptureQueriesContext(connection) as requetes:
+            data = self.historique(page_size=2).json()
+        self.assertFalse([q for q in requetes.captured_queries if 'cast_date' in q['sql']])
+
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(len(data['details']), 2)
+        self.assertIsNotNone(data['next'])
+        self.assertEqual([(j['nb'], j['total']) for j in data['par_jour']], [(5, 1200)])
+        self.assertEqual(sum(m['nb'] for m in data['par_mois']), 5)
+
+        depuis = (date.today() - timedelta(days=120)).isoformat()
+        self.assertEqual(self.historique(date_debut=depuis).json()['count'], 6)
+
+    def test_cumuls_du_caissier_tenus_a_jour_par_la_vente(self, _imprimer):
+        attendu = list(VenteUtilisateurJournaliere.objects.order_by('jour').values_list('jour', 'nombre_ventes', 'total'))
+        VenteUtilisateurJournaliere.objects.all().delete()
+        produit = ProduitPharmacie.objects.get(nom_medicament="Doliprane")
+        for _ in range(5):
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 2}]}, format='json')
+
+        self.assertEqual(
+            list(VenteUtilisateurJournaliere.objects.values_list('jour', 'nombre_ventes', 'total')), attendu[-1:]
+        )
+
+    def test_compteurs_partages_mis_a_jour_en_dernier(self, _imprimer):
+        produit = self.creer_produit("Aspirine", quantite=10, lots=(10,))
+        with CaptureQueriesContext(connection) as requetes:
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 1}]}, format='json')
+
+        sql = [q['sql'] for q in requetes.captured_queries]
+        premier = next(i for i, q in enumerate(sql) if 'pharmacie_statistiquejournaliere' in q)
+        compteurs = ('pharmacie_statistiquejournaliere', 'pharmacie_venteutilisateurjournaliere')
+        ecritures = [q for q in sql[premier:] if q.startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertTrue(ecritures)
+        self.assertTrue(all(any(t in q for t in compteurs) for q in ecritures), ecritures)
+
+    def test_cumuls_separes_quand_le_caissier_change_de_pharmacie(self, _imprimer):
+        avant = VenteUtilisateurJournaliere.objects.get(pharmacie=self.pharmacie, jour=timezone.localdate())
+        autre = Pharmacie.objects.create(
+            nom_pharm="Autre", ville_pharm="Kinshasa", commune_pharm="Gombe",
+            adresse_pharm="Av. 2", ni="NI-2", telephone="0990000002"
+        )
+        self.user.pharmacie = autre
+        self.user.save()
+        self.pharmacie = autre
+        produit = self.creer_produit("Aspirine", quantite=10)
+        self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 1}]}, format='json')
+
+        self.assertEqual(
+            VenteUtilisateurJournaliere.objects.get(pk=avant.pk).nombre_ventes, avant.nombre_ventes
+        )
+        self.assertEqual(VenteUtilisateurJournaliere.objects.get(pharmacie=autre).nombre_ventes, 1)
+
+    def test_historique_reserve_aux_utilisateurs_connectes(self, _imprimer):
+        self.assertEqual(APIClient().get('/api/historique-ventes/caissier/', {'utilisateur': self.user.id}).status_code, 401)
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class RapportGeneralPeriodeTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        produit = self.creer_produit("Doliprane", quantite=100)
+        for _ in range(3):
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(produit.id), 'quantite': 2}]}, format='json')
+        # Une vente antérieure de 40 jours, puis les tables du jour recalculées
+        VenteProduit.objects.filter(pk=VenteProduit.objects.first().pk).update(
+            date_vente=timezone.now() - timedelta(days=40)
+        )
+        VenteJournaliere.reconstruire(self.pharmacie.id)
+        StatistiqueJournaliere.reconstruire(self.pharmacie.id)
+
+    def rapport(self, **params):
+        return self.api.get('/api/rapport-general/', params)
+
+    def test_periode_libre_par_jour_et_par_mois(self, _imprimer):
+        depuis = (timezone.localdate() - timedelta(days=60)).isoformat()
+
+        par_jour = self.rapport(date_debut=depuis, granularite='jour').json()
+        self.assertEqual(par_jour['periode'], 'personnalisee')
+        self.assertEqual([p['nombre_ventes'] for p in par_jour['serie']], [1, 2])
+        self.assertEqual(par_jour['nombre_ventes'], 3)
+        self.assertEqual(par_jour['total_ventes'], 720)
+        self.assertEqual(par_jour['produit_plus_vendu'], "Doliprane")
+
+        par_mois = self.rapport(date_debut=depuis, granularite='mois').json()
+        self.assertEqual(sum(p['total_ventes'] for p in par_mois['serie']), 720)
+
+    def test_serie_horaire_du_jour(self, _imprimer):
+        from .views import calculer_rapport_general
+        with self.assertNumQueries(2) as requetes:
+            resultat = calculer_rapport_general(self.pharmacie, timezone.localdate(), timezone.localdate(), 'heure')
+        # Une jointure groupée, pas de sous-requête par vente
+        self.assertEqual(requetes.captured_queries[0]['sql'].count('SELECT'), 1)
+        self.assertEqual(resultat['nombre_ventes'], 2)
+        self.assertEqual(resultat['chiffre_affaire'], 480)
+        self.assertEqual(resultat['total_ventes'], 480)
+        self.assertEqual(self.rapport().json()['granularite'], 'heure')
+
+    def test_benefice_garde_le_prix_achat_de_la_vente(self, _imprimer):
+        from .views import calculer_rapport_general
+        # Une hausse du prix d'achat après coup ne doit changer ni l'une ni l'autre série
+        ProduitPharmacie.objects.filter(pharmacie=self.pharmacie).update(prix_achat=200)
+        VenteJournaliere.reconstruire(self.pharmacie.id)
+        StatistiqueJournaliere.reconstruire(self.pharmacie.id)
+
+        aujourd_hui = timezone.localdate()
+        par_heure = calculer_rapport_general(self.pharmacie, aujourd_hui, aujourd_hui, 'heure')
+        par_jour = calculer_rapport_general(self.pharmacie, aujourd_hui, aujourd_hui, 'jour')
+        self.assertEqual(par_heure['benefice'], 80)
+        self.assertEqual(par_jour['benefice'], par_heure['benefice'])
+
+    def test_parametres_invalides(self, _imprimer):
+        depuis = (timezone.localdate() - timedelta(days=60)).isoformat()
+        self.assertEqual(self.rapport(date_debut=depuis, granularite='heure').status_code, 400)
+        self.assertEqual(self.rapport(date_debut='2025-02-30').status_code, 400)
+        self.assertEqual(self.rapport(date_debut='2025-03-01', date_fin='2025-02-01').status_code, 400)
+        self.assertEqual(self.rapport(granularite='annee').status_code, 400)
+
+
+from rest_framework_simplejwt.tokens import RefreshToken
+from .utils import bus_evenements, ouvrir_flux_sse, FluxEvenementsSSE
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class FluxEvenementsTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Doliprane", quantite=5, alerte=3)
+
+    def ouvrir_flux(self, **params):
+        return self.client.get('/api/evenements/', params)
+
+    def test_vente_publiee_apres_commit(self, _imprimer):
+        file = bus_evenements.abonner(self.pharmacie.id)
+        self.addCleanup(bus_evenements.desabonner, self.pharmacie.id, file)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api.post('/api/ventes/', {'lignes': [{'produit': str(self.produit.id), 'quantite': 2}]}, format='json')
+
+        evenements = {type_evenement: donnees for _, type_evenement, donnees in list(file.queue)}
+        self.assertEqual(evenements['vente']['caissier'], "caissier")
+        self.assertEqual(evenements['stock']['produits'], [{'id': str(self.produit.id), 'quantite': 3, 'en_alerte': True}])
+        self.assertEqual(evenements['alerte']['produits'][0]['nom_medicament'], "Doliprane")
+
+    def test_flux_sse_avec_jeton_en_parametre(self, _imprimer):
+        reponse = self.ouvrir_flux(token=str(RefreshToken.for_user(self.user).access_token))
+        self.assertEqual(reponse['Content-Type'], 'text/event-stream')
+        flux = iter(reponse.streaming_content)
+
+        self.assertEqual(next(flux), b"retry: 3000\n\n")
+        self.assertEqual(bus_evenements.nombre_abonnes(self.pharmacie.id), 1)
+        bus_evenements.publier(self.pharmacie.id, 'reception', {'id': 'r1'})
+        self.assertRegex(next(flux).decode(), r'^id: \d+\nevent: reception\ndata: \{"id":"r1"\}\n\n$')
+
+        with mock.patch('pharmacie.utils.BATTEMENT_SSE', 0.01):
+            self.assertEqual(next(flux), b": ping\n\n")
+
+        # Durée maximale atteinte : fin du flux (le navigateur se reconnecte) et désabonnement
+        with mock.patch('pharmacie.utils.DUREE_MAX_SSE', 0):
+            self.assertEqual(list(flux), [])
+        self.assertEqual(bus_evenements.nombre_abonnes(self.pharmacie.id), 0)
+
+    def test_flux_refuse_au_dela_du_plafond(self, _imprimer):
+        jeton = str(RefreshToken.for_user(self.user).access_token)
+        with mock.patch('pharmacie.utils.MAX_ABONNES_SSE', 1):
+            reponse = self.ouvrir_flux(token=jeton)
+            self.assertEqual(reponse.status_code, 200)
+
+            sature = self.ouvrir_flux(token=jeton)
+            self.assertEqual(sature.status_code, 503)
+            self.assertEqual(sature['Retry-After'], '30')
+            self.assertEqual(sature.content, b"retry: 30000\n\n")
+
+        with mock.patch('pharmacie.utils.DUREE_MAX_SSE', 0):
+            list(reponse.streaming_content)
+        self.assertEqual(bus_evenements.nombre_abonnes(self.pharmacie.id), 0)
+
+        # Réponse fermée sans avoir été lue : l'abonnement est quand même retiré
+        flux = ouvrir_flux_sse(self.pharmacie.id)
+        self.assertIsInstance(flux, FluxEvenementsSSE)
+        flux.close()
+        self.assertEqual(bus_evenements.nombre_abonnes(self.pharmacie.id), 0)
+
+    def test_stock_publie_seulement_si_la_quantite_change(self, _imprimer):
+        file = bus_evenements.abonner(self.pharmacie.id)
+        self.addCleanup(bus_evenements.desabonner, self.pharmacie.id, file)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produit.prix_vente = 150
+            self.produit.save()
+        self.assertTrue(file.empty())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produit.quantite = 8
+            self.produit.save()
+        self.assertEqual([e[1] for e in list(file.queue)], ['stock'])
+
+    def test_flux_refuse_sans_jeton_valide(self, _imprimer):
+        self.assertEqual(self.ouvrir_flux().status_code, 401)
+        self.assertEqual(self.ouvrir_flux(token="invalide").status_code, 401)
+
+    def test_abonne_lent_garde_les_derniers_evenements(self, _imprimer):
+        file = bus_evenements.abonner(self.pharmacie.id)
+        self.addCleanup(bus_evenements.desabonner, self.pharmacie.id, file)
+        for i in range(bus_evenements.TAILLE_FILE + 5):
+            bus_evenements.publier(self.pharmacie.id, 'vente', {'n': i})
+
+        self.assertEqual(file.qsize(), bus_evenements.TAILLE_FILE)
+        self.assertEqual(file.queue[0][2], {'n': 5})
+
+
+# Script de synchronisation local ↔ distant (importé comme module, sans lancer run())
+from hopitalsage_front import sync_remote_to_local as synchro
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class SynchronisationTest(VenteBaseMixin, TestCase):
+    DIRECTION = "default→remote"
+
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Ibuprofene", quantite=10)
+
+    def a_synchroniser(self, model):
+        return synchro.get_sync_queryset("default", model, self.DIRECTION, self.pharmacie)
+
+    def test_vente_hors_ligne_antidatee_reprise_par_la_synchro(self, _imprimer):
+        derniere_synchro = timezone.now()
+        vente = {
+            'cle_idempotence': "caisse1-8", 'date_vente': (derniere_synchro - timedelta(hours=2)).isoformat(),
+            'lignes': [{'produit': str(self.produit.id), 'quantite': 1}],
+        }
+        filigranes = {f"{m}_{self.DIRECTION}": derniere_synchro.isoformat() for m in ("VenteProduit", "VenteLigne")}
+
+        with mock.patch.dict(synchro.SYNC_TIMES, filigranes):
+            self.api.post('/api/ventes/lot/', {'ventes': [vente]}, format='json')
+
+            ventes = self.a_synchroniser(VenteProduit)
+            self.assertEqual(list(ventes.values_list('cle_idempotence', flat=True)), ["caisse1-8"])
+            self.assertLess(ventes.get().date_vente, derniere_synchro)
+            self.assertEqual(self.a_synchroniser(VenteLigne).count(), 1)
+
+    def test_agregats_recalcules_apres_la_synchro(self, _imprimer):
+        # Ce que la synchro écrit : bulk_create / bulk_update, sans serializer ni signaux
+        def copier(source_db, target_db, model, pharmacie=None):
+            if model is VenteProduit:
+                vente = VenteProduit(pharmacie=self.pharmacie, utilisateur=self.user, montant_total=240)
+                VenteProduit.objects.bulk_create([vente])
+                VenteLigne.objects.bulk_create([VenteLigne(
+                    vente=vente, produit=self.produit, quantite=2, prix_unitaire=120, total=240, prix_achat_unitaire=100
+                )])
+                return 1
+            if model is ProduitPharmacie:
+                self.produit.quantite = 8
+                ProduitPharmacie.objects.bulk_update([self.produit], ['quantite'])
+                return 1
+            return 0
+
+        with mock.patch.object(synchro, 'sync_model', side_effect=copier):
+            synchro.sync_pharmacie("remote", "default", self.pharmacie)
+
+        jour = timezone.localdate()
+        stat = StatistiqueJournaliere.objects.get(pharmacie=self.pharmacie, jour=jour)
+        self.assertEqual((stat.nombre_ventes, stat.total_ventes, stat.cout), (1, 240, 200))
+        self.assertEqual(VenteJournaliere.objects.get(produit=self.produit, jour=jour).quantite, 2)
+        self.assertEqual(VenteUtilisateurJournaliere.objects.get(utilisateur=self.user, jour=jour).total, 240)
+        self.assertEqual(ValorisationStock.objects.get(pharmacie=self.pharmacie).quantite, 8)
+
+
+import threading
+from unittest import SkipTest
+from django.test import TransactionTestCase
+
+
+@mock.patch('pharmacie.serializers.imprimer_ticket_vente')
+class VenteConcurrenteTest(VenteBaseMixin, TransactionTestCase):
+    NB_CAISSES = 8
+    VENTES_PAR_CAISSE = 5
+    STOCK_INITIAL = 20
+
+    @classmethod
+    def setUpClass(cls):
+        # Décidé sur la base de test (créée après l'import de ce module), pas sur celle de dev
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise SkipTest("Les threads ont besoin d'une base partagée (PostgreSQL ou SQLite sur fichier)")
+        super().setUpClass()
+
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Ibuprofene", quantite=self.STOCK_INITIAL, lots=(self.STOCK_INITIAL,))
+
+    def test_decrementer_stock_signale_les_echecs(self, _imprimer):
+        autre = self.creer_produit("Vitamine C", quantite=1)
+
+        echecs = ProduitPharmacie.decrementer_stock({self.produit.pk: 5, autre.pk: 2})
+
+        self.assertEqual(echecs, [autre.pk])
+        self.produit.refresh_from_db()
+        autre.refresh_from_db()
+        self.assertEqual((self.produit.quantite, autre.quantite), (self.STOCK_INITIAL - 5, 1))
+
+    def test_caisses_concurrentes_ne_survendent_pas(self, _imprimer):
+        statuts = []
+        depart = threading.Barrier(self.NB_CAISSES)
+
+        def caisse():
+            api = APIClient()
+            api.force_authenticate(self.user)
+            depart.wait()
+            try:
+                for _ in range(self.VENTES_PAR_CAISSE):
+                    response = api.post('/api/ventes/', {
+                        'lignes': [{'produit': str(self.produit.id), 'quantite': 1}]
+                    }, format='json')
+                    statuts.append(response.status_code)
+            finally:
+                connection.close()
+
+        caisses = [threading.Thread(target=caisse) for _ in range(self.NB_CAISSES)]
+        for t in caisses:
+            t.start()
+        for t in caisses:
+            t.join()
+
+        self.produit.refresh_from_db()
+        vendus = sum(VenteLigne.objects.filter(produit=self.produit).values_list('quantite', flat=True))
+        self.assertEqual(statuts.count(201), self.STOCK_INITIAL)
+        self.assertEqual(statuts.count(400), self.NB_CAISSES * self.VENTES_PAR_CAISSE - self.STOCK_INITIAL)
+        self.assertEqual(self.produit.quantite, 0)
+        self.assertEqual(vendus, self.STOCK_INITIAL)
+        self.assertEqual(self.produit.lots.get().quantite, 0)
+
+
+############################ Spouleur d'impression ############################
+from escpos.printer import Dummy
+from pharmacie import utils
+from .utils import SpouleurImpression, _rendre_octets, _rendre_bon_commande
+
+
+class ImprimanteEnPanne(Dummy):
+    pannes = 1
+
+    def _raw(self, msg):
+        if ImprimanteEnPanne.pannes:
+            ImprimanteEnPanne.pannes -= 1
+            raise OSError("Imprimante déconnectée")
+        super()._raw(msg)
+
+
+class SpouleurImpressionTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Doliprane", quantite=10)
+
+    def test_vente_mise_en_file_apres_commit_et_imprimee(self):
+        spouleur = SpouleurImpression(ouvrir=Dummy)
+
+        with mock.patch('pharmacie.utils.spouleur_impression', spouleur):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                response = self.api.post('/api/ventes/', {
+                    'lignes': [{'produit': str(self.produit.id), 'quantite': 2}]
+                }, format='json')
+                self.assertEqual(response.status_code, 201)
+            # Rien n'est imprimé tant que la vente n'est pas validée
+            self.assertEqual(spouleur.statut()['travaux'], [])
+
+            for callback in callbacks:
+                callback()
+            spouleur.attendre()
+
+        travail = spouleur.statut()['travaux'][0]
+        self.assertEqual((travail['type'], travail['statut']), ('vente', 'imprime'))
+        self.assertIn(b"FACTURE", spouleur.imprimante.output)
+        self.assertIn(b"Doliprane", spouleur.imprimante.output)
+
+    def test_travail_reessaye_apres_panne(self):
+        spouleur = SpouleurImpression(ouvrir=ImprimanteEnPanne)
+        spouleur.DELAI_ENTRE_TENTATIVES = 0
+
+        spouleur.soumettre('commande', _rendre_octets(_rendre_bon_commande, {
+            'pharmacie': self.pharmacie.nom_pharm, 'fabricant': self.fabricant.nom,
+            'date_commande': '01/01/2025 10:00',
+            'lignes': [{'nom': 'Doliprane', 'quantite_commandee': 4}],
+        }))
+        spouleur.attendre()
+
+        travail = spouleur.statut()['travaux'][0]
+        self.assertEqual((travail['statut'], travail['tentatives']), ('imprime', 2))
+        self.assertIn(b"BON DE COMMANDE", spouleur.imprimante.output)
+
+    def test_ticket_conserve_et_reimprime(self):
+        spouleur = SpouleurImpression(ouvrir=Dummy)
+
+        with mock.patch('pharmacie.utils.spouleur_impression', spouleur):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.api.post('/api/ventes/', {
+                    'lignes': [{'produit': str(self.produit.id), 'quantite': 1}]
+                }, format='json')
+            vente = VenteProduit.objects.get()
+            ticket = bytes(vente.ticket_escpos)
+
+            response = self.api.post(f'/api/ventes/{vente.id}/reimprimer/')
+            self.assertEqual(response.status_code, 202)
+            spouleur.attendre()
+
+        self.assertIn(b"Doliprane", ticket)
+        # Le ticket réimprimé est exactement celui de la vente
+        self.assertEqual(spouleur.imprimante.output, ticket * 2)
+
+    def test_erreur_impression_ne_fait_pas_echouer_la_vente(self):
+        with mock.patch('pharmacie.utils.rendre_ticket_vente', side_effect=RuntimeError("gabarit invalide")):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.api.post('/api/ventes/', {
+                    'lignes': [{'produit': str(self.produit.id), 'quantite': 1}]
+                }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(VenteProduit.objects.get().ticket_escpos)
+
+
+class GabaritTicketTest(VenteBaseMixin, TestCase):
+    def setUp(self):
+        self.creer_pharmacie()
+        self.produit = self.creer_produit("Doliprane", quantite=10)
+        utils._cache_gabarits.clear()
+
+    def donnees(self):
+        vente = VenteProduit.objects.create(pharmacie=self.pharmacie, utilisateur=self.user)
+        ligne = VenteLigne(vente=vente, produit=self.produit, quantite=1, prix_unitaire=self.produit.prix_vente)
+        return utils.donnees_ticket_vente(vente, [ligne])
+
+    def test_entete_rendu_une_fois_par_version_de_pharmacie(self):
+        with mock.patch('pharmacie.utils._entete_vente', wraps=utils._entete_vente) as entete:
+            utils.rendre_ticket_vente(self.donnees())
+            utils.rendre_ticket_vente(self.donnees())
+            self.assertEqual(entete.call_count, 1)
+
+            self.pharmacie.telephone = "0999000000"
+            self.pharmacie.save()
+            octets = utils.rendre_ticket_vente(self.donnees())
+            self.assertEqual(entete.call_count, 2)
+
+        self.assertIn(b"0999000000", octets)
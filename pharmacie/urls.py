@@ -8,6 +8,7 @@ from .views import (
     ProduitPharmacieListAPIView,
     PharmacieUserListAPIView,
     VenteCreateAPIView,    
+    VenteLotAPIView,
     produits_par_fabricant,
     ClientViewSet,
     MedicalExamViewSet,
@@ -52,7 +53,17 @@ liste_rapports,
 generer_rapport,
 imprimer_proformat,
 ImprimerCommandeAPIView,
-ApprovisionnementRapideView
+ApprovisionnementRapideView,
+statut_impression,
+reimprimer_vente,
+produit_par_code_barre,
+recherche_produits,
+suggestions_commande,
+propositions_commande,
+export_historique_ventes,
+export_rapport_stock,
+historique_ventes,
+flux_evenements
 
 
 
@@ -77,6 +88,8 @@ router.register(r'depenses', DepenseViewSet, basename='depense')
 
 
 urlpatterns = [
+    # Avant le routeur : sinon 'recherche' serait pris pour un id de produits-pharmacie
+    path('api/produits-pharmacie/recherche/', recherche_produits, name='recherche-produits'),
     path('api/', include(router.urls)),
     path('api/requisitions/reset/', reset_requisitions),
     path('api/stock-total/', stock_total),
@@ -104,14 +117,19 @@ urlpatterns = [
     path('api/requisitions/<uuid:pk>/incrementer/', incrementer_demande),
     # Création d'une vente
     path('api/ventes/', VenteCreateAPIView.as_view(), name='vente-create'),
+    path('api/ventes/lot/', VenteLotAPIView.as_view(), name='vente-lot'),
     path('api/statistiques-du-jour/', statistiques_du_jour),
     path('api/rapport-general/', rapport_general),
     path('api/historique-mouvements/', historique_mouvements, name='historique-mouvements'),
     path('api/historique-ventes/', HistoriqueVentesAPIView.as_view(), name='historique-ventes'),
+    path('api/historique-ventes/caissier/', historique_ventes, name='historique-ventes-caissier'),
+    path('api/export/ventes/', export_historique_ventes, name='export-ventes'),
+    path('api/export/rapport-stock/', export_rapport_stock, name='export-rapport-stock'),
 
     # Liste des produits d'une pharmacies
     path('api/commandes-produitss/', CommandeProduitListView.as_view(), name='liste-commandes-produits'),
     path('api/produits-pharmacie/', ProduitPharmacieListAPIView.as_view(), name='produits-pharmacie'),
+    path('api/produits-pharmacie/code-barre/<str:code>/', produit_par_code_barre, name='produit-code-barre'),
     path('api/reception/confirm/', ConfirmerReceptionView.as_view(), name='confirmer-reception'),
     path('api/commande/<uuid:pk>/', CommandeDetailView.as_view(), name='commande-detail'),
 
@@ -121,10 +139,15 @@ urlpatterns = [
     path('api/clients/<uuid:pk>/ordonnance/', CreatePrescriptionView.as_view(), name='create-prescription'),
     path('api/clients/<uuid:pk>/dossier-medical/', DossierMedicalClientView.as_view(), name='dossier-medical'),
     path('api/rapport-stock/<uuid:pharmacie_id>/', analyse_stock_api, name='analyse_stock_api'),
+    path('api/previsions/suggestions/', suggestions_commande, name='suggestions-commande'),
+    path('api/commandes/propositions/', propositions_commande, name='propositions-commande'),
     path("api/rapports/", liste_rapports, name="liste_rapports"),
     path("api/rapports/generer/", generer_rapport, name="generer_rapport"),
     path('api/imprimer-proformat/', imprimer_proformat, name='imprimer_proformat'),
     path("api/imprimer-commande/",ImprimerCommandeAPIView.as_view()),
+    path('api/impression/statut/', statut_impression, name='statut_impression'),
+    path('api/ventes/<uuid:pk>/reimprimer/', reimprimer_vente, name='reimprimer-vente'),
     path('api/stock/ajout-direct/', ApprovisionnementRapideView.as_view()),
+    path('api/evenements/', flux_evenements, name='flux-evenements'),
      
 ]
@@ -7,17 +7,21 @@ Analyse et gestion des stocks pour la pharmacie :
 - Détection des produits inactifs ou en rupture
 """
 
+import numpy as np
 from decimal import Decimal, ROUND_HALF_UP
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
 from collections import OrderedDict
-from django.db.models import Sum, F, Value, Q, Min, Max, DecimalField
+from django.db.models import Sum, F, Value, Q, Min, Max, Avg, OuterRef, Subquery, DecimalField, DateTimeField, DurationField, ExpressionWrapper
 from django.db.models.functions import Coalesce, TruncMonth
 from django.utils import timezone
+from django.db import transaction
 
 from pharmacie.models import (
     ProduitPharmacie,
     VenteLigne,
     VenteProduit,
+    VenteJournaliere,
+    PrevisionDemande,
     ReceptionLigne,
     ReceptionProduit,
     CommandeProduitLigne,
@@ -31,6 +35,74 @@ def _quantize(value, places="0.01"):
     """Arrondir proprement les décimaux."""
     return Decimal(value).quantize(Decimal(places), rounding=ROUND_HALF_UP)
 
+
+def bornes_locales(date_debut=None, date_fin=None):
+    """
+    Jours date_debut..date_fin en datetimes [début, fin[ du fuseau courant, à filtrer
+    par date_vente__gte / date_vente__lt : contrairement à date_vente__date, ces
+    filtres peuvent utiliser l'index (pharmacie, date_vente). Borne absente : None.
+    """
+    tz = timezone.get_current_timezone()
+    debut = timezone.make_aware(datetime.combine(date_debut, datetime.min.time()), tz) if date_debut else None
+    fin = timezone.make_aware(datetime.combine(date_fin + timedelta(days=1), datetime.min.time()), tz) if date_fin else None
+    return debut, fin
+
+# ============================================================
+# 🗄️ CACHE DES ANALYSES
+# ============================================================
+
+from functools import wraps
+from django.core.cache import cache
+
+DUREE_CACHE_ANALYSES = 15 * 60  # secondes
+
+
+def _cle_version_analyses(pharmacie_id):
+    return f"analyses:version:{pharmacie_id}"
+
+
+def version_analyses(pharmacie_id):
+    """Numéro de version des analyses d'une pharmacie (change à chaque vente, réception, ...)."""
+    return cache.get_or_set(_cle_version_analyses(pharmacie_id), 1, None)
+
+
+def invalider_analyses(pharmacie_id):
+    """Rend obsolètes toutes les analyses en cache de la pharmacie (nouvelle version des clés)."""
+    cle = _cle_version_analyses(pharmacie_id)
+    try:
+        cache.incr(cle)
+    except ValueError:
+        cache.set(cle, 2, None)
+
+
+def cle_cache_analyse(nom, pharmacie_id, *parametres):
+    """Clé de cache d'une analyse, liée à la version courante des données de la pharmacie."""
+    suffixe = ":".join(str(p) for p in parametres)
+    return f"analyses:{nom}:{pharmacie_id}:v{version_analyses(pharmacie_id)}:{suffixe}"
+
+
+def analyse_en_cache(nom, duree=DUREE_CACHE_ANALYSES):
+    """
+    Met en cache le résultat d'une analyse dont le premier argument est la pharmacie,
+    par (pharmacie, paramètres). Les entrées deviennent obsolètes dès que la version
+    des analyses de la pharmacie change (vente, réception, dépense, ...).
+    """
+    def decorateur(fonction):
+        @wraps(fonction)
+        def enveloppe(pharmacie, *args, **kwargs):
+            parametres = [getattr(a, 'pk', a) for a in args]
+            parametres += [f"{k}={getattr(v, 'pk', v)}" for k, v in sorted(kwargs.items())]
+            cle = cle_cache_analyse(nom, pharmacie.pk, *parametres)
+
+            resultat = cache.get(cle)
+            if resultat is None:
+                resultat = fonction(pharmacie, *args, **kwargs)
+                cache.set(cle, resultat, duree)
+            return resultat
+        return enveloppe
+    return decorateur
+
+
 # ============================================================
 # 📊 AGRÉGATIONS
 # ============================================================
@@ -40,18 +112,14 @@ def aggregate_sales(pharmacie, period_days=30, by_value=False):
     Agrège les ventes sur une période donnée.
     Retourne un dict : {produit_id: {...}}
     """
-    end = timezone.now()
-    start = end - timedelta(days=period_days)
+    end = timezone.localdate()
+    start = end - timedelta(days=period_days - 1)  # period_days jours, aujourd'hui compris
 
-    qs = (
-        VenteLigne.objects
-        .filter(vente__pharmacie=pharmacie, vente__date_vente__range=(start, end))
-        .select_related('produit')
-    )
+    qs = VenteJournaliere.objects.filter(pharmacie=pharmacie, jour__range=(start, end))
 
     agg = qs.values('produit').annotate(
         sold_qty=Coalesce(Sum('quantite'), Value(0), output_field=DecimalField()),
-        total_value=Coalesce(Sum(F('total')), Value(0), output_field=DecimalField()),
+        total_value=Coalesce(Sum('chiffre_affaires'), Value(0), output_field=DecimalField()),
     )
 
     produits = ProduitPharmacie.objects.filter(id__in=[a['produit'] for a in agg])
@@ -71,67 +139,93 @@ def aggregate_sales(pharmacie, period_days=30, by_value=False):
 
 def aggregate_received(pharmacie, period_days=None):
     """
-    Total reçu par produit.
+    Total reçu par produit, calculé en base (une requête : somme des réceptions
+    groupées par produit fabricant, rattachée à chaque produit de la pharmacie).
     Retourne : {produit_pharmacie_id: total_recu}
     """
-    qs = (
-        ReceptionLigne.objects
-        .select_related('ligne_commande', 'reception', 'ligne_commande__produit_fabricant')
-        .filter(reception__commande__pharmacie=pharmacie)
+    receptions = ReceptionLigne.objects.filter(
+        reception__commande__pharmacie=pharmacie,
+        ligne_commande__produit_fabricant=OuterRef('produit_fabricant'),
     )
 
     if period_days:
         end = timezone.now()
         start = end - timedelta(days=period_days)
-        qs = qs.filter(reception__date_reception__range=(start, end))
+        receptions = receptions.filter(reception__date_reception__range=(start, end))
 
-    totals = {}
-    for r in qs:
-        pf = r.ligne_commande.produit_fabricant
-        if pf:
-            totals[str(pf.id)] = totals.get(str(pf.id), 0) + int(r.quantite_recue or 0)
+    total_recu = (
+        receptions.values('ligne_commande__produit_fabricant')
+        .annotate(total=Sum('quantite_recue'))
+        .values('total')
+    )
 
-    result = {}
-    produits_ph = ProduitPharmacie.objects.filter(pharmacie=pharmacie).select_related('produit_fabricant')
-    for ph in produits_ph:
-        pf_id = str(ph.produit_fabricant.id) if ph.produit_fabricant else None
-        result[str(ph.id)] = Decimal(totals.get(pf_id, 0))
+    produits = (
+        ProduitPharmacie.objects
+        .filter(pharmacie=pharmacie)
+        .annotate(total_recu=Coalesce(Subquery(total_recu), Value(0)))
+        .values_list('id', 'total_recu')
+    )
 
-    return result
+    return {str(pid): Decimal(total) for pid, total in produits}
 
 # ============================================================
 # ⏳ ESTIMATION TEMPS EN PHARMACIE
 # ============================================================
 
-def estimate_time_in_pharmacy(pharmacie, produit_obj, period_days=365):
-    """Estime le temps moyen qu’un produit passe dans la pharmacie."""
-    pf = produit_obj.produit_fabricant
-    if not pf:
-        return None
+def _avg_since(field, reference):
+    """Moyenne de (field - reference) en durée : une date moyenne calculable par GROUP BY."""
+    return Avg(ExpressionWrapper(F(field) - Value(reference, output_field=DateTimeField()),
+                                 output_field=DurationField()))
+
 
+def estimate_times_in_pharmacy(pharmacie, period_days=365, produits=None):
+    """
+    Estime, pour tous les produits à la fois, le temps moyen passé dans la pharmacie :
+    écart entre la date moyenne des ventes et la date moyenne des réceptions.
+    Deux requêtes groupées (réceptions par produit fabricant, ventes par produit).
+    Retourne : {produit_id: jours (Decimal)}
+    """
     end = timezone.now()
     start = end - timedelta(days=period_days)
 
     rec_qs = ReceptionLigne.objects.filter(
         reception__commande__pharmacie=pharmacie,
         reception__date_reception__range=(start, end),
-        ligne_commande__produit_fabricant=pf
     )
-
     sale_qs = VenteLigne.objects.filter(
         vente__pharmacie=pharmacie,
         vente__date_vente__range=(start, end),
-        produit=produit_obj
+    )
+    if produits is not None:
+        rec_qs = rec_qs.filter(ligne_commande__produit_fabricant__in=[p.produit_fabricant_id for p in produits])
+        sale_qs = sale_qs.filter(produit__in=produits)
+
+    avg_rec = dict(
+        rec_qs.values('ligne_commande__produit_fabricant')
+        .annotate(avg=_avg_since('reception__date_reception', start))
+        .values_list('ligne_commande__produit_fabricant', 'avg')
+    )
+    avg_sale = (
+        sale_qs.values('produit', 'produit__produit_fabricant')
+        .annotate(avg=_avg_since('vente__date_vente', start))
     )
 
-    if not rec_qs.exists() or not sale_qs.exists():
-        return None
+    result = {}
+    for row in avg_sale:
+        rec = avg_rec.get(row['produit__produit_fabricant'])
+        if rec is None or row['avg'] is None:
+            continue
+        avg_days = (row['avg'] - rec).total_seconds() / (24 * 3600)
+        if avg_days >= 0:
+            result[str(row['produit'])] = Decimal(avg_days).quantize(Decimal('0.1'))
+    return result
 
-    avg_rec = sum(r.reception.date_reception.timestamp() for r in rec_qs) / rec_qs.count()
-    avg_sale = sum(s.vente.date_vente.timestamp() for s in sale_qs) / sale_qs.count()
-    avg_days = (avg_sale - avg_rec) / (24 * 3600)
 
-    return Decimal(avg_days).quantize(Decimal('0.1')) if avg_days >= 0 else None
+def estimate_time_in_pharmacy(pharmacie, produit_obj, period_days=365):
+    """Estime le temps moyen qu’un produit passe dans la pharmacie."""
+    if not produit_obj.produit_fabricant_id:
+        return None
+    return estimate_times_in_pharmacy(pharmacie, period_days, produits=[produit_obj]).get(str(produit_obj.id))
 
 # ============================================================
 # 🧠 MÉTRIQUES ET CATÉGORISATION ABC
@@ -146,6 +240,7 @@ def compute_metrics(pharmacie, period_days=30, by_value=False, abc_thresholds=(8
     """
     sales = aggregate_sales(pharmacie, period_days, by_value)
     received = aggregate_received(pharmacie)
+    times_in_pharm = estimate_times_in_pharmacy(pharmacie)
     total_global = sum(v['sold_value'] if by_value else v['sold_qty'] for v in sales.values()) or Decimal('0')
 
     items = []
@@ -160,7 +255,7 @@ def compute_metrics(pharmacie, period_days=30, by_value=False, abc_thresholds=(8
         stock_current = Decimal(prod.quantite or 0)
         percent = (sold_value / total_global * 100) if by_value else (sold_qty / total_global * 100)
         avg_daily = sold_qty / Decimal(period_days) if period_days > 0 else Decimal('0')
-        time_in_pharm = estimate_time_in_pharmacy(pharmacie, prod)
+        time_in_pharm = times_in_pharm.get(str(prod.id))
 
         items.append({
             'produit': prod,
@@ -206,7 +301,7 @@ def recommend_order_qty(produit_obj, avg_daily, lead_time_days=14, safety_days=7
     current = Decimal(produit_obj.quantite or 0)
     reorder_level = avg_daily * Decimal(lead_time_days + safety_days)
     desired_stock = avg_daily * Decimal(target_cover_days)
-    qty_needed = max(desired_stock - current, 0)
+    qty_needed = max(desired_stock - current, Decimal('0'))
 
     if rounding_unit > 1:
         units = (qty_needed / Decimal(rounding_unit)).quantize(0, rounding=ROUND_HALF_UP)
@@ -240,57 +335,192 @@ def flags_for_product(item, expire_threshold_days=90, low_stock_days_threshold=7
 
     return flags
 
+# ============================================================
+# 📆 PREMIÈRE / DERNIÈRE VENTE PAR PRODUIT
+# ============================================================
+
+def sale_dates_by_product(pharmacie, produits=None):
+    """
+    Première et dernière vente de chaque produit, en une requête groupée.
+    Retourne : {produit_id: {'first': datetime, 'last': datetime}}
+    """
+    qs = VenteJournaliere.objects.filter(pharmacie=pharmacie)
+    if produits is not None:
+        qs = qs.filter(produit__in=produits)
+
+    rows = qs.values('produit').annotate(first=Min('premiere_vente'), last=Max('derniere_vente'))
+    return {str(r['produit']): {'first': r['first'], 'last': r['last']} for r in rows}
+
 # ============================================================
 # 📄 RAPPORT GLOBAL
 # ============================================================
 
+def _round_half_up(values, places):
+    """ROUND_HALF_UP vectorisé (comme _quantize) pour des valeurs positives."""
+    factor = 10 ** places
+    return np.floor(values * factor + 0.5 + 1e-9) / factor
+
+
+def load_inventory_arrays(pharmacie, period_days=30):
+    """
+    Charge en une fois, sous forme de tableaux NumPy (une case par produit vendu
+    sur la période), tout ce dont le rapport a besoin :
+    ventes (table journalière), stock, seuil d'alerte, péremption, quantités reçues
+    et temps moyen en pharmacie. Nombre de requêtes constant.
+    """
+    end = timezone.localdate()
+    start = end - timedelta(days=period_days - 1)  # period_days jours, aujourd'hui compris
+
+    rows = list(
+        VenteJournaliere.objects
+        .filter(pharmacie=pharmacie, jour__range=(start, end))
+        .values('produit', 'produit__nom_medicament', 'produit__quantite',
+                'produit__alerte_quantite', 'produit__date_peremption')
+        .annotate(sold_qty=Sum('quantite'), sold_value=Sum('chiffre_affaires'))
+    )
+    received = aggregate_received(pharmacie)
+    times = estimate_times_in_pharmacy(pharmacie)
+
+    ids = [str(r['produit']) for r in rows]
+    return {
+        'ids': ids,
+        'noms': [r['produit__nom_medicament'] for r in rows],
+        'sold_qty': np.array([r['sold_qty'] or 0 for r in rows], dtype=float),
+        'sold_value': np.array([float(r['sold_value'] or 0) for r in rows], dtype=float),
+        'stock': np.array([r['produit__quantite'] for r in rows], dtype=float),
+        'alerte': np.array([r['produit__alerte_quantite'] for r in rows], dtype=float),
+        'days_to_expiry': np.array([(r['produit__date_peremption'] - end).days for r in rows], dtype=float),
+        'received_qty': np.array([float(received.get(pid, 0)) for pid in ids], dtype=float),
+        'time_in_pharm': np.array([float(times[pid]) if pid in times else np.nan for pid in ids], dtype=float),
+    }
+
+
+def quantites_a_commander(avg_daily, stock, target_cover_days=30, rounding_unit=1):
+    """
+    recommend_order_qty vectorisé : couverture cible - stock actuel, arrondi
+    à rounding_unit (reorder_level non utilisé, comme recommend_order_qty).
+    """
+    qty_needed = np.maximum(avg_daily * target_cover_days - stock, 0)
+    if rounding_unit > 1:
+        return (_round_half_up(qty_needed / rounding_unit, 0) * rounding_unit).astype(np.int64)
+    return _round_half_up(qty_needed, 0).astype(np.int64)
+
+
+def compute_metrics_vectorized(data, period_days=30, by_value=False, abc_thresholds=(80, 95),
+                               lead_time_days=14, safety_days=7, target_cover_days=30, rounding_unit=1,
+                               expire_threshold_days=90, low_stock_days_threshold=7):
+    """
+    Version vectorisée de compute_metrics + recommend_order_qty + flags_for_product :
+    mêmes règles, calculées sur tous les produits à la fois.
+    Retourne les tableaux triés par ventes décroissantes.
+    """
+    sold = data['sold_qty']
+    metric = data['sold_value'] if by_value else sold
+    total_global = metric.sum()
+
+    percent = _round_half_up(metric / total_global * 100, 2) if total_global > 0 else np.zeros_like(metric)
+    avg_daily = _round_half_up(sold / period_days, 2) if period_days > 0 else np.zeros_like(sold)
+
+    # Classement (stable, comme list.sort)
+    order = np.argsort(-metric, kind='stable')
+    out = {k: v[order] for k, v in data.items() if isinstance(v, np.ndarray)}
+    out.update(ids=[data['ids'][i] for i in order], noms=[data['noms'][i] for i in order])
+    percent, avg_daily = percent[order], avg_daily[order]
+
+    # Catégorisation ABC sur le pourcentage cumulé (en centièmes entiers : pas d'erreur d'arrondi)
+    cum = np.cumsum(np.rint(percent * 100).astype(np.int64))
+    a_limit, b_limit = (int(round(t * 100)) for t in abc_thresholds)
+    categorie = np.where(cum <= a_limit, 'A', np.where(cum <= b_limit, 'B', 'C'))
+
+    stock = out['stock']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_stock = np.where(avg_daily > 0, np.round(stock / avg_daily, 1), np.nan)
+
+    suggestion = quantites_a_commander(avg_daily, stock, target_cover_days, rounding_unit)
+
+    flags = {
+        'péremption_proche': out['days_to_expiry'] <= expire_threshold_days,
+        'alerte_quantite': stock <= out['alerte'],
+        'rupture_rapide_possible': (days_of_stock > 0) & (days_of_stock <= low_stock_days_threshold),
+        'rotation_rapide': categorie == 'A',
+        'rotation_lente': categorie == 'C',
+        'stock_ancien': out['time_in_pharm'] > 90,
+    }
+    statut = np.select(
+        [
+            flags['alerte_quantite'] | flags['rupture_rapide_possible'],
+            flags['rotation_rapide'],
+            flags['rotation_lente'],
+            flags['péremption_proche'] | flags['stock_ancien'],
+        ],
+        ["⚠️ Rupture fréquente", "🚀 Rotation rapide", "🐢 Rotation lente", "⏳ Péremption/Stock ancien"],
+        default="OK",
+    )
+
+    received = out['received_qty']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        taux_rotation = np.where(received > 0, out['sold_qty'] / received * 100, 0.0)
+
+    out.update(
+        percent=percent, avg_daily=avg_daily, categorie=categorie, days_of_stock=days_of_stock,
+        suggestion=suggestion, flags=flags, statut=statut, taux_rotation=taux_rotation,
+    )
+    return out
+
+
+@analyse_en_cache('rapport_stock')
 def generate_report(pharmacie, period_days=30, by_value=False, **kwargs):
     """
     Génère le rapport complet d’analyse de stock.
+    Calculs vectorisés (NumPy) sur tout le catalogue ; mêmes règles que
+    compute_metrics / recommend_order_qty / flags_for_product.
+    La suggestion de commande part de la demande prévue (compute_forecasts, saisonnalité
+    comprise) quand elle existe, sinon de la moyenne de la période ; dans les deux cas
+    avec le stock actuel et la même règle que recommend_order_qty.
     """
-    metrics = compute_metrics(pharmacie, period_days, by_value)
-    report = []
+    m = compute_metrics_vectorized(load_inventory_arrays(pharmacie, period_days), period_days, by_value, **kwargs)
+    sale_dates = sale_dates_by_product(pharmacie)
+    previsions = {
+        str(pid): float(demande) * float(coefficient) for pid, demande, coefficient in
+        PrevisionDemande.objects.filter(pharmacie=pharmacie)
+        .values_list('produit_id', 'demande_journaliere', 'coefficient_saisonnier')
+    }
+    demande_prevue = np.array([previsions.get(pid, np.nan) for pid in m['ids']], dtype=float)
+    suggestions = np.where(
+        np.isnan(demande_prevue),
+        m['suggestion'],
+        quantites_a_commander(
+            _round_half_up(np.nan_to_num(demande_prevue), 2), m['stock'],
+            kwargs.get('target_cover_days', 30), kwargs.get('rounding_unit', 1),
+        ),
+    )
     today = timezone.now().date()
 
-    for item in metrics:
-        prod = item['produit']
-        qty_reco = recommend_order_qty(prod, item['avg_daily'], **kwargs)
-        flags = flags_for_product(item)
-
-        statut = "OK"
-        if 'alerte_quantite' in flags or 'rupture_rapide_possible' in flags:
-            statut = "⚠️ Rupture fréquente"
-        elif 'rotation_rapide' in flags:
-            statut = "🚀 Rotation rapide"
-        elif 'rotation_lente' in flags:
-            statut = "🐢 Rotation lente"
-        elif 'péremption_proche' in flags or 'stock_ancien' in flags:
-            statut = "⏳ Péremption/Stock ancien"
-
-        last_sale = VenteLigne.objects.filter(vente__pharmacie=pharmacie, produit=prod)\
-            .order_by('-vente__date_vente').values_list('vente__date_vente', flat=True).first()
+    noms_flags = list(m['flags'])
+    flags_par_produit = np.column_stack([m['flags'][f] for f in noms_flags]) if m['ids'] else []
 
-        days_since_last_sale = (today - last_sale.date()).days if last_sale else None
-        first_entry = getattr(prod, 'date_entree', None)
-        time_in_pharm_days = (today - first_entry).days if first_entry else None
+    report = []
+    for i, pid in enumerate(m['ids']):
+        last_sale = sale_dates.get(pid, {}).get('last')
+        days_of_stock = m['days_of_stock'][i]
 
         report.append({
-            'produit_id': item['produit_id'],
-            'nom': item['nom'],
-            'quantite_achetee': int(item['received_qty']),
-            'quantite_vendue': int(item['sold_qty']),
-            'quantite_restante': int(item['stock_current']),
-            'taux_rotation_pct': float((item['sold_qty'] / (item['received_qty'] or 1)) * 100) if item['received_qty'] > 0 else 0.0,
-            'contribution_vente_pct': float(item['percent']),
-            'categorie': item['categorie'],
-            'avg_daily': float(item['avg_daily']),
-            'days_of_stock': float(item['days_of_stock']) if item['days_of_stock'] is not None else None,
+            'produit_id': pid,
+            'nom': m['noms'][i],
+            'quantite_achetee': int(m['received_qty'][i]),
+            'quantite_vendue': int(m['sold_qty'][i]),
+            'quantite_restante': int(m['stock'][i]),
+            'taux_rotation_pct': float(m['taux_rotation'][i]),
+            'contribution_vente_pct': float(m['percent'][i]),
+            'categorie': str(m['categorie'][i]),
+            'avg_daily': float(m['avg_daily'][i]),
+            'days_of_stock': None if np.isnan(days_of_stock) else float(days_of_stock),
             'last_sale_date': str(last_sale.date()) if last_sale else None,
-            'days_since_last_sale': days_since_last_sale,
-            'time_in_pharm_days': time_in_pharm_days,
-            'statut': statut,
-            'flags': flags,
-            'suggestion_commande': qty_reco,
+            'days_since_last_sale': (today - last_sale.date()).days if last_sale else None,
+            'time_in_pharm_days': None,  # ProduitPharmacie n'a pas de date d'entrée
+            'statut': str(m['statut'][i]),
+            'flags': [f for f, actif in zip(noms_flags, flags_par_produit[i]) if actif],
+            'suggestion_commande': int(suggestions[i]),
         })
 
     return report
@@ -299,6 +529,7 @@ def generate_report(pharmacie, period_days=30, by_value=False, **kwargs):
 # 🔄 ROTATION RÉELLE DES PRODUITS
 # ============================================================
 
+@analyse_en_cache('rotation_reelle')
 def analyse_rotation_reelle(pharmacie, period_days=180):
     """
     Analyse la rotation réelle des produits :
@@ -307,28 +538,36 @@ def analyse_rotation_reelle(pharmacie, period_days=180):
     end = timezone.now()
     start = end - timedelta(days=period_days)
 
-    commandes = (
+    commandes = list(
         CommandeProduitLigne.objects
         .filter(commande__pharmacie=pharmacie, commande__date_commande__range=(start, end))
-        .select_related('produit_fabricant')
+        .select_related('commande')
     )
 
+    # Produit de la pharmacie pour chaque produit fabricant commandé (une requête)
+    produits = {}
+    for prod in (ProduitPharmacie.objects
+                 .filter(pharmacie=pharmacie, produit_fabricant__in={c.produit_fabricant_id for c in commandes})
+                 .order_by('id')):
+        produits.setdefault(prod.produit_fabricant_id, prod)
+
+    # Première / dernière vente de ces produits (une requête groupée)
+    sale_dates = sale_dates_by_product(pharmacie, produits=list(produits.values()))
+
     resultats = []
     today = timezone.now().date()
 
     for cmd in commandes:
-        pf = cmd.produit_fabricant
-        prod = ProduitPharmacie.objects.filter(pharmacie=pharmacie, produit_fabricant=pf).first()
+        prod = produits.get(cmd.produit_fabricant_id)
         if not prod:
             continue
 
         date_commande = cmd.commande.date_commande
-        ventes = VenteLigne.objects.filter(vente__pharmacie=pharmacie, produit=prod)
+        dates = sale_dates.get(str(prod.id), {})
+        premiere_vente = dates.get('first')
+        derniere_vente = dates.get('last')
 
-        premiere_vente = ventes.aggregate(Min('vente__date_vente'))['vente__date_vente__min']
-        derniere_vente = ventes.aggregate(Max('vente__date_vente'))['vente__date_vente__max']
-
-        delai_rotation = (premiere_vente.date() - date_commande).days if premiere_vente else None
+        delai_rotation = (premiere_vente.date() - date_commande.date()).days if premiere_vente else None
         temps_inactif = (today - derniere_vente.date()).days if derniere_vente else None
 
         if not derniere_vente:
@@ -357,26 +596,38 @@ def analyse_rotation_reelle(pharmacie, period_days=180):
 # 📅 ANALYSE SAISONNIÈRE
 # ============================================================
 
+def fenetre_mois_complets(months_back=12, jour=None):
+    """
+    (premier jour, dernier jour) des months_back mois calendaires complets qui précèdent
+    le mois de `jour` (aujourd'hui par défaut) : le mois en cours, partiel, est exclu,
+    et le plus ancien mois est compté en entier.
+    """
+    jour = jour or timezone.localdate()
+    end = jour.replace(day=1) - timedelta(days=1)
+    annee, mois = divmod(end.year * 12 + end.month - 1 - (months_back - 1), 12)
+    return date(annee, mois + 1, 1), end
+
+
+@analyse_en_cache('saisonnalite')
 def seasonal_analysis(pharmacie, produit_obj=None, months_back=12, by_value=False):
     """
-    Analyse saisonnière des ventes (par mois).
+    Analyse saisonnière des ventes (par mois), sur les months_back derniers mois complets.
     """
-    end = timezone.now()
-    start = end - timedelta(days=30 * months_back)
+    start, end = fenetre_mois_complets(months_back)
 
-    qs = VenteLigne.objects.filter(vente__pharmacie=pharmacie, vente__date_vente__range=(start, end))
+    qs = VenteJournaliere.objects.filter(pharmacie=pharmacie, jour__range=(start, end))
     if produit_obj:
         qs = qs.filter(produit=produit_obj)
 
-    agg_field = Sum('total') if by_value else Sum('quantite')
+    agg_field = Sum('chiffre_affaires') if by_value else Sum('quantite')
     monthly_qs = (
-        qs.annotate(month=TruncMonth('vente__date_vente'))
+        qs.annotate(month=TruncMonth('jour'))
         .values('month')
-        .annotate(total=Coalesce(agg_field, Value(0)))
+        .annotate(total=Coalesce(agg_field, Value(0), output_field=DecimalField()))
         .order_by('month')
     )
 
-    monthly = [{'month': row['month'].date(), 'total': Decimal(row['total'] or 0)} for row in monthly_qs if row['month']]
+    monthly = [{'month': row['month'], 'total': Decimal(row['total'] or 0)} for row in monthly_qs if row['month']]
     totals = [m['total'] for m in monthly]
 
     avg_monthly = sum(totals) / Decimal(len(totals)) if totals else Decimal('0')
@@ -390,6 +641,68 @@ def seasonal_analysis(pharmacie, produit_obj=None, months_back=12, by_value=Fals
         'multiplier': float(_quantize(multiplier)),
     }
 
+def seasonal_profile(pharmacie, months_back=12, by_value=False):
+    """
+    Profil saisonnier de tout le catalogue en une requête groupée (produit × mois),
+    sur les months_back derniers mois complets (fenetre_mois_complets).
+    Retourne un dict :
+      - months : liste des mois (1er du mois), colonnes de la matrice
+      - produit_ids : identifiants (str), lignes de la matrice
+      - matrix : tableau numpy (n_produits, n_mois) des ventes mensuelles
+      - avg_monthly / max_month / multiplier : par produit, mêmes règles que
+        seasonal_analysis(produit_obj=...) (moyenne sur les mois avec ventes)
+    """
+    start, end = fenetre_mois_complets(months_back)
+
+    agg_field = Sum('chiffre_affaires') if by_value else Sum('quantite')
+    rows = list(
+        VenteJournaliere.objects
+        .filter(pharmacie=pharmacie, jour__range=(start, end))
+        .annotate(month=TruncMonth('jour'))
+        .values('produit', 'month')
+        .annotate(total=Coalesce(agg_field, Value(0), output_field=DecimalField()))
+    )
+
+    months = sorted({r['month'] for r in rows})
+    produit_ids = sorted({str(r['produit']) for r in rows})
+    col = {m: j for j, m in enumerate(months)}
+    lig = {pid: i for i, pid in enumerate(produit_ids)}
+
+    matrix = np.zeros((len(produit_ids), len(months)))
+    for r in rows:
+        matrix[lig[str(r['produit'])], col[r['month']]] = float(r['total'] or 0)
+
+    nb_mois = np.count_nonzero(matrix, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_monthly = np.where(nb_mois > 0, matrix.sum(axis=1) / nb_mois, 0.0)
+        max_month = matrix.max(axis=1) if months else np.zeros(len(produit_ids))
+        multiplier = np.where(avg_monthly > 0, _round_half_up(max_month / avg_monthly, 2), 0.0)
+
+    return {
+        'months': months,
+        'produit_ids': produit_ids,
+        'matrix': matrix,
+        'avg_monthly': avg_monthly,
+        'max_month': max_month,
+        'multiplier': multiplier,
+    }
+
+
+def monthly_coefficients(profile, month):
+    """
+    Coefficient saisonnier de chaque produit du profil pour un mois calendaire (1-12) :
+    ventes de ce mois (complet) dans la fenêtre / moyenne mensuelle du produit.
+    NaN quand le produit n'a rien vendu ce mois-là.
+    """
+    colonnes = [j for j, m in enumerate(profile['months']) if m.month == month]
+    n = len(profile['produit_ids'])
+    if not colonnes:
+        return np.full(n, np.nan)
+
+    ventes = profile['matrix'][:, colonnes[0]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((ventes > 0) & (profile['avg_monthly'] > 0), ventes / profile['avg_monthly'], np.nan)
+
 # ============================================================
 # 🕓 DERNIÈRE VENTE
 # ============================================================
@@ -399,9 +712,9 @@ def last_sale_info(pharmacie, produit_obj):
     Retourne la dernière vente et le nombre de jours écoulés.
     """
     last_sale = (
-        VenteLigne.objects
-        .filter(vente__pharmacie=pharmacie, produit=produit_obj)
-        .aggregate(last_date=Max('vente__date_vente'))
+        VenteJournaliere.objects
+        .filter(pharmacie=pharmacie, produit=produit_obj)
+        .aggregate(last_date=Max('derniere_vente'))
         ['last_date']
     )
 
@@ -414,324 +727,1216 @@ def last_sale_info(pharmacie, produit_obj):
 
 
 
+# ============================================================
+# 🔮 PRÉVISION DE LA DEMANDE
+# ============================================================
+
+ALPHA_LISSAGE = 0.2
+ALPHA_CROSTON = 0.1
+SEUIL_INTERMITTENCE = 1.32  # intervalle moyen entre deux jours de vente (ADI) au-delà duquel on applique Croston
+
+
+def demand_matrix(pharmacie, history_days=180):
+    """
+    Matrice produits × jours des quantités vendues (table journalière, une requête).
+    Retourne (produit_ids, matrice numpy de forme (n_produits, history_days)).
+    """
+    end = timezone.localdate()
+    start = end - timedelta(days=history_days - 1)
+
+    rows = list(
+        VenteJournaliere.objects
+        .filter(pharmacie=pharmacie, jour__range=(start, end), quantite__gt=0)
+        .values_list('produit', 'jour', 'quantite')
+    )
+    produit_ids = sorted({r[0] for r in rows}, key=str)
+    index = {pid: i for i, pid in enumerate(produit_ids)}
+
+    matrice = np.zeros((len(produit_ids), history_days))
+    for pid, jour, quantite in rows:
+        matrice[index[pid], (jour - start).days] += quantite
+    return produit_ids, matrice
+
+
+def forecast_daily_demand(matrice, alpha_ses=ALPHA_LISSAGE, alpha_croston=ALPHA_CROSTON):
+    """
+    Demande journalière prévue pour chaque ligne de la matrice, vectorisée sur tous les produits :
+    - lissage exponentiel simple pour les produits vendus régulièrement
+    - Croston (correction SBA) pour les produits à demande intermittente
+    Retourne (prévision, masque des produits traités par Croston).
+    """
+    n, jours = matrice.shape
+    ventes = matrice > 0
+    nb_jours_vente = ventes.sum(axis=1)
+    intermittent = jours / np.maximum(nb_jours_vente, 1) > SEUIL_INTERMITTENCE
+
+    # Lissage exponentiel simple, initialisé sur la première semaine
+    niveau = matrice[:, :7].mean(axis=1)
+    for t in range(jours):
+        niveau = niveau + alpha_ses * (matrice[:, t] - niveau)
+
+    # Croston : taille des ventes (z) et intervalle entre ventes (p) lissés aux seuls jours de vente
+    z = matrice.sum(axis=1) / np.maximum(nb_jours_vente, 1)
+    p = jours / np.maximum(nb_jours_vente, 1)
+    q = np.ones(n)
+    deja_vendu = np.zeros(n, dtype=bool)  # l'intervalle n'est connu qu'à partir de la deuxième vente
+    for t in range(jours):
+        y = matrice[:, t]
+        vendu = ventes[:, t]
+        z = np.where(vendu, z + alpha_croston * (y - z), z)
+        p = np.where(vendu & deja_vendu, p + alpha_croston * (q - p), p)
+        q = np.where(vendu, 1, q + 1)
+        deja_vendu |= vendu
+    croston = (1 - alpha_croston / 2) * z / p
+
+    return np.where(intermittent, croston, niveau), intermittent
+
+
+def seasonal_coefficients(pharmacie, produit_ids, months_back=12):
+    """
+    Coefficient saisonnier du mois en cours pour chaque produit (profil du catalogue, une requête) :
+    ventes du même mois l'an dernier / moyenne mensuelle du produit, borné à [0.5, 2].
+    Repli sur le coefficient de la pharmacie quand le produit n'a pas vendu ce mois-là,
+    puis sur 1 si l'historique ne couvre pas ce mois.
+    """
+    profil = seasonal_profile(pharmacie, months_back=months_back)
+    mois = timezone.localdate().month
+
+    # Coefficient de la pharmacie (comme seasonal_analysis sans produit)
+    totaux = profil['matrix'].sum(axis=0)
+    colonnes = [j for j, m in enumerate(profil['months']) if m.month == mois]
+    coefficient_pharmacie = totaux[colonnes[0]] / totaux.mean() if colonnes and totaux.mean() > 0 else 1.0
+
+    par_produit = dict(zip(profil['produit_ids'], monthly_coefficients(profil, mois)))
+    coefficients = np.array([par_produit.get(str(pid), np.nan) for pid in produit_ids], dtype=float)
+    return np.clip(np.where(np.isnan(coefficients), coefficient_pharmacie, coefficients), 0.5, 2.0)
+
+
+def compute_forecasts(pharmacie, history_days=180):
+    """
+    Calcule et enregistre (PrevisionDemande) la demande journalière prévue et le
+    coefficient saisonnier de tous les produits vendus sur la période. La quantité
+    à commander n'est pas enregistrée : elle dépend du stock et se calcule à la
+    lecture (suggestion_prevision, generate_report).
+    Retourne le nombre de produits traités.
+    """
+    produit_ids, matrice = demand_matrix(pharmacie, history_days)
+    prevision, intermittent = forecast_daily_demand(matrice)
+    coefficient = seasonal_coefficients(pharmacie, produit_ids)
+
+    previsions = [
+        PrevisionDemande(
+            pharmacie=pharmacie,
+            produit_id=pid,
+            methode='croston' if intermittent[i] else 'lissage',
+            demande_journaliere=_quantize(prevision[i], "0.001"),
+            coefficient_saisonnier=_quantize(coefficient[i]),
+        )
+        for i, pid in enumerate(produit_ids)
+    ]
+
+    with transaction.atomic():
+        PrevisionDemande.objects.filter(pharmacie=pharmacie).delete()
+        PrevisionDemande.objects.bulk_create(previsions, batch_size=1000)
+        transaction.on_commit(lambda: invalider_analyses(pharmacie.id))
+
+    return len(previsions)
+
+
+def suggestion_prevision(prevision, **kwargs):
+    """Quantité à commander d'après une prévision et le stock actuel de son produit (recommend_order_qty)."""
+    return recommend_order_qty(prevision.produit, _quantize(prevision.demande_prevue), **kwargs)
+
+
+# ============================================================
+# 🛒 PROPOSITIONS DE COMMANDE
+# ============================================================
+
+from math import ceil
+from pharmacie.models import CommandeProduit, TauxChange
+
+
+def generer_propositions_commande(pharmacie, period_days=30):
+    """
+    Transforme les suggestions de commande du rapport de stock en commandes brouillon
+    (etat='brouillon'), une par fabricant, toutes les lignes en un seul bulk_create.
+    Les quantités suggérées (en plaquettes) sont converties en boîtes ; les prix USD
+    sont convertis avec le taux de change courant, lu une seule fois.
+    Seuls les brouillons générés précédemment (auto_genere) sont remplacés :
+    ceux créés ou modifiés à la main sont conservés.
+    Retourne la liste des commandes créées.
+    """
+    suggestions = {
+        r['produit_id']: r['suggestion_commande']
+        for r in generate_report(pharmacie, period_days)
+        if r['suggestion_commande'] > 0
+    }
+    produits = (
+        ProduitPharmacie.objects
+        .filter(pharmacie=pharmacie, pk__in=suggestions.keys())
+        .select_related('produit_fabricant')
+    )
+
+    # Quantités en boîtes, regroupées par fabricant puis par produit fabricant
+    par_fabricant = {}
+    for produit in produits:
+        pf = produit.produit_fabricant
+        boites = ceil(suggestions[str(produit.id)] / (pf.nombre_plaquettes_par_boite or 1))
+        lignes = par_fabricant.setdefault(pf.fabricant_id, {})
+        quantite, _ = lignes.get(pf.id, (0, pf))
+        lignes[pf.id] = (quantite + boites, pf)
+
+    taux = TauxChange.objects.order_by('-date').values_list('taux', flat=True).first()
+
+    commandes, lignes = [], []
+    for fabricant_id, produits_fabricant in par_fabricant.items():
+        commande = CommandeProduit(pharmacie=pharmacie, fabricant_id=fabricant_id, etat='brouillon', auto_genere=True)
+        commandes.append(commande)
+        for quantite, pf in produits_fabricant.values():
+            prix = Decimal(pf.prix_achat)
+            if pf.devise.upper() == 'USD':
+                if taux is None:
+                    raise ValueError("Aucun taux de change défini pour convertir le prix.")
+                prix *= Decimal(taux)
+            lignes.append(CommandeProduitLigne(
+                commande=commande,
+                produit_fabricant=pf,
+                quantite_commandee=quantite,
+                prix_achat=_quantize(prix),  # bulk_create n'appelle pas save()
+            ))
+
+    with transaction.atomic():
+        CommandeProduit.objects.filter(pharmacie=pharmacie, etat='brouillon', auto_genere=True).delete()
+        CommandeProduit.objects.bulk_create(commandes)
+        CommandeProduitLigne.objects.bulk_create(lignes, batch_size=1000)
+
+    return commandes
+
+
+# ============================================================
+# 📤 EXPORTS EN FLUX (CSV / NDJSON)
+# ============================================================
+
+import csv
+import json
+from django.http import StreamingHttpResponse
+
+TYPES_EXPORT = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+TAILLE_PAQUET_EXPORT = 2000
+
+
+class _Tampon:
+    """Pseudo-fichier pour csv.writer : renvoie la ligne écrite au lieu de la stocker."""
+    def write(self, valeur):
+        return valeur
+
+
+def _flux_csv(entetes, lignes):
+    ecrivain = csv.writer(_Tampon())
+    yield '\ufeff'  # BOM : accents lisibles à l'ouverture dans Excel
+    yield ecrivain.writerow(entetes)
+    for ligne in lignes:
+        yield ecrivain.writerow(ligne)
+
+
+def _flux_ndjson(entetes, lignes):
+    for ligne in lignes:
+        yield json.dumps(dict(zip(entetes, ligne)), default=str, ensure_ascii=False) + "\n"
+
+
+def reponse_export(type_export, entetes, lignes, nom_fichier):
+    """
+    Réponse HTTP en flux : les octets partent au fur et à mesure que `lignes`
+    (itérable de tuples, idéalement un QuerySet.iterator()) est parcouru.
+    """
+    flux = _flux_csv if type_export == 'csv' else _flux_ndjson
+    reponse = StreamingHttpResponse(flux(entetes, lignes), content_type=TYPES_EXPORT[type_export])
+    reponse['Content-Disposition'] = f'attachment; filename="{nom_fichier}.{type_export}"'
+    return reponse
+
+
+ENTETES_EXPORT_VENTES = [
+    'date_vente', 'vente_id', 'utilisateur', 'client', 'produit', 'quantite', 'prix_unitaire', 'total',
+]
+
+
+def lignes_export_ventes(pharmacie, date_debut=None, date_fin=None):
+    """Lignes de vente de la pharmacie (une par produit vendu), lues par paquets en base."""
+    lignes = VenteLigne.objects.filter(vente__pharmacie=pharmacie)
+    debut, fin = bornes_locales(date_debut, date_fin)
+    if debut:
+        lignes = lignes.filter(vente__date_vente__gte=debut)
+    if fin:
+        lignes = lignes.filter(vente__date_vente__lt=fin)
+
+    return (
+        lignes
+        .order_by('vente__date_vente', 'vente_id')
+        .values_list(
+            'vente__date_vente', 'vente_id', 'vente__utilisateur__username', 'vente__client__nom_complet',
+            'produit__nom_medicament', 'quantite', 'prix_unitaire', 'total',
+        )
+        .iterator(chunk_size=TAILLE_PAQUET_EXPORT)
+    )
+
+
+ENTETES_EXPORT_STOCK = [
+    'produit_id', 'nom', 'categorie', 'statut', 'quantite_achetee', 'quantite_vendue', 'quantite_restante',
+    'taux_rotation_pct', 'contribution_vente_pct', 'avg_daily', 'days_of_stock', 'last_sale_date',
+    'days_since_last_sale', 'suggestion_commande',
+]
+
+
+def lignes_export_stock(pharmacie, period_days=30):
+    """Lignes du rapport de stock (calculé une fois, en cache) au format tabulaire."""
+    for r in generate_report(pharmacie, period_days):
+        yield tuple(r[champ] for champ in ENTETES_EXPORT_STOCK)
+
+
 #################### IMPRESSION#######################################
 #################### IMPRESSION #######################################
 #################### IMPRESSION #######################################
-from escpos.printer import Usb
+from escpos.printer import Usb, Dummy
 from datetime import datetime
 import random
+import threading
 import traceback
 
+# Les tickets sont rendus en mémoire (imprimante Dummy) en un seul tampon
+# d'octets ESC/POS, écrit ensuite en une fois sur l'imprimante.
+# L'en-tête et le pied, fixes pour une pharmacie, sont mis en cache et
+# recalculés seulement quand la ligne Pharmacie change (updated_at).
+_cache_gabarits = {}
+_verrou_gabarits = threading.Lock()
+
+
+def _rendre_octets(rendu, *args):
+    """Exécute rendu(printer, *args) sur une imprimante en mémoire et retourne les octets."""
+    tampon = Dummy()
+    rendu(tampon, *args)
+    return tampon.output
+
+
+def _gabarit(nom, pharmacie, rendu):
+    """Octets d'un gabarit fixe (en-tête/pied) de la pharmacie, depuis le cache."""
+    cle = (nom, pharmacie['id'])
+    version = pharmacie['updated_at']
+    with _verrou_gabarits:
+        en_cache = _cache_gabarits.get(cle)
+    if en_cache and en_cache[0] == version:
+        return en_cache[1]
+
+    octets = _rendre_octets(rendu, pharmacie)
+    with _verrou_gabarits:
+        _cache_gabarits[cle] = (version, octets)
+    return octets
+
+
+def _donnees_pharmacie(pharmacie):
+    return {
+        'id': str(pharmacie.id),
+        'updated_at': pharmacie.updated_at.isoformat() if pharmacie.updated_at else None,
+        'nom_pharm': pharmacie.nom_pharm,
+        'adresse_pharm': pharmacie.adresse_pharm,
+        'telephone': pharmacie.telephone,
+    }
+
+
+def _entete_vente(printer, pharmacie):
+    # Nom pharmacie en gras
+    printer.set(bold=True)
+    printer.text(f"{pharmacie['nom_pharm']}\n")
+
+    # Ultra petit texte (le plus petit possible sur ESC/POS)
+    printer.set(font='b', width=1, height=1)
+    printer.text("\x1B\x21\x01")  # Mode caractères condensés ESC/POS
+    printer.text("(Votre Santé, notre priorité)\n")
+    printer.text("\x1B\x21\x00")  # Retour au mode normal
+
+    # Infos contact
+    printer.set(bold=False)
+    printer.text("Adresse: Av. Lunguvu, N°6, Q/Foir ")
+    printer.text(f"C/: {pharmacie['adresse_pharm']}\n")
+    printer.text(f"Tel: {pharmacie['telephone']}\n")
+    printer.text("Pharmacien Grâce MUSAMFUR\n")
+
+    # Mentions légales fixes
+    printer.text("RCCM: KINM/RCCM/24-A-04269\n")
+    printer.text("IDNAT: 01-g4701-N68946B\n")
+    printer.text("NI: A2436650P\n")
+
+    # Mention légale réduite et centrée
+    printer.set(align='center', width=0.8, height=0.8, bold=False)
+    printer.text("Les produits vendus ne sont\n")
+    printer.text("ni repris, ni échangés.\n")
+    printer.set(width=1, height=1)
+    printer.text("-" * 32 + "\n")
+
+
+def _pied_vente(printer, pharmacie):
+    # =====================================================
+    # ⚠️ AVERTISSEMENT CLIENT
+    # =====================================================
+    printer.set(align='center')
+    printer.text("Chers clients, veuillez vérifier vos\n")
+    printer.text("produits à la livraison.\n")
+    printer.text("-" * 32 + "\n")
+
+    # =====================================================
+    # 🙏 REMERCIEMENT
+    # =====================================================
+    printer.set(align='center', bold=True)
+    printer.text("Merci pour votre paiement !\n")
+    printer.set(bold=False)
+    printer.text("À bientôt !\n\n\n")
+
+
+def _corps_vente(printer, donnees):
+    client = donnees['client']
+
+    # =====================================================
+    # 👤 CLIENT
+    # =====================================================
+    printer.set(align='left', bold=False)
+    if client:
+        printer.text(f"Client : {client['nom_complet']}\n")
+        if client['telephone']:
+            printer.text(f"Tél : {client['telephone']}\n")
+    else:
+        printer.text("Client\n")
+
+    printer.text("-" * 32 + "\n")
+
+    # =====================================================
+    # 🧾 FACTURE N° (ALÉATOIRE)
+    # =====================================================
+    numero_facture = donnees['numero_facture']
+    printer.set(align='center', bold=True)
+    printer.text(f"FACTURE N° {numero_facture}\n")
+    printer.set(bold=False)
+    printer.text("-" * 42 + "\n")
+
+    # =====================================================
+    # 💊 DÉTAIL DES PRODUITS
+    # =====================================================
+    printer.set(align='left', bold=True)
+    printer.text(f"{'Produit':<18}|{'Qté':^5}|{'Prix':^9}|{'PT':^9}\n")
+    printer.set(bold=False)
+    printer.text("-" * 42 + "\n")
+
+    total = 0
+    for l in donnees['lignes']:
+        produit = l['nom']
+        qte = l['quantite']
+        pu = l['prix_unitaire']
+        sous_total = qte * pu
+        total += sous_total
+
+        # Tronquer le nom du produit si trop long
+        nom_affiche = (produit[:18] + '..') if len(produit) > 18 else produit
+
+        # Afficher les colonnes avec séparateurs |
+        printer.text(f"{nom_affiche:<18}|{qte:^5}|{pu:>7.2f}Fc|{sous_total:>7.2f}Fc\n")
+
+    printer.text("-" * 42 + "\n")
+
+    # =====================================================
+    # 💰 TOTAL
+    # =====================================================
+    printer.set(align='right', bold=True)
+    printer.text(f"TOTAL : {total:.2f} Fc\n")
+    printer.set(bold=False)
+    printer.text("-" * 42 + "\n")
+
+
+def _qr_et_coupe(printer, qr_content, size):
+    printer.set(align='center')
+    printer.qr(qr_content, size=size)
+    printer.text("-" * 42 + "\n")
+
+    # ✂️ Couper le papier
+    printer.cut()
+
+
+def rendre_ticket_vente(donnees):
+    """Rend le ticket de caisse complet en octets ESC/POS."""
+    pharmacie = donnees['pharmacie']
+
+    # 👉 Pour diminuer toute la taille du ticket :
+    #    width et height peuvent être mis à 0.8 ou 0.7
+    def premiere_ligne(printer):
+        printer.set(width=1, height=1)
+        # Première ligne : Bienvenue à gauche, date à droite
+        printer.set(align='left', bold=False)
+        printer.text(f"Bienvenue chez{'':<10}{donnees['date_vente']:>20}\n")
+
+    return b"".join([
+        _rendre_octets(premiere_ligne),
+        _gabarit('entete_vente', pharmacie, _entete_vente),
+        _rendre_octets(_corps_vente, donnees),
+        _gabarit('pied_vente', pharmacie, _pied_vente),
+        _rendre_octets(
+            _qr_et_coupe,
+            f"Facture N° {donnees['numero_facture']} - {pharmacie['nom_pharm']}",
+            6,
+        ),
+    ])
+
+
+def donnees_ticket_vente(vente, lignes):
+    """Instantané (sans objets ORM) des informations imprimées sur le ticket."""
+    client = vente.client
+    return {
+        'pharmacie': _donnees_pharmacie(vente.pharmacie),
+        'client': {
+            'nom_complet': client.nom_complet,
+            'telephone': client.telephone,
+        } if client else None,
+        'date_vente': vente.date_vente.strftime('%d/%m/%Y %H:%M'),
+        'numero_facture': random.randint(1000, 9999),
+        'lignes': [
+            {
+                'nom': l.produit.nom_medicament,
+                'quantite': l.quantite,
+                'prix_unitaire': float(l.prix_unitaire),
+            }
+            for l in lignes
+        ],
+    }
+
+
 def imprimer_ticket_vente(vente, lignes):
+    """
+    Rend le ticket de la vente, le conserve sur la vente (réimpression
+    immédiate) et le dépose dans la file d'impression.
+    À appeler après le commit (transaction.on_commit) : l'impression ne
+    retient plus la transaction ni les verrous de la vente. La vente est déjà
+    validée : une erreur est journalisée, jamais remontée à la caisse.
+    """
     print(">>> Impression du ticket appelée pour la vente", vente.id)
     try:
-        # 🔌 Connexion à l’imprimante USB
-        printer = Usb(0x1fc9, 0x2016)
+        octets = rendre_ticket_vente(donnees_ticket_vente(vente, lignes))
+        type(vente).objects.filter(pk=vente.pk).update(ticket_escpos=octets)
+        return spouleur_impression.soumettre('vente', octets, f"Vente {vente.id}")
+    except Exception as e:
+        print(f"⚠️ Erreur impression ticket (vente {vente.id}): {e}")
+        traceback.print_exc()
+        return None
 
-        pharmacie = vente.pharmacie
-        client = vente.client
 
-        # =====================================================
-        # 🔹 CONFIGURATION GLOBALE (TAILLE DU TEXTE)
-        # =====================================================
-        # 👉 Pour diminuer toute la taille du ticket :
-        #    width et height peuvent être mis à 0.8 ou 0.7
-        printer.set(width=1, height=1)
+def reimprimer_ticket_vente(vente):
+    """Réimprime le ticket conservé (ou le rend à nouveau pour les anciennes ventes)."""
+    octets = vente.ticket_escpos
+    if not octets:
+        lignes = vente.lignes.select_related('produit')
+        octets = rendre_ticket_vente(donnees_ticket_vente(vente, lignes))
+        type(vente).objects.filter(pk=vente.pk).update(ticket_escpos=octets)
+    return spouleur_impression.soumettre('vente', bytes(octets), f"Réimpression vente {vente.id}")
 
-        # =====================================================
-        # 🏪 EN-TÊTE PHARMACIE
-        # =====================================================
-        date_vente = vente.date_vente.strftime('%d/%m/%Y %H:%M')
 
-        # Première ligne : Bienvenue à gauche, date à droite
-        printer.set(align='left', bold=False)
-        printer.text(f"Bienvenue chez{'':<10}{date_vente:>20}\n")
-
-        # Nom pharmacie en gras
-        printer.set(bold=True)
-        printer.text(f"{pharmacie.nom_pharm}\n")
-        
-       # Texte très petit en italique simulé
-# Ultra petit texte (le plus petit possible sur ESC/POS)
-        printer.set(font='b', width=1, height=1)
-        printer.text("\x1B\x21\x01")  # Mode caractères condensés ESC/POS
-        printer.text("(Votre Santé, notre priorité)\n")
-        printer.text("\x1B\x21\x00")  # Retour au mode normal
-
-        # Infos contact
-        printer.set(bold=False)
-        printer.text("Adresse: Av. Lunguvu, N°6, Q/Foir ")
-        printer.text(f"C/: {pharmacie.adresse_pharm}\n")
-        printer.text(f"Tel: {pharmacie.telephone}\n")
-        printer.text("Pharmacien Grâce MUSAMFUR\n")
-
-        # Mentions légales fixes
-        printer.text("RCCM: KINM/RCCM/24-A-04269\n")
-        printer.text("IDNAT: 01-g4701-N68946B\n")
-        printer.text("NI: A2436650P\n")
-
-        # Mention légale réduite et centrée
-        printer.set(align='center', width=0.8, height=0.8, bold=False)
-        printer.text("Les produits vendus ne sont\n")
-        printer.text("ni repris, ni échangés.\n")
-        printer.set(width=1, height=1)
-        printer.text("-" * 32 + "\n")
+################### proforma##################
+def _entete_proformat(printer, pharmacie):
+    printer.set(bold=True)
+    printer.text(f"{pharmacie['nom_pharm'][:32]}\n")
 
-        # =====================================================
-        # 👤 CLIENT
-        # =====================================================
-        printer.set(align='left', bold=False)
-        if client:
-            printer.text(f"Client : {client.nom_complet}\n")
-            if client.telephone:
-                printer.text(f"Tél : {client.telephone}\n")
-        else:
-            printer.text("Client\n")
+    printer.set(bold=False, font='b')  # texte petit
+    printer.text("(Votre Santé, notre priorité)\n")
 
-        printer.text("-" * 32 + "\n")
+    printer.text(f"Adresse: {pharmacie['adresse_pharm'][:32]}\n")
+    printer.text(f"Tel: {pharmacie['telephone'][:32]}\n")
+    printer.text("-" * 32 + "\n")
 
-        # =====================================================
-        # 🧾 FACTURE N° (ALÉATOIRE)
-        # =====================================================
-               # =====================================================
-        # 🧾 FACTURE N° (ALÉATOIRE)
-        # =====================================================
-        numero_facture = random.randint(1000, 9999)
-        printer.set(align='center', bold=True)
-        printer.text(f"FACTURE N° {numero_facture}\n")
-        printer.set(bold=False)
-        printer.text("-" * 42 + "\n")
 
-        # =====================================================
-        # 💊 DÉTAIL DES PRODUITS
-        # =====================================================
+def _corps_proformat(printer, donnees):
+    client = donnees['client']
+    lignes = donnees['lignes']
+
+    # ========================
+    # 👤 CLIENT
+    # ========================
+    if client:
+        printer.text(f"Client: {client['nom_complet'][:28]}\n")
+        if client['telephone']:
+            printer.text(f"Tél: {client['telephone'][:28]}\n")
+    else:
+        printer.text("Client: ---\n")
+    printer.text("-" * 32 + "\n")
+
+    # ========================
+    # 🧾 PROFORMAT
+    # ========================
+    printer.set(align='center', bold=True)
+    printer.text(f"PROFORMAT N°{donnees['numero_proformat']}\n")
+    printer.set(bold=False)
+    printer.text("-" * 32 + "\n")
+
+    # ========================
+    # 💊 DÉTAIL PRODUITS
+    # ========================
+    if not lignes:
+        printer.text("⚠️ AUCUN PRODUIT\n")
+        printer.text("-" * 32 + "\n")
+    else:
         printer.set(align='left', bold=True)
-        printer.text(f"{'Produit':<18}|{'Qté':^5}|{'Prix':^9}|{'PT':^9}\n")
+        # 12 + 4 + 8 + 8 = 32
+        printer.text(f"{'PRODUIT':<12}{'QTE':>4}{'P.U':>8}{'TOT':>8}\n")
         printer.set(bold=False)
-        printer.text("-" * 42 + "\n")
+        printer.text("-" * 32 + "\n")
 
         total = 0
         for l in lignes:
-            produit = l.produit.nom_medicament
-            qte = l.quantite
-            pu = float(l.prix_unitaire)
+            nom = l["nom"][:12]
+            qte = l["quantite"]
+            pu = float(l["prix_unitaire"])
             sous_total = qte * pu
             total += sous_total
+            printer.text(f"{nom:<12}{qte:>4}{pu:>8.0f}{sous_total:>8.0f}\n")
 
-            # Tronquer le nom du produit si trop long
-            nom_affiche = (produit[:18] + '..') if len(produit) > 18 else produit
-
-            # Afficher les colonnes avec séparateurs |
-            printer.text(f"{nom_affiche:<18}|{qte:^5}|{pu:>7.2f}Fc|{sous_total:>7.2f}Fc\n")
-
-        printer.text("-" * 42 + "\n")
+        printer.text("-" * 32 + "\n")
 
-        # =====================================================
         # 💰 TOTAL
-        # =====================================================
         printer.set(align='right', bold=True)
-        printer.text(f"TOTAL : {total:.2f} Fc\n")
+        printer.text(f"TOTAL: {total:.0f} Fc\n")
         printer.set(bold=False)
-        printer.text("-" * 42 + "\n")
-
-        # =====================================================
-        # ⚠️ AVERTISSEMENT CLIENT
-        # =====================================================
-        printer.set(align='center')
-        printer.text("Chers clients, veuillez vérifier vos\n")
-        printer.text("produits à la livraison.\n")
         printer.text("-" * 32 + "\n")
 
-        # =====================================================
-        # 🙏 REMERCIEMENT
-        # =====================================================
-        printer.set(align='center', bold=True)
-        printer.text("Merci pour votre paiement !\n")
-        printer.set(bold=False)
-        printer.text("À bientôt !\n\n\n")
-        qr_content = f"Facture N° {numero_facture} - {pharmacie.nom_pharm}"
-        printer.set(align='center')
-        printer.qr(qr_content, size=6)
-        printer.text("-" * 42 + "\n")
+    # ========================
+    # 📝 MESSAGE + QR
+    # ========================
+    printer.set(align='center')
+    printer.text("Vérifiez vos produits\nà la livraison.\n")
+    printer.text("-" * 32 + "\n")
+    printer.text("Merci ! À bientôt !\n\n")
 
-        # ✂️ Couper le papier
-        printer.cut()
-        printer.close()
+    # 🔲 QR Code (taille réduite pour fiabilité)
+    qr_content = f"Proformat {donnees['numero_proformat']} - {donnees['pharmacie']['nom_pharm']}"
+    try:
+        printer.qr(qr_content, size=4)  # size=4 → plus fiable que 6
+    except Exception as qr_e:
+        printer.text("QR: indisponible\n")
+        print(f"⚠️ QR échoué: {qr_e}")
 
+    printer.cut()
 
-        print(">>> Ticket imprimé avec succès ✅")
 
-    except Exception as e:
-        print(f"⚠️ Erreur impression ticket: {e}")
-        traceback.print_exc()
+def rendre_ticket_proformat(donnees):
+    """Rend le ticket proformat en octets ESC/POS."""
+    # ✅ Largeur standard 58mm = 32 colonnes max
+    def premieres_lignes(printer):
+        printer.set(width=1, height=1)
+        printer.set(align='left', bold=False)
+        printer.text(f"Bienvenue chez\n")
+        printer.text(f"{donnees['date']:>32}\n")
 
+    return b"".join([
+        _rendre_octets(premieres_lignes),
+        _gabarit('entete_proformat', donnees['pharmacie'], _entete_proformat),
+        _rendre_octets(_corps_proformat, donnees),
+    ])
 
-################### proforma##################
-from escpos.printer import Usb
-import random
-import traceback
-from datetime import datetime
 
 def imprimer_ticket_proformat(client, pharmacie, lignes):
-    try:
-        printer = Usb(0x1fc9, 0x2016)
+    """Rend le proformat et le dépose dans la file d'impression."""
+    donnees = {
+        'pharmacie': _donnees_pharmacie(pharmacie),
+        'client': {
+            'nom_complet': client.nom_complet,
+            'telephone': client.telephone,
+        } if client else None,
+        'date': datetime.now().strftime('%d/%m/%Y %H:%M'),
+        'numero_proformat': random.randint(1000, 9999),
+        'lignes': lignes,
+    }
+    octets = rendre_ticket_proformat(donnees)
+    return spouleur_impression.soumettre('proformat', octets, f"Proformat {pharmacie.nom_pharm}")
 
-        # ✅ Largeur standard 58mm = 32 colonnes max
-        printer.set(width=1, height=1)
+######################## Impression Commande de Produit#############################
+def _rendre_bon_commande(printer, donnees):
+    """
+    Impression thermique du BON DE COMMANDE (réception fournisseur)
+    Corps : Produit | Qté cmd | Qté reçue (cases)
+    """
+    # ==============================
+    # 🏥 EN-TÊTE
+    # ==============================
+    printer.set(align='center', bold=True)
+    printer.text("BON DE COMMANDE\n")
+    printer.set(bold=False)
+    printer.text("-" * 32 + "\n")
+
+    printer.set(align='left')
+    printer.text(f"Pharmacie : {donnees['pharmacie']}\n")
+    printer.text(f"Date      : {donnees['date_commande']}\n")
+    printer.text(f"Fabricant : {donnees['fabricant']}\n")
+    printer.text("-" * 32 + "\n")
+
+    # ==============================
+    # 📦 CORPS (RÉCEPTION)
+    # ==============================
+    printer.set(bold=True)
+    printer.text(f"{'Produit':<16}{'Cmd':>5}{'Rec'}\n")
+    printer.set(bold=False)
+    printer.text("-" * 32 + "\n")
+
+    for ligne in donnees['lignes']:
+        nom = ligne['nom'][:16]
+        qte_cmd = ligne['quantite_commandee']
+
+        # ⬜⬜⬜ = zone manuelle réception
+        printer.text(f"{nom:<16}{qte_cmd:>5}   [   ]\n")
+
+    printer.text("-" * 32 + "\n")
+
+    # ==============================
+    # ✍️ SIGNATURE / RÉCEPTION
+    # ==============================
+    printer.text("\nReçu par : _______________\n")
+    printer.text("Date     : ____ / ____ / ____\n")
+
+    printer.text("\n\n")
+    printer.cut()
 
-        # ========================
-        # 🏪 EN-TÊTE
-        # ========================
-        date_now = datetime.now().strftime('%d/%m/%Y %H:%M')
-        printer.set(align='left', bold=False)
-        printer.text(f"Bienvenue chez\n")
-        printer.text(f"{date_now:>32}\n")
 
-        printer.set(bold=True)
-        printer.text(f"{pharmacie.nom_pharm[:32]}\n")
+def imprimer_commande_thermique(commande):
+    """Rend le bon de commande et le dépose dans la file d'impression."""
+    donnees = {
+        'pharmacie': commande.pharmacie.nom_pharm,
+        'fabricant': commande.fabricant.nom,
+        'date_commande': commande.date_commande.strftime("%d/%m/%Y %H:%M"),
+        'lignes': [
+            {'nom': ligne.produit_fabricant.nom, 'quantite_commandee': ligne.quantite_commandee}
+            for ligne in commande.lignes.select_related('produit_fabricant')
+        ],
+    }
+    octets = _rendre_octets(_rendre_bon_commande, donnees)
+    return spouleur_impression.soumettre('commande', octets, f"Commande {commande.id}")
 
-        printer.set(bold=False, font='b')  # texte petit
-        printer.text("(Votre Santé, notre priorité)\n")
 
-        printer.text(f"Adresse: {pharmacie.adresse_pharm[:32]}\n")
-        printer.text(f"Tel: {pharmacie.telephone[:32]}\n")
-        printer.text("-" * 32 + "\n")
+######################## Spouleur d'impression #############################
+import queue
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from escpos.printer import File
 
-        # ========================
-        # 👤 CLIENT
-        # ========================
-        if client:
-            printer.text(f"Client: {client.nom_complet[:28]}\n")
-            if client.telephone:
-                printer.text(f"Tél: {client.telephone[:28]}\n")
-        else:
-            printer.text("Client: ---\n")
-        printer.text("-" * 32 + "\n")
+TYPES_TICKETS = ('vente', 'proformat', 'commande')
 
-        # ========================
-        # 🧾 PROFORMAT
-        # ========================
-        numero_proformat = random.randint(1000, 9999)
-        printer.set(align='center', bold=True)
-        printer.text(f"PROFORMAT N°{numero_proformat}\n")
-        printer.set(bold=False)
-        printer.text("-" * 32 + "\n")
 
-        # ========================
-        # 💊 DÉTAIL PRODUITS
-        # ========================
-        if not lignes:
-            printer.text("⚠️ AUCUN PRODUIT\n")
-            printer.text("-" * 32 + "\n")
-        else:
-            printer.set(align='left', bold=True)
-            # 12 + 4 + 8 + 8 = 32
-            printer.text(f"{'PRODUIT':<12}{'QTE':>4}{'P.U':>8}{'TOT':>8}\n")
-            printer.set(bold=False)
-            printer.text("-" * 32 + "\n")
-
-            total = 0
-            for l in lignes:
-                nom = l["nom"][:12]
-                qte = l["quantite"]
-                pu = float(l["prix_unitaire"])
-                sous_total = qte * pu
-                total += sous_total
-                printer.text(f"{nom:<12}{qte:>4}{pu:>8.0f}{sous_total:>8.0f}\n")
-
-            printer.text("-" * 32 + "\n")
-
-            # 💰 TOTAL
-            printer.set(align='right', bold=True)
-            printer.text(f"TOTAL: {total:.0f} Fc\n")
-            printer.set(bold=False)
-            printer.text("-" * 32 + "\n")
-
-        # ========================
-        # 📝 MESSAGE + QR
-        # ========================
-        printer.set(align='center')
-        printer.text("Vérifiez vos produits\nà la livraison.\n")
-        printer.text("-" * 32 + "\n")
-        printer.text("Merci ! À bientôt !\n\n")
+def ouvrir_imprimante():
+    """
+    Ouvre l'imprimante configurée dans settings.IMPRIMANTE :
+    - 'usb'     : imprimante thermique USB (matériel de la caisse)
+    - 'fichier' : écrit les octets ESC/POS dans un fichier (tests, débogage)
+    - 'dummy'   : garde les octets en mémoire
+    """
+    conf = getattr(settings, 'IMPRIMANTE', {})
+    backend = conf.get('BACKEND', 'usb')
 
-        # 🔲 QR Code (taille réduite pour fiabilité)
-        qr_content = f"Proformat {numero_proformat} - {pharmacie.nom_pharm}"
-        try:
-            printer.qr(qr_content, size=4)  # size=4 → plus fiable que 6
-        except Exception as qr_e:
-            printer.text("QR: indisponible\n")
-            print(f"⚠️ QR échoué: {qr_e}")
+    if backend == 'usb':
+        return Usb(conf.get('ID_FABRICANT', 0x1fc9), conf.get('ID_PRODUIT', 0x2016))
+    if backend == 'fichier':
+        return File(conf.get('FICHIER', '/tmp/tickets.escpos'))
+    if backend == 'dummy':
+        return Dummy()
+    raise ValueError(f"Backend d'imprimante inconnu : {backend}")
 
-        printer.cut()
-        printer.close()
-        print("✅ Proformat imprimé avec succès")
 
-    except Exception as e:
-        print(f"❌ Erreur impression proformat: {e}")
-        traceback.print_exc()
+class SpouleurImpression:
+    """
+    File d'impression du processus : les requêtes déposent un travail
+    (ticket déjà rendu en octets ESC/POS) et rendent la main tout de suite ;
+    un thread dédié garde la connexion à l'imprimante ouverte et vide la file.
+    Un travail en échec est réessayé en rouvrant la connexion.
+    """
+    TENTATIVES_MAX = 3
+    DELAI_ENTRE_TENTATIVES = 2  # secondes, multiplié par le numéro de tentative
+    HISTORIQUE_MAX = 100
+
+    def __init__(self, ouvrir=ouvrir_imprimante):
+        self._ouvrir = ouvrir
+        self._file = queue.Queue()
+        self._travaux = OrderedDict()
+        self._verrou = threading.Lock()
+        self._thread = None
+        self.imprimante = None
+
+    def soumettre(self, type_travail, octets, description=""):
+        """Ajoute un ticket rendu à la file et retourne l'identifiant du travail."""
+        if type_travail not in TYPES_TICKETS:
+            raise ValueError(f"Type de ticket inconnu : {type_travail}")
+
+        travail = {
+            'id': str(uuid.uuid4()),
+            'type': type_travail,
+            'description': description,
+            'statut': 'en_attente',
+            'tentatives': 0,
+            'erreur': None,
+            'taille_octets': len(octets),
+            'cree_le': timezone.now().isoformat(),
+            'octets': octets,
+        }
+        with self._verrou:
+            self._travaux[travail['id']] = travail
+            # On ne garde que l'historique récent (les travaux en attente restent)
+            for ancien in list(self._travaux.values()):
+                if len(self._travaux) <= self.HISTORIQUE_MAX:
+                    break
+                if ancien['statut'] in ('imprime', 'echec'):
+                    del self._travaux[ancien['id']]
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._boucle, name="spouleur-impression", daemon=True
+                )
+                self._thread.start()
+
+        self._file.put(travail)
+        return travail['id']
+
+    def attendre(self):
+        """Bloque jusqu'à ce que tous les travaux déposés soient traités."""
+        self._file.join()
+
+    def statut(self):
+        with self._verrou:
+            travaux = [
+                {k: v for k, v in t.items() if k != 'octets'}
+                for t in reversed(self._travaux.values())
+            ]
+        return {
+            'actif': self._thread is not None and self._thread.is_alive(),
+            'connecte': self.imprimante is not None,
+            'en_attente': self._file.qsize(),
+            'travaux': travaux,
+        }
 
-######################## Impression Commande de Produit#############################
-from escpos.printer import Usb
-from datetime import datetime
-import traceback
+    def _boucle(self):
+        while True:
+            travail = self._file.get()
+            try:
+                self._imprimer(travail)
+            finally:
+                self._file.task_done()
+
+    def _imprimer(self, travail):
+        for tentative in range(1, self.TENTATIVES_MAX + 1):
+            travail['tentatives'] = tentative
+            travail['statut'] = 'en_cours'
+            try:
+                if self.imprimante is None:
+                    self.imprimante = self._ouvrir()
+                # Tout le ticket en une seule écriture sur le périphérique
+                self.imprimante._raw(travail['octets'])
+                travail['statut'] = 'imprime'
+                travail['erreur'] = None
+                print(f">>> {travail['description']} imprimé avec succès ✅")
+                return
+            except Exception as e:
+                travail['erreur'] = str(e)
+                print(f"⚠️ Erreur impression ({travail['description']}, tentative {tentative}): {e}")
+                traceback.print_exc()
+                self._fermer()
+                if tentative < self.TENTATIVES_MAX:
+                    time.sleep(self.DELAI_ENTRE_TENTATIVES * tentative)
+
+        travail['statut'] = 'echec'
+
+    def _fermer(self):
+        if self.imprimante is not None:
+            try:
+                self.imprimante.close()
+            except Exception:
+                pass
+        self.imprimante = None
+
+
+# Un spouleur par processus : il est le seul à parler à l'imprimante
+spouleur_impression = SpouleurImpression()
+
+
+######################## Index des codes-barres #############################
+class IndexCodesBarres:
+    """
+    Index en mémoire (par processus) des produits d'une pharmacie par code-barre,
+    pour la caisse : code_barre -> fiche {id, nom_medicament, prix_vente, quantite, code_barre}.
+    - Chargé à la première lecture, en une requête par pharmacie.
+    - Tenu à jour par les signaux de ProduitPharmacie et après chaque vente.
+    - Rechargé après DUREE_VIE secondes : borne l'écart avec les modifications
+      faites par un autre processus (autre worker) ou sans signal (update()).
+    - Code inconnu : lecture en base, puis ajout à l'index.
+    """
+    DUREE_VIE = 30  # secondes
+    CHAMPS = ('id', 'nom_medicament', 'prix_vente', 'quantite', 'code_barre')
+
+    def __init__(self):
+        self._pharmacies = {}  # pharmacie_id -> {'expire': t, 'codes': {code: fiche}, 'ids': {produit_id: code}}
+        self._verrou = threading.Lock()
+
+    @staticmethod
+    def _fiche(valeurs):
+        return {
+            'id': str(valeurs['id']),
+            'nom_medicament': valeurs['nom_medicament'],
+            'prix_vente': str(valeurs['prix_vente']) if valeurs['prix_vente'] is not None else None,
+            'quantite': valeurs['quantite'],
+            'code_barre': valeurs['code_barre'],
+        }
 
-def imprimer_commande_thermique(commande):
+    def _entree(self, pharmacie_id):
+        cle = str(pharmacie_id)
+        entree = self._pharmacies.get(cle)
+        if entree and entree['expire'] > time.monotonic():
+            return entree
+
+        produits = ProduitPharmacie.objects.filter(pharmacie_id=pharmacie_id).values(*self.CHAMPS)
+        codes, ids = {}, {}
+        for valeurs in produits:
+            fiche = self._fiche(valeurs)
+            codes[fiche['code_barre']] = fiche
+            ids[fiche['id']] = fiche['code_barre']
+
+        entree = {'expire': time.monotonic() + self.DUREE_VIE, 'codes': codes, 'ids': ids}
+        with self._verrou:
+            self._pharmacies[cle] = entree
+        return entree
+
+    def chercher(self, pharmacie_id, code):
+        """Fiche du produit portant ce code-barre dans la pharmacie, ou None."""
+        fiche = self._entree(pharmacie_id)['codes'].get(code)
+        if fiche is None:
+            valeurs = ProduitPharmacie.objects.filter(
+                pharmacie_id=pharmacie_id, code_barre=code
+            ).values(*self.CHAMPS).first()
+            if valeurs is None:
+                return None
+            fiche = self._fiche(valeurs)
+            self._placer(str(pharmacie_id), fiche)
+        return dict(fiche)
+
+    def _placer(self, cle, fiche):
+        with self._verrou:
+            entree = self._pharmacies.get(cle)
+            if entree is None:
+                return
+            ancien_code = entree['ids'].get(fiche['id'])
+            if ancien_code is not None and ancien_code != fiche['code_barre']:
+                entree['codes'].pop(ancien_code, None)
+            entree['codes'][fiche['code_barre']] = fiche
+            entree['ids'][fiche['id']] = fiche['code_barre']
+
+    def mettre_a_jour(self, produit):
+        """Remplace la fiche d'un produit modifié (sans effet si la pharmacie n'est pas chargée)."""
+        self._placer(str(produit.pharmacie_id), self._fiche({c: getattr(produit, c) for c in self.CHAMPS}))
+
+    def retirer(self, pharmacie_id, produit_id):
+        with self._verrou:
+            entree = self._pharmacies.get(str(pharmacie_id))
+            if entree is None:
+                return
+            code = entree['ids'].pop(str(produit_id), None)
+            if code is not None:
+                entree['codes'].pop(code, None)
+
+    def ajuster_stocks(self, pharmacie_id, stocks):
+        """Reporte les stocks après une vente (mise à jour par UPDATE, sans signal) : {produit_id: quantite}."""
+        with self._verrou:
+            entree = self._pharmacies.get(str(pharmacie_id))
+            if entree is None:
+                return
+            for produit_id, quantite in stocks.items():
+                code = entree['ids'].get(str(produit_id))
+                if code is not None:
+                    entree['codes'][code] = dict(entree['codes'][code], quantite=quantite)
+
+    def invalider(self, pharmacie_id=None):
+        with self._verrou:
+            if pharmacie_id is None:
+                self._pharmacies.clear()
+            else:
+                self._pharmacies.pop(str(pharmacie_id), None)
+
+
+index_codes_barres = IndexCodesBarres()
+
+
+######################## Recherche de produits (tolérante aux fautes) #############################
+import heapq
+import unicodedata
+from collections import Counter, defaultdict
+from django.db import connection
+from django.db.models.functions import Greatest
+from pharmacie.models import ProduitFabricant
+
+CHAMPS_RECHERCHE = ('id', 'nom_medicament', 'nom_fabricant', 'prix_vente', 'quantite', 'code_barre')
+SEUIL_SIMILARITE = 0.4
+
+
+def _normaliser(texte):
+    """Minuscules, sans accents, ponctuation remplacée par des espaces."""
+    texte = unicodedata.normalize('NFKD', texte or '')
+    texte = ''.join(c for c in texte if not unicodedata.combining(c)).lower()
+    return ''.join(c if c.isalnum() else ' ' for c in texte)
+
+
+def _trigrammes(texte):
+    """Trigrammes à la manière de pg_trgm : chaque mot est entouré de '  ' et ' '."""
+    resultat = set()
+    for mot in _normaliser(texte).split():
+        mot = f"  {mot} "
+        resultat.update(mot[i:i + 3] for i in range(len(mot) - 2))
+    return resultat
+
+
+class IndexRecherche:
     """
-    Impression thermique du BON DE COMMANDE (réception fournisseur)
-    Corps : Produit | Qté cmd | Qté reçue (cases)
+    Index n-grammes en mémoire (par processus) des noms de produits d'une pharmacie,
+    utilisé quand la base n'est pas PostgreSQL (SQLite en local).
+    Chargé à la première recherche (une requête), invalidé par les signaux
+    des produits et rechargé après DUREE_VIE secondes.
     """
-    try:
-        printer = Usb(0x1fc9, 0x2016)
+    DUREE_VIE = 300  # secondes
+
+    def __init__(self):
+        self._pharmacies = {}
+        self._verrou = threading.Lock()
+
+    def _entree(self, pharmacie_id):
+        cle = str(pharmacie_id)
+        entree = self._pharmacies.get(cle)
+        if entree and entree['expire'] > time.monotonic():
+            return entree
+
+        produits = []
+        postings = defaultdict(list)  # trigramme -> [(rang produit, champ)]
+        lignes = ProduitPharmacie.objects.filter(pharmacie_id=pharmacie_id).values_list(
+            'id', 'nom_medicament', 'produit_fabricant__nom'
+        )
+        for rang, (produit_id, nom, nom_fabricant) in enumerate(lignes):
+            tailles = []
+            for champ, texte in enumerate((nom, nom_fabricant)):
+                tri = _trigrammes(texte)
+                tailles.append(len(tri))
+                for t in tri:
+                    postings[t].append((rang, champ))
+            produits.append((produit_id, tailles))
+
+        entree = {'expire': time.monotonic() + self.DUREE_VIE, 'produits': produits, 'postings': dict(postings)}
+        with self._verrou:
+            self._pharmacies[cle] = entree
+        return entree
+
+    def rechercher(self, pharmacie_id, terme, limite):
+        """[(produit_id, score)] des `limite` meilleurs produits, score décroissant."""
+        requete = _trigrammes(terme)
+        if not requete:
+            return []
+        entree = self._entree(pharmacie_id)
+
+        # Nombre de trigrammes communs, par produit et par champ
+        communs = Counter()
+        for t in requete:
+            communs.update(entree['postings'].get(t, ()))
+
+        meilleurs = {}
+        for (rang, champ), n in communs.items():
+            couverture = n / len(requete)  # ≈ word_similarity de pg_trgm
+            if couverture < SEUIL_SIMILARITE:
+                continue
+            taille = entree['produits'][rang][1][champ]
+            jaccard = n / (len(requete) + taille - n)  # ≈ similarity : préfère les noms courts
+            meilleurs[rang] = max(meilleurs.get(rang, (0, 0)), (couverture, jaccard))
+
+        top = heapq.nlargest(limite, meilleurs.items(), key=lambda item: item[1])
+        return [(entree['produits'][rang][0], round(score[0], 3)) for rang, score in top]
+
+    def invalider(self, pharmacie_id=None):
+        with self._verrou:
+            if pharmacie_id is None:
+                self._pharmacies.clear()
+            else:
+                self._pharmacies.pop(str(pharmacie_id), None)
+
+
+index_recherche = IndexRecherche()
+
+
+def rechercher_produits(pharmacie_id, terme, limite=20):
+    """
+    Recherche tolérante aux fautes sur nom_medicament et le nom du produit fabricant.
+    - PostgreSQL : similarité pg_trgm (index GIN de la migration 0008)
+    - Autres bases : index n-grammes en mémoire
+    Retourne les fiches classées par score décroissant.
+    """
+    produits = ProduitPharmacie.objects.filter(pharmacie_id=pharmacie_id).annotate(
+        nom_fabricant=F('produit_fabricant__nom')
+    )
+
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        # Filtre par l'opérateur %> (servi par les index GIN gin_trgm_ops) au seuil
+        # SEUIL_SIMILARITE ; la similarité n'est calculée que pour classer les candidats.
+        fabricants = ProduitFabricant.objects.filter(nom__trigram_word_similar=terme).values('pk')
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s", [SEUIL_SIMILARITE])
+            resultats = list(
+                produits.filter(Q(nom_medicament__trigram_word_similar=terme) | Q(produit_fabricant__in=fabricants))
+                .annotate(score=Greatest(
+                    TrigramWordSimilarity(terme, 'nom_medicament'),
+                    TrigramWordSimilarity(terme, 'produit_fabricant__nom'),
+                ))
+                .order_by('-score', 'nom_medicament')
+                .values(*CHAMPS_RECHERCHE, 'score')[:limite]
+            )
+    else:
+        classement = index_recherche.rechercher(pharmacie_id, terme, limite)
+        # Prix et stock relus en base (une requête sur les seuls résultats)
+        fiches = {
+            p['id']: p for p in produits.filter(pk__in=[pk for pk, _ in classement]).values(*CHAMPS_RECHERCHE)
+        }
+        resultats = [dict(fiches[pk], score=score) for pk, score in classement if pk in fiches]
 
-        pharmacie = commande.pharmacie
-        fabricant = commande.fabricant
-        date_cmd = commande.date_commande.strftime("%d/%m/%Y %H:%M")
+    return resultats
 
-        # ==============================
-        # 🏥 EN-TÊTE
-        # ==============================
-        printer.set(align='center', bold=True)
-        printer.text("BON DE COMMANDE\n")
-        printer.set(bold=False)
-        printer.text("-" * 32 + "\n")
 
-        printer.set(align='left')
-        printer.text(f"Pharmacie : {pharmacie.nom_pharm}\n")
-        printer.text(f"Date      : {date_cmd}\n")
-        printer.text(f"Fabricant : {fabricant.nom}\n")
-        printer.text("-" * 32 + "\n")
+######################## Événements en direct (SSE) #############################
+from itertools import count
+from django.core.serializers.json import DjangoJSONEncoder
 
-        # ==============================
-        # 📦 CORPS (RÉCEPTION)
-        # ==============================
-        printer.set(bold=True)
-        printer.text(f"{'Produit':<16}{'Cmd':>5}{'Rec'}\n")
-        printer.set(bold=False)
-        printer.text("-" * 32 + "\n")
+BATTEMENT_SSE = 15      # secondes sans événement avant un commentaire ": ping" (garde la connexion ouverte)
+DUREE_MAX_SSE = 300     # secondes : le navigateur se reconnecte seul (EventSource), le worker est libéré
+RECONNEXION_SSE = 3000  # millisecondes avant reconnexion, transmis au navigateur (retry:)
+MAX_ABONNES_SSE = 4     # flux ouverts par processus : chacun garde un thread gunicorn (--threads 16)
+RECONNEXION_SATURE_SSE = 30000  # millisecondes avant nouvel essai quand MAX_ABONNES_SSE est atteint
 
-        for ligne in commande.lignes.all():
-            nom = ligne.produit_fabricant.nom[:16]
-            qte_cmd = ligne.quantite_commandee
 
-            # ⬜⬜⬜ = zone manuelle réception
-            printer.text(f"{nom:<16}{qte_cmd:>5}   [   ]\n")
+class BusEvenements:
+    """
+    Pub/sub en mémoire (par processus) des événements d'une pharmacie :
+    une file bornée par abonné (connexion SSE), alimentée par publier().
+    - Un abonné lent perd ses événements les plus anciens, jamais la caisse n'attend.
+    - Suffisant avec un seul worker ; pour plusieurs workers, un bus partagé
+      (ex. Redis pub/sub) doit offrir les mêmes méthodes abonner/desabonner/publier.
+    """
+    TAILLE_FILE = 100
+
+    def __init__(self):
+        self._abonnes = defaultdict(set)  # pharmacie_id -> {queue.Queue}
+        self._ids = count(1)
+        self._verrou = threading.Lock()
+
+    def abonner(self, pharmacie_id, limite=None):
+        """File du nouvel abonné, ou None si le processus compte déjà `limite` abonnés."""
+        file = queue.Queue(maxsize=self.TAILLE_FILE)
+        with self._verrou:
+            if limite is not None and self.nombre_abonnes() >= limite:
+                return None
+            self._abonnes[str(pharmacie_id)].add(file)
+        return file
+
+    def desabonner(self, pharmacie_id, file):
+        with self._verrou:
+            abonnes = self._abonnes.get(str(pharmacie_id))
+            if abonnes is not None:
+                abonnes.discard(file)
+                if not abonnes:
+                    del self._abonnes[str(pharmacie_id)]
+
+    def nombre_abonnes(self, pharmacie_id=None):
+        if pharmacie_id is None:
+            return sum(len(abonnes) for abonnes in list(self._abonnes.values()))
+        return len(self._abonnes.get(str(pharmacie_id), ()))
+
+    def publier(self, pharmacie_id, type_evenement, donnees):
+        with self._verrou:
+            abonnes = list(self._abonnes.get(str(pharmacie_id), ()))
+            evenement = (next(self._ids), type_evenement, donnees)
+        for file in abonnes:
+            while True:
+                try:
+                    file.put_nowait(evenement)
+                    break
+                except queue.Full:
+                    try:
+                        file.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+bus_evenements = BusEvenements()
+
+
+def publier_evenement(pharmacie_id, type_evenement, donnees):
+    """Publie l'événement après le commit : rien n'est poussé pour une transaction annulée."""
+    transaction.on_commit(lambda: bus_evenements.publier(pharmacie_id, type_evenement, donnees))
+
+
+def publier_mouvements_stock(pharmacie_id, mouvements):
+    """
+    mouvements : [(produit, quantite_avant)] avec produit.quantite déjà à jour.
+    Publie le stock des produits touchés ("stock") et ceux qui viennent de passer
+    sous leur seuil d'alerte ("alerte").
+    """
+    fiches, alertes = [], []
+    for produit, quantite_avant in mouvements:
+        fiche = {
+            'id': str(produit.pk),
+            'quantite': produit.quantite,
+            'en_alerte': produit.quantite <= produit.alerte_quantite,
+        }
+        fiches.append(fiche)
+        if fiche['en_alerte'] and (quantite_avant is None or quantite_avant > produit.alerte_quantite):
+            alertes.append(dict(fiche, nom_medicament=produit.nom_medicament))
+    if fiches:
+        publier_evenement(pharmacie_id, 'stock', {'produits': fiches})
+    if alertes:
+        publier_evenement(pharmacie_id, 'alerte', {'produits': alertes})
 
-        printer.text("-" * 32 + "\n")
 
-        # ==============================
-        # ✍️ SIGNATURE / RÉCEPTION
-        # ==============================
-        printer.text("\nReçu par : _______________\n")
-        printer.text("Date     : ____ / ____ / ____\n")
+class FluxEvenementsSSE:
+    """
+    Flux text/event-stream d'un abonné : un bloc par événement (id, event, data JSON),
+    un commentaire ": ping" toutes les BATTEMENT_SSE secondes, fin après DUREE_MAX_SSE secondes.
+    close() (appelé par Django à la fermeture de la réponse, même jamais lue) retire l'abonnement.
+    """
 
-        printer.text("\n\n")
-        printer.cut()
-        printer.close()
+    def __init__(self, pharmacie_id, file):
+        self.pharmacie_id = pharmacie_id
+        self.file = file
 
-    except Exception as e:
-        traceback.print_exc()
-        raise e
+    def __iter__(self):
+        try:
+            yield f"retry: {RECONNEXION_SSE}\n\n"
+            debut = time.monotonic()
+            while True:
+                restant = DUREE_MAX_SSE - (time.monotonic() - debut)
+                if restant <= 0:
+                    return
+                try:
+                    identifiant, type_evenement, donnees = self.file.get(timeout=min(BATTEMENT_SSE, restant))
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield (
+                    f"id: {identifiant}\nevent: {type_evenement}\n"
+                    f"data: {json.dumps(donnees, cls=DjangoJSONEncoder, separators=(',', ':'))}\n\n"
+                )
+        finally:
+            self.close()
+
+    def close(self):
+        bus_evenements.desabonner(self.pharmacie_id, self.file)
+
+
+def ouvrir_flux_sse(pharmacie_id):
+    """Abonne la pharmacie au bus ; None si MAX_ABONNES_SSE flux sont déjà ouverts dans ce processus."""
+    file = bus_evenements.abonner(pharmacie_id, limite=MAX_ABONNES_SSE)
+    return None if file is None else FluxEvenementsSSE(pharmacie_id, file)
 
 
 #########################-----Rapport Mensuel et Calcul Marge de Progretion ou regrestion----###############
@@ -77,6 +77,44 @@ class ProduitPharmacieViewSet(viewsets.ModelViewSet):
         serializer.save(pharmacie=self.request.user.pharmacie)
 
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from .utils import index_codes_barres
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def produit_par_code_barre(request, code):
+    """
+    Lecture d'un code-barre à la caisse : fiche servie depuis l'index en mémoire
+    (id, nom_medicament, prix_vente, quantite, code_barre), sans requête en base
+    quand le produit est indexé.
+    """
+    fiche = index_codes_barres.chercher(request.user.pharmacie_id, code)
+    if fiche is None:
+        return Response({"error": "Produit introuvable"}, status=404)
+    return Response(fiche)
+
+
+from .utils import rechercher_produits
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recherche_produits(request):
+    """
+    Recherche tolérante aux fautes de frappe : ?q=paracetmol&limite=20
+    Résultats classés (score décroissant) sur le nom du médicament et du produit fabricant.
+    """
+    terme = request.GET.get('q', '').strip()
+    if len(terme) < 2:
+        return Response([])
+
+    try:
+        limite = min(max(int(request.GET.get('limite', 20)), 1), 50)
+    except ValueError:
+        return Response({"error": "limite doit être un entier"}, status=400)
+
+    return Response(rechercher_produits(request.user.pharmacie_id, terme, limite))
+
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from .models import ProduitFabricant
@@ -119,6 +157,38 @@ class CommandeProduitViewSet(viewsets.ModelViewSet):
             logger.exception("❌ Erreur lors de la création de la commande : %s", str(e))
             raise
 
+    def perform_update(self, serializer):
+        # Brouillon repris à la main : plus remplacé par generer_propositions_commande
+        serializer.save(auto_genere=False)
+
+
+from django.db.models import Count, Sum, F, DecimalField
+from .utils import generer_propositions_commande
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def propositions_commande(request):
+    """
+    Génère les commandes brouillon (une par fabricant) à partir des suggestions
+    du rapport de stock de la pharmacie. Remplace les brouillons générés précédemment,
+    pas ceux créés ou modifiés à la main.
+    """
+    try:
+        commandes = generer_propositions_commande(request.user.pharmacie)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    resume = (
+        CommandeProduit.objects
+        .filter(pk__in=[c.pk for c in commandes])
+        .values('id', 'fabricant__nom')
+        .annotate(
+            nombre_lignes=Count('lignes'),
+            montant=Sum(F('lignes__quantite_commandee') * F('lignes__prix_achat'), output_field=DecimalField()),
+        )
+    )
+    return Response(list(resume), status=status.HTTP_201_CREATED)
+
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -156,8 +226,8 @@ class ImprimerCommandeAPIView(APIView):
                 pharmacie=request.user.pharmacie
             )
 
-            imprimer_commande_thermique(commande)
-            return Response({"status": "imprimé"}, status=status.HTTP_200_OK)
+            travail_id = imprimer_commande_thermique(commande)
+            return Response({"status": "en_file", "travail_id": travail_id}, status=status.HTTP_202_ACCEPTED)
 
         except CommandeProduit.DoesNotExist:
             return Response(
@@ -170,6 +240,36 @@ class ImprimerCommandeAPIView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+from .utils import spouleur_impression
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def statut_impression(request):
+    """
+    État du spouleur d'impression de ce processus :
+    thread actif, imprimante connectée, travaux en attente et derniers travaux.
+    """
+    return Response(spouleur_impression.statut())
+
+
+from .models import VenteProduit
+from .utils import reimprimer_ticket_vente
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def reimprimer_vente(request, pk):
+    """Remet en file le ticket déjà rendu d'une vente de la pharmacie."""
+    try:
+        vente = VenteProduit.objects.select_related('pharmacie', 'client').get(
+            pk=pk,
+            pharmacie=request.user.pharmacie
+        )
+    except VenteProduit.DoesNotExist:
+        return Response({"error": "Vente introuvable"}, status=status.HTTP_404_NOT_FOUND)
+
+    travail_id = reimprimer_ticket_vente(vente)
+    return Response({"status": "en_file", "travail_id": travail_id}, status=status.HTTP_202_ACCEPTED)
+
 ###################"Recption de Medicamennt du commande"####################""
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -197,6 +297,10 @@ class ConfirmerReceptionView(APIView):
             if commande.pharmacie != request.user.pharmacie:
                 return Response({"error": "Cette commande ne vous appartient pas."}, status=403)
 
+            # Un brouillon n'a pas été passé au fournisseur : rien à réceptionner
+            if commande.etat == 'brouillon':
+                return Response({"error": "Commande brouillon : à valider avant réception."}, status=400)
+
             commande.etat = 'confirmee'
             commande.save()
 
@@ -281,11 +385,30 @@ class VenteProduitViewSet(viewsets.ModelViewSet):
             client=client
         )
 
+from django.db import IntegrityError, transaction
+
 class VenteCreateAPIView(generics.CreateAPIView):
     queryset = VenteProduit.objects.all()
     serializer_class = VenteProduitSerializer
     permission_classes = [IsAuthenticated]
 
+    def create(self, request, *args, **kwargs):
+        # 🔁 Renvoi d'une vente déjà enregistrée (timeout, double clic) : on la retourne telle quelle
+        cle = request.data.get('cle_idempotence')
+        if cle:
+            vente = VenteProduit.objects.filter(pharmacie=request.user.pharmacie, cle_idempotence=cle).first()
+            if vente:
+                return Response(self.get_serializer(vente).data, status=status.HTTP_200_OK)
+
+        try:
+            return super().create(request, *args, **kwargs)
+        except IntegrityError:
+            # Deux envois simultanés de la même vente : le second retrouve le premier
+            vente = VenteProduit.objects.filter(pharmacie=request.user.pharmacie, cle_idempotence=cle).first()
+            if not cle or vente is None:
+                raise
+            return Response(self.get_serializer(vente).data, status=status.HTTP_200_OK)
+
     def perform_create(self, serializer):
         client_id = self.request.data.get('client')
         client = None
@@ -305,6 +428,123 @@ class VenteCreateAPIView(generics.CreateAPIView):
         )
 
 
+from datetime import timedelta
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+class VenteLotAPIView(APIView):
+    """
+    Synchronisation des ventes enregistrées hors ligne par une caisse.
+
+    POST {"ventes": [{"cle_idempotence": "...", "date_vente": "2025-01-31T14:05:00+01:00",
+                      "lignes": [...], "client": ...}, ...]}
+
+    date_vente (heure de la vente sur la caisse) est enregistrée telle quelle :
+    les cumuls du jour, rapports et historiques la comptent au bon jour. Absente,
+    l'heure de synchronisation est utilisée ; refusée si elle est dans le futur
+    (au-delà de DERIVE_HORLOGE) ou plus ancienne que AGE_MAX_VENTE.
+
+    Les ventes sont traitées par paquets de TAILLE_PAQUET dans une transaction
+    par paquet (un point de sauvegarde par vente : une vente refusée n'annule
+    pas les autres). Une vente dont la clé est déjà connue n'est pas recréée.
+    Résultat par vente : statut 'cree', 'doublon' ou 'erreur'.
+    """
+    permission_classes = [IsAuthenticated]
+    TAILLE_PAQUET = 50
+    VENTES_MAX = 1000
+    DERIVE_HORLOGE = timedelta(minutes=5)  # avance tolérée de l'horloge de la caisse
+    AGE_MAX_VENTE = timedelta(days=7)
+
+    def post(self, request):
+        ventes = request.data.get('ventes')
+        if not isinstance(ventes, list) or not ventes:
+            return Response({"error": "ventes doit être une liste non vide"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ventes) > self.VENTES_MAX:
+            return Response(
+                {"error": f"{self.VENTES_MAX} ventes maximum par envoi"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        pharmacie = request.user.pharmacie
+        resultats = []
+        for debut in range(0, len(ventes), self.TAILLE_PAQUET):
+            resultats.extend(self._traiter_paquet(request, pharmacie, ventes[debut:debut + self.TAILLE_PAQUET]))
+
+        return Response({
+            "crees": sum(r['statut'] == 'cree' for r in resultats),
+            "doublons": sum(r['statut'] == 'doublon' for r in resultats),
+            "erreurs": sum(r['statut'] == 'erreur' for r in resultats),
+            "resultats": resultats,
+        })
+
+    def _date_vente(self, donnees):
+        valeur = donnees.get('date_vente')
+        if not valeur:
+            return timezone.now()
+        try:
+            date_vente = parse_datetime(str(valeur))
+        except ValueError:
+            date_vente = None
+        if date_vente is None:
+            raise serializers.ValidationError({'date_vente': ["Date invalide (format ISO 8601 attendu)"]})
+        if timezone.is_naive(date_vente):
+            date_vente = timezone.make_aware(date_vente)
+
+        maintenant = timezone.now()
+        if date_vente > maintenant + self.DERIVE_HORLOGE:
+            raise serializers.ValidationError({'date_vente': ["Date de vente dans le futur"]})
+        if date_vente < maintenant - self.AGE_MAX_VENTE:
+            raise serializers.ValidationError(
+                {'date_vente': [f"Vente de plus de {self.AGE_MAX_VENTE.days} jours : à saisir manuellement"]}
+            )
+        return date_vente
+
+    def _traiter_paquet(self, request, pharmacie, ventes):
+        cles = [v.get('cle_idempotence') for v in ventes if isinstance(v, dict) and v.get('cle_idempotence')]
+        # 🔹 Clés déjà enregistrées, en une seule requête pour tout le paquet
+        connues = dict(
+            VenteProduit.objects.filter(pharmacie=pharmacie, cle_idempotence__in=cles)
+            .values_list('cle_idempotence', 'id')
+        )
+
+        resultats = []
+        with transaction.atomic():
+            for donnees in ventes:
+                cle = donnees.get('cle_idempotence') if isinstance(donnees, dict) else None
+                if not cle:
+                    resultats.append({"cle_idempotence": cle, "statut": "erreur",
+                                      "erreurs": ["cle_idempotence requise"]})
+                    continue
+                if cle in connues:
+                    resultats.append({"cle_idempotence": cle, "statut": "doublon", "vente_id": connues[cle]})
+                    continue
+
+                serializer = VenteProduitSerializer(
+                    data=donnees,
+                    context={'request': request, 'imprimer_ticket': False}
+                )
+                try:
+                    with transaction.atomic():
+                        date_vente = self._date_vente(donnees)
+                        serializer.is_valid(raise_exception=True)
+                        vente = serializer.save(utilisateur=request.user, date_vente=date_vente)
+                except serializers.ValidationError as e:
+                    resultats.append({"cle_idempotence": cle, "statut": "erreur", "erreurs": e.detail})
+                    continue
+                except IntegrityError:
+                    # Même clé envoyée en parallèle par une autre requête
+                    vente_id = VenteProduit.objects.filter(
+                        pharmacie=pharmacie, cle_idempotence=cle
+                    ).values_list('id', flat=True).first()
+                    resultats.append({"cle_idempotence": cle, "statut": "doublon", "vente_id": vente_id})
+                    continue
+
+                connues[cle] = vente.id
+                resultats.append({"cle_idempotence": cle, "statut": "cree", "vente_id": vente.id})
+
+        return resultats
+
+
 
 
 
@@ -345,14 +585,14 @@ def imprimer_proformat(request):
             "prix_unitaire": float(l["prix_unitaire"])
         })
 
-    # Impression
-    imprimer_ticket_proformat(
+    # Impression (mise en file, le spouleur imprime en arrière-plan)
+    travail_id = imprimer_ticket_proformat(
         pharmacie=pharmacie,
         client=data.get("client"),
         lignes=lignes_clean
     )
 
-    return Response({"message": "Proformat imprimé avec succès"})
+    return Response({"message": "Proformat envoyé à l'imprimante", "travail_id": travail_id}, status=202)
 
 
 ################# Historique de la vente #######################
@@ -368,9 +608,28 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.utils.dateparse import parse_date
 from .serializers import HistoriqueVenteSerializer, HistoriqueDepenseSerializer
+from django.db.models import Prefetch
+from rest_framework.pagination import CursorPagination
+from .models import VenteLigne
+
+class HistoriqueVentesPagination(CursorPagination):
+    """
+    Pagination par curseur sur (date_vente, id) : chaque page filtre à partir de la
+    position du curseur au lieu de sauter N lignes (temps constant quelle que soit la page).
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = ('-date_vente', '-id')
+
 
 # views.py
 class HistoriqueVentesAPIView(APIView):
+    """
+    Historique des ventes et dépenses (?date_debut=&date_fin=).
+    Avec ?cursor= ou ?page_size= : ventes seules, paginées par curseur
+    ({next, previous, results}) ; les dépenses restent sur l'appel sans pagination.
+    """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -399,7 +658,18 @@ class HistoriqueVentesAPIView(APIView):
             except:
                 pass
 
-        ventes = ventes.order_by('-date_vente')
+        # Utilisateur, client et produits chargés avec la page : nombre de requêtes constant
+        ventes = (
+            ventes.defer('ticket_escpos')
+            .select_related('utilisateur', 'client')
+            .prefetch_related(Prefetch('lignes', queryset=VenteLigne.objects.select_related('produit')))
+            .order_by('-date_vente', '-id')
+        )
+
+        if 'cursor' in request.GET or 'page_size' in request.GET:
+            paginator = HistoriqueVentesPagination()
+            page = paginator.paginate_queryset(ventes, request, view=self)
+            return paginator.get_paginated_response(HistoriqueVenteSerializer(page, many=True).data)
 
         # --- DÉPENSES ---
         depenses = Depense.objects.filter(pharmacie=pharmacie)
@@ -424,6 +694,66 @@ class HistoriqueVentesAPIView(APIView):
             "depenses": depenses_serialized,
         })
 
+##################### Exports en flux (comptable) #################
+from .utils import (
+    TYPES_EXPORT, reponse_export,
+    ENTETES_EXPORT_VENTES, lignes_export_ventes,
+    ENTETES_EXPORT_STOCK, lignes_export_stock,
+)
+
+def _type_export(request):
+    # « type » et non « format » : DRF réserve ?format= au choix du renderer
+    type_export = request.GET.get('type', 'csv')
+    return type_export if type_export in TYPES_EXPORT else None
+
+
+def _date_export(request, nom):
+    valeur = request.GET.get(nom)
+    if not valeur:
+        return None
+    jour = parse_date(valeur)  # ValueError si la date n'existe pas
+    if jour is None:
+        raise ValueError(valeur)
+    return jour
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_historique_ventes(request):
+    """
+    API : /api/export/ventes/?type=csv|ndjson&date_debut=2025-01-01&date_fin=2025-12-31
+    Historique des ventes ligne par ligne, envoyé en flux (mémoire constante).
+    """
+    type_export = _type_export(request)
+    if type_export is None:
+        return Response({"error": "type doit être csv ou ndjson"}, status=400)
+
+    try:
+        date_debut = _date_export(request, 'date_debut')
+        date_fin = _date_export(request, 'date_fin')
+    except ValueError:
+        return Response({"error": "Dates au format AAAA-MM-JJ"}, status=400)
+
+    lignes = lignes_export_ventes(request.user.pharmacie, date_debut, date_fin)
+    return reponse_export(type_export, ENTETES_EXPORT_VENTES, lignes, "historique_ventes")
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_rapport_stock(request):
+    """API : /api/export/rapport-stock/?type=csv|ndjson&days=30"""
+    type_export = _type_export(request)
+    if type_export is None:
+        return Response({"error": "type doit être csv ou ndjson"}, status=400)
+
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        return Response({"error": "days doit être un entier"}, status=400)
+
+    lignes = lignes_export_stock(request.user.pharmacie, days)
+    return reponse_export(type_export, ENTETES_EXPORT_STOCK, lignes, f"rapport_stock_{days}j")
+
 ##################" Statistique Vente #################"
 class ProduitPharmacieListAPIView(generics.ListAPIView):
     serializer_class = ProduitsPharmacieSerializer
@@ -625,69 +955,159 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from datetime import date
 from django.db.models import Sum, F
-from .models import VenteProduit, VenteLigne
+from django.utils import timezone
+from .models import VenteProduit, VenteLigne, VenteJournaliere, StatistiqueJournaliere
+from .utils import analyse_en_cache
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def statistiques_du_jour(request):
+    """
+    Compteurs du jour tenus à jour à chaque vente (StatistiqueJournaliere) :
+    une seule ligne lue, quelle que soit l'activité de la journée.
+    """
     user = request.user
     pharmacie = user.pharmacie  # ou lié via profil
 
-    today = date.today()
+    stats = (
+        StatistiqueJournaliere.objects
+        .select_related('produit_plus_vendu')
+        .filter(pharmacie=pharmacie, jour=timezone.localdate())
+        .first()
+    ) or StatistiqueJournaliere(pharmacie=pharmacie)
 
-    ventes_du_jour = VenteProduit.objects.filter(
-        pharmacie=pharmacie,
-        date_vente__date=today
-    )
+    return Response({
+        "chiffre_affaire": stats.chiffre_affaires,
+        "benefice": stats.benefice,
+        "total_ventes": stats.total_ventes,
+        "nombre_ventes": stats.nombre_ventes,
+        "produit_plus_vendu": stats.produit_plus_vendu.nom_medicament if stats.produit_plus_vendu else "Aucun"
+    })
+
+
+################## Rapport Générale ######################################"
+# views.py
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+from datetime import date, timedelta
+from django.db.models import Sum, F, Count, DecimalField
+from django.db.models.functions import TruncHour, TruncWeek, TruncMonth
+from .models import VenteProduit, VenteLigne
+from .utils import bornes_locales
 
-    total_ventes = ventes_du_jour.aggregate(total=Sum('montant_total'))['total'] or 0
+GRANULARITES_RAPPORT = ('heure', 'jour', 'semaine', 'mois')
+MAX_JOURS_PAR_HEURE = 31  # au-delà, la série horaire lirait trop de ventes brutes
 
-    lignes_du_jour = VenteLigne.objects.filter(
-        vente__in=ventes_du_jour
+
+def _serie_horaire(pharmacie, date_debut, date_fin):
+    """
+    Série par heure depuis les ventes brutes : une seule requête groupée sur la
+    jointure ventes/lignes. La jointure répète chaque vente par ligne : les ventes
+    sont comptées distinctes et le total vient des lignes (montant_total est leur
+    somme, cf. VenteProduitSerializer.create).
+    """
+    debut, fin = bornes_locales(date_debut, date_fin)
+    montant = DecimalField(max_digits=14, decimal_places=2)
+
+    return (
+        VenteProduit.objects
+        .filter(pharmacie=pharmacie, date_vente__gte=debut, date_vente__lt=fin)
+        .annotate(periode=TruncHour('date_vente'))
+        .values('periode')
+        .annotate(
+            nombre_ventes=Count('id', distinct=True),
+            total_ventes=Sum('lignes__total'),
+            chiffre_affaire=Sum('lignes__total'),
+            cout=Sum(F('lignes__quantite') * F('lignes__prix_achat_unitaire'), output_field=montant),
+        )
+        .order_by('periode')
     )
 
-    chiffre_affaire = lignes_du_jour.aggregate(total=Sum('total'))['total'] or 0
 
-    # Bénéfice = (Prix_vente - Prix_achat) * quantite
-    lignes = lignes_du_jour.annotate(
-        benefice_unitaire=(F('prix_unitaire') - F('produit__prix_achat')) * F('quantite')
+def _serie_journaliere(pharmacie, date_debut, date_fin, granularite):
+    """Série par jour/semaine/mois depuis les compteurs du jour (StatistiqueJournaliere)."""
+    stats = StatistiqueJournaliere.objects.filter(pharmacie=pharmacie, jour__gte=date_debut, jour__lte=date_fin)
+    if granularite == 'jour':
+        stats = stats.annotate(periode=F('jour'))
+    else:
+        stats = stats.annotate(periode={'semaine': TruncWeek, 'mois': TruncMonth}[granularite]('jour'))
+    return (
+        stats.values('periode')
+        .annotate(
+            nombre_ventes=Sum('nombre_ventes'),
+            total_ventes=Sum('total_ventes'),
+            chiffre_affaire=Sum('chiffre_affaires'),
+            cout=Sum('cout'),
+        )
+        .order_by('periode')
     )
-    benefice = lignes.aggregate(total=Sum('benefice_unitaire'))['total'] or 0
 
-    # Produit le plus vendu
+
+@analyse_en_cache('rapport_general')
+def calculer_rapport_general(pharmacie, date_debut, date_fin, granularite='jour'):
+    """
+    Totaux et série de la période [date_debut, date_fin] : une requête groupée pour
+    la série (les totaux en sont la somme) et une pour le produit le plus vendu.
+    Les séries par jour/semaine/mois lisent les tables pré-agrégées, quelle que
+    soit la longueur de la période ; seule la série horaire lit les ventes.
+    """
+    if granularite == 'heure':
+        lignes = _serie_horaire(pharmacie, date_debut, date_fin)
+    else:
+        lignes = _serie_journaliere(pharmacie, date_debut, date_fin, granularite)
+
+    serie = [
+        {
+            "periode": l['periode'],
+            "nombre_ventes": l['nombre_ventes'] or 0,
+            "total_ventes": l['total_ventes'] or 0,
+            "chiffre_affaire": l['chiffre_affaire'] or 0,
+            "benefice": (l['chiffre_affaire'] or 0) - (l['cout'] or 0),
+        }
+        for l in lignes
+    ]
+
     produit_plus_vendu = (
-        lignes_du_jour.values('produit__nom_medicament')
+        VenteJournaliere.objects
+        .filter(pharmacie=pharmacie, jour__gte=date_debut, jour__lte=date_fin)
+        .values('produit__nom_medicament')
         .annotate(qte=Sum('quantite'))
         .order_by('-qte')
         .first()
     )
 
-    return Response({
-        "chiffre_affaire": chiffre_affaire,
-        "benefice": benefice,
-        "total_ventes": total_ventes,
-        "produit_plus_vendu": produit_plus_vendu['produit__nom_medicament'] if produit_plus_vendu else "Aucun"
-    })
-
+    return {
+        "chiffre_affaire": sum(p['chiffre_affaire'] for p in serie),
+        "benefice": sum(p['benefice'] for p in serie),
+        "total_ventes": sum(p['total_ventes'] for p in serie),
+        "nombre_ventes": sum(p['nombre_ventes'] for p in serie),
+        "produit_plus_vendu": produit_plus_vendu['produit__nom_medicament'] if produit_plus_vendu else "Aucun",
+        "serie": serie,
+    }
 
-################## Rapport Générale ######################################"
-# views.py
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.response import Response
-from datetime import date, timedelta
-from django.db.models import Sum, F
-from .models import VenteProduit, VenteLigne
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def rapport_general(request):
+    """
+    API : /api/rapport-general/?periode=jour|semaine|mois
+          /api/rapport-general/?date_debut=2025-01-01&date_fin=2025-03-31&granularite=heure|jour|semaine|mois
+    """
     user = request.user
     pharmacie = user.pharmacie  # Assurez-vous que l'utilisateur est lié à une pharmacie
 
     periode = request.GET.get('periode', 'jour')
-    today = date.today()
+    today = timezone.localdate()
 
-    if periode == 'jour':
+    try:
+        date_debut = _date_export(request, 'date_debut')
+        date_fin = _date_export(request, 'date_fin') or today
+    except ValueError:
+        return Response({'error': 'Date invalide (format AAAA-MM-JJ)'}, status=400)
+
+    if date_debut is not None:
+        periode = 'personnalisee'
+    elif periode == 'jour':
         date_debut = today
     elif periode == 'semaine':
         date_debut = today - timedelta(days=today.weekday())
@@ -696,38 +1116,21 @@ def rapport_general(request):
     else:
         return Response({'error': 'Période invalide'}, status=400)
 
-    ventes = VenteProduit.objects.filter(
-        pharmacie=pharmacie,
-        date_vente__date__gte=date_debut,
-        date_vente__date__lte=today
-    )
-
-    total_ventes = ventes.aggregate(total=Sum('montant_total'))['total'] or 0
+    if date_debut > date_fin:
+        return Response({'error': 'date_debut doit précéder date_fin'}, status=400)
 
-    lignes = VenteLigne.objects.filter(vente__in=ventes)
-
-    chiffre_affaire = lignes.aggregate(total=Sum('total'))['total'] or 0
-
-    lignes = lignes.annotate(
-        benefice_unitaire=(F('prix_unitaire') - F('produit__prix_achat')) * F('quantite')
-    )
-    benefice = lignes.aggregate(total=Sum('benefice_unitaire'))['total'] or 0
-
-    produit_plus_vendu = (
-        lignes.values('produit__nom_medicament')
-        .annotate(qte=Sum('quantite'))
-        .order_by('-qte')
-        .first()
-    )
+    granularite = request.GET.get('granularite', 'heure' if date_debut == date_fin else 'jour')
+    if granularite not in GRANULARITES_RAPPORT:
+        return Response({'error': 'Granularité invalide'}, status=400)
+    if granularite == 'heure' and (date_fin - date_debut).days >= MAX_JOURS_PAR_HEURE:
+        return Response({'error': f'Granularité horaire limitée à {MAX_JOURS_PAR_HEURE} jours'}, status=400)
 
     return Response({
         "periode": periode,
         "date_debut": date_debut,
-        "date_fin": today,
-        "chiffre_affaire": chiffre_affaire,
-        "benefice": benefice,
-        "total_ventes": total_ventes,
-        "produit_plus_vendu": produit_plus_vendu['produit__nom_medicament'] if produit_plus_vendu else "Aucun"
+        "date_fin": date_fin,
+        "granularite": granularite,
+        **calculer_rapport_general(pharmacie, date_debut, date_fin, granularite),
     })
 
 from rest_framework.views import APIView
@@ -839,7 +1242,11 @@ from .serializers import MouvementCommandeSerializer
 @permission_classes([IsAuthenticated])
 def historique_mouvements(request):
     pharmacie = request.user.pharmacie
-    commandes = CommandeProduit.objects.filter(pharmacie=pharmacie).order_by('-date_commande')
+    commandes = (
+        CommandeProduit.objects.filter(pharmacie=pharmacie)
+        .exclude(etat='brouillon')  # propositions pas encore passées au fournisseur
+        .order_by('-date_commande')
+    )
     serializer = MouvementCommandeSerializer(commandes, many=True)
     return Response(serializer.data)
 
@@ -893,37 +1300,70 @@ def delete_all_requisitions(request):
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.db.models import Sum, Count
-from django.db.models.functions import TruncDay, TruncWeek, TruncMonth
-from .models import VenteProduit
+from django.db.models.functions import TruncWeek, TruncMonth
+from rest_framework.pagination import PageNumberPagination
+from .models import VenteProduit, VenteUtilisateurJournaliere
+
+class HistoriqueCaissierPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
 
-@permission_classes([IsAuthenticated])
 @api_view(['GET'])
+@permission_classes([IsAuthenticated])
 def historique_ventes(request):
+    """
+    API : /api/historique-ventes/caissier/?utilisateur=<id>&date_debut=&date_fin=&page=&page_size=
+    Séries jour/semaine/mois lues dans les cumuls par caissier (VenteUtilisateurJournaliere)
+    et détail des ventes paginé, sur une période bornée (30 derniers jours par défaut).
+    """
     utilisateur_id = request.GET.get('utilisateur')
 
     if not utilisateur_id:
         return Response({"error": "Utilisateur ID manquant."}, status=400)
 
-    ventes = VenteProduit.objects.filter(utilisateur_id=utilisateur_id)
+    try:
+        date_fin = _date_export(request, 'date_fin') or timezone.localdate()
+        date_debut = _date_export(request, 'date_debut') or date_fin - timedelta(days=30)
+    except ValueError:
+        return Response({"error": "Dates au format AAAA-MM-JJ"}, status=400)
+
+    cumuls = VenteUtilisateurJournaliere.objects.filter(
+        pharmacie=request.user.pharmacie, utilisateur_id=utilisateur_id, jour__range=(date_debut, date_fin)
+    )
 
-    par_jour = ventes.annotate(jour=TruncDay('date_vente')).values('jour').annotate(
-        total=Sum('montant_total'), nb=Count('id')
-    ).order_by('-jour')
+    par_jour = cumuls.values('jour').annotate(total=Sum('total'), nb=Sum('nombre_ventes')).order_by('-jour')
 
-    par_semaine = ventes.annotate(semaine=TruncWeek('date_vente')).values('semaine').annotate(
-        total=Sum('montant_total'), nb=Count('id')
+    par_semaine = cumuls.annotate(semaine=TruncWeek('jour')).values('semaine').annotate(
+        total=Sum('total'), nb=Sum('nombre_ventes')
     ).order_by('-semaine')
 
-    par_mois = ventes.annotate(mois=TruncMonth('date_vente')).values('mois').annotate(
-        total=Sum('montant_total'), nb=Count('id')
+    par_mois = cumuls.annotate(mois=TruncMonth('jour')).values('mois').annotate(
+        total=Sum('total'), nb=Sum('nombre_ventes')
     ).order_by('-mois')
 
+    debut, fin = bornes_locales(date_debut, date_fin)
+    ventes = (
+        VenteProduit.objects
+        .filter(
+            pharmacie=request.user.pharmacie, utilisateur_id=utilisateur_id,
+            date_vente__gte=debut, date_vente__lt=fin,
+        )
+        .defer('ticket_escpos')
+        .select_related('client')
+        .prefetch_related('lignes__produit')
+        .order_by('-date_vente', '-id')
+    )
+    paginator = HistoriqueCaissierPagination()
+    page = paginator.paginate_queryset(ventes, request)
+
     details = [
         {
             "id": v.id,
             "date": v.date_vente,
             "montant_total": v.montant_total,
-            "client": v.client.nom_client if v.client else "N/A",
+            "client": v.client.nom_complet if v.client else "N/A",
             "lignes": [
                 {
                     "produit": l.produit.nom_medicament,
@@ -933,13 +1373,18 @@ def historique_ventes(request):
                 for l in v.lignes.all()
             ]
         }
-        for v in ventes.select_related('client').prefetch_related('lignes__produit')
+        for v in page
     ]
 
     return Response({
+        "date_debut": date_debut,
+        "date_fin": date_fin,
         "par_jour": list(par_jour),
         "par_semaine": list(par_semaine),
         "par_mois": list(par_mois),
+        "count": paginator.page.paginator.count,
+        "next": paginator.get_next_link(),
+        "previous": paginator.get_previous_link(),
         "details": details
     })
 
@@ -1438,20 +1883,37 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from decimal import Decimal
-from .models import ProduitPharmacie
+from django.db.models import Sum
+from .models import ValorisationStock
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def stock_total(request):
+    """
+    API : /api/stock-total/?par=categorie|localisation
+    Valeur du stock tenue à jour (ValorisationStock) : quelques lignes lues,
+    quelle que soit la taille du catalogue.
+    """
     pharmacie = request.user.pharmacie  # suppose que l'utilisateur a un champ pharmacie
-    produits = ProduitPharmacie.objects.filter(pharmacie=pharmacie)
+    valorisations = ValorisationStock.objects.filter(pharmacie=pharmacie)
 
-    montant_total = Decimal('0.00')
-    for produit in produits:
-        if produit.prix_vente:
-            montant_total += produit.quantite * produit.prix_vente
+    totaux = valorisations.aggregate(vente=Sum('valeur_vente'), achat=Sum('valeur_achat'))
+    data = {
+        'montant_stock': round(totaux['vente'] or Decimal('0.00'), 2),
+        'montant_stock_achat': round(totaux['achat'] or Decimal('0.00'), 2),
+    }
+
+    par = request.GET.get('par')
+    if par:
+        if par not in ('categorie', 'localisation'):
+            return Response({'error': "par doit être 'categorie' ou 'localisation'"}, status=400)
+        data[f'par_{par}'] = list(
+            valorisations.values(par)
+            .annotate(quantite=Sum('quantite'), valeur_vente=Sum('valeur_vente'), valeur_achat=Sum('valeur_achat'))
+            .order_by('-valeur_vente')
+        )
 
-    return Response({'montant_stock': round(montant_total, 2)})
+    return Response(data)
 
 
 from rest_framework import viewsets, permissions
@@ -1501,7 +1963,8 @@ from pharmacie.models import (
 from .utils import seasonal_analysis
 
 
-from django.db.models import Sum, Max, Min
+from datetime import timedelta
+from django.db.models import Sum, Max, Min, Q
 from django.utils import timezone
 from rest_framework.decorators import api_view
 from django.shortcuts import get_object_or_404
@@ -1509,59 +1972,67 @@ from django.http import JsonResponse
 from pharmacie.models import Pharmacie, ProduitPharmacie, ProduitFabricant, CommandeProduitLigne, VenteLigne
 from .utils import seasonal_analysis
 
-@api_view(["GET"])
-def analyse_stock_api(request, pharmacie_id):
+from django.core.paginator import Paginator, InvalidPage
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import permission_classes
+from .models import VenteJournaliere
+from .utils import analyse_en_cache, seasonal_profile
+
+TRIS_ANALYSE_STOCK = {
+    'nom', 'stock_disponible', 'derniere_commande', 'derniere_vente',
+    'jours_depuis_derniere_vente', 'temps_total_en_officine', 'total_ventes',
+    'pourcentage', 'categorie', 'statut', 'multiplicateur_saisonnier',
+}
+
+
+@analyse_en_cache('analyse_stock')
+def calculer_analyse_stock(pharmacie, days):
     """
-    API : /api/analyse-stock/<pharmacie_id>/?days=30
-    Analyse la rotation des produits :
-      - Basée sur les commandes et les ventes
-      - Montre les produits inactifs
-      - Calcule la catégorie ABC selon le volume de ventes
+    Analyse de rotation de tous les produits de la pharmacie en requêtes groupées
+    (produits, commandes, ventes, saisonnalité par produit et globale) : leur nombre
+    ne dépend pas du catalogue. total_ventes et la classification ABC portent sur
+    les `days` derniers jours (aujourd'hui compris).
     """
-    pharmacie = get_object_or_404(Pharmacie, pk=pharmacie_id)
+    today = timezone.localdate()
 
-    try:
-        days = int(request.GET.get('days', 30))
-    except ValueError:
-        days = 30
+    produits = ProduitPharmacie.objects.filter(pharmacie=pharmacie).values(
+        'id', 'nom_medicament', 'quantite', 'produit_fabricant_id'
+    )
 
-    today = timezone.now().date()
-    produits_data = []
+    # Première / dernière commande de chaque produit fabricant, pour cette pharmacie
+    commandes = {
+        c['produit_fabricant']: c
+        for c in CommandeProduitLigne.objects
+        .filter(commande__pharmacie=pharmacie)
+        .values('produit_fabricant')
+        .annotate(last_date=Max('commande__date_commande'), first_date=Min('commande__date_commande'))
+    }
 
-    # Tous les produits de cette pharmacie
-    produits = ProduitPharmacie.objects.filter(pharmacie=pharmacie)
+    # Dernière vente (tout l'historique) + volume vendu sur les `days` derniers jours
+    debut_periode = today - timedelta(days=days - 1)
+    ventes = {
+        v['produit']: v
+        for v in VenteJournaliere.objects
+        .filter(pharmacie=pharmacie)
+        .values('produit')
+        .annotate(last_date=Max('derniere_vente'), total=Sum('quantite', filter=Q(jour__gte=debut_periode)))
+    }
 
-    ventes_totales = []
+    # Multiplicateur saisonnier (pic mensuel / moyenne) de chaque produit, une requête
+    profil = seasonal_profile(pharmacie, months_back=12)
+    multiplicateurs = dict(zip(profil['produit_ids'], profil['multiplier'].tolist()))
+
+    produits_data = []
     total_global_ventes = 0
 
-    # 🔹 Étape 1 : Récupérer données de base et volume de ventes
     for prod in produits:
-        fabricants_ids = ProduitFabricant.objects.filter(
-            produitpharmacie=prod
-        ).values_list('id', flat=True)
-
-        # Dernière commande
-        last_cmd = CommandeProduitLigne.objects.filter(
-            produit_fabricant_id__in=fabricants_ids
-        ).aggregate(
-            last_date=Max('commande__date_commande'),
-            first_date=Min('commande__date_commande')
-        )
-
-        last_cmd_date = last_cmd['last_date']
-        first_cmd_date = last_cmd['first_date']
-
-        # Dernière vente + volume total vendu
-        ventes = VenteLigne.objects.filter(
-            vente__pharmacie=pharmacie,
-            produit=prod
-        )
-        last_sale = ventes.aggregate(last_date=Max('vente__date_vente'))
-        last_sale_date = last_sale['last_date']
+        cmd = commandes.get(prod['produit_fabricant_id'], {})
+        last_cmd_date = cmd.get('last_date')
+        first_cmd_date = cmd.get('first_date')
 
-        # ✅ Correction ici : champ réel = quantite_vendue
-        total_ventes = ventes.aggregate(total=Sum('quantite'))['total'] or 0
-        ventes_totales.append((prod, total_ventes))
+        vente = ventes.get(prod['id'], {})
+        last_sale_date = vente.get('last_date')
+        total_ventes = vente.get('total') or 0
         total_global_ventes += total_ventes
 
         # Calcul des jours
@@ -1579,18 +2050,19 @@ def analyse_stock_api(request, pharmacie_id):
             statut = "✅ Produit en mouvement"
 
         produits_data.append({
-            'produit_id': prod.id,
-            'nom': str(prod),
-            'stock_disponible': getattr(prod, 'quantite', None),
+            'produit_id': prod['id'],
+            'nom': f"{prod['nom_medicament']} - {pharmacie.nom_pharm}",
+            'stock_disponible': prod['quantite'],
             'derniere_commande': str(last_cmd_date.date()) if last_cmd_date else None,
             'derniere_vente': str(last_sale_date.date()) if last_sale_date else None,
             'jours_depuis_derniere_vente': days_since_last_sale,
             'temps_total_en_officine': time_in_pharm_days,
             'statut': statut,
             'total_ventes': total_ventes,
+            'multiplicateur_saisonnier': multiplicateurs.get(str(prod['id'])),
         })
 
-    # 🔹 Étape 2 : Classification ABC (par % cumulé des ventes)
+    # 🔹 Classification ABC (par % cumulé des ventes)
     produits_data = sorted(produits_data, key=lambda x: x['total_ventes'], reverse=True)
 
     cumul = 0
@@ -1606,18 +2078,106 @@ def analyse_stock_api(request, pharmacie_id):
         p['categorie'] = categorie
         p['pourcentage'] = round(part, 2)
 
-    # 🔹 Étape 3 : Analyse saisonnière
+    # 🔹 Analyse saisonnière
     seasonal = seasonal_analysis(pharmacie, months_back=12, by_value=False)
 
-    data = {
-        'pharmacie': getattr(pharmacie, 'nom_pharm', None) or getattr(pharmacie, 'nom', None) or str(pharmacie),
+    return {
+        'pharmacie': pharmacie.nom_pharm,
         'period_days': days,
         'produits': produits_data,
         'seasonal_data': seasonal,
     }
 
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def analyse_stock_api(request, pharmacie_id):
+    """
+    API : /api/rapport-stock/<pharmacie_id>/?days=30&ordering=-total_ventes&page=1&page_size=50
+    Analyse la rotation des produits :
+      - Basée sur les commandes et les ventes
+      - Montre les produits inactifs
+      - Calcule la catégorie ABC selon le volume de ventes
+    Résultat en cache par (pharmacie, days), invalidé par les ventes, réceptions et dépenses.
+    Tri (ordering, '-' pour décroissant) et pagination (page, page_size) côté serveur ;
+    sans page/page_size, tous les produits sont renvoyés.
+    """
+    if str(request.user.pharmacie_id) != str(pharmacie_id) and not request.user.is_superuser:
+        return JsonResponse({"error": "Accès refusé à cette pharmacie"}, status=403)
+
+    pharmacie = get_object_or_404(Pharmacie, pk=pharmacie_id)
+
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 3650)
+    except ValueError:
+        days = 30
+
+    data = calculer_analyse_stock(pharmacie, days)
+    produits_data = data['produits']
+
+    # 🔹 Tri côté serveur (valeurs vides en dernier)
+    ordering = request.GET.get('ordering')
+    if ordering:
+        champ = ordering.lstrip('-')
+        if champ not in TRIS_ANALYSE_STOCK:
+            return JsonResponse({"error": f"Tri inconnu : {champ}"}, status=400)
+        renseignes = [p for p in produits_data if p[champ] is not None]
+        vides = [p for p in produits_data if p[champ] is None]
+        produits_data = sorted(renseignes, key=lambda p: p[champ], reverse=ordering.startswith('-')) + vides
+
+    data = {**data, 'count': len(produits_data)}
+
+    # 🔹 Pagination côté serveur
+    if 'page' in request.GET or 'page_size' in request.GET:
+        try:
+            page_size = min(max(int(request.GET.get('page_size', 100)), 1), 2000)
+            page = Paginator(produits_data, page_size).page(request.GET.get('page', 1))
+        except (ValueError, InvalidPage):
+            return JsonResponse({"error": "Page invalide"}, status=404)
+        produits_data = page.object_list
+        data.update({'page': page.number, 'num_pages': page.paginator.num_pages})
+
+    data['produits'] = produits_data
     return JsonResponse(data, safe=False, json_dumps_params={'ensure_ascii': False})
 
+#####################--Prévisions de demande---###################################
+from .models import PrevisionDemande
+from .utils import suggestion_prevision
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def suggestions_commande(request):
+    """
+    API : /api/previsions/suggestions/?tous=1
+    Dernières prévisions calculées (commande calculer_previsions) pour la pharmacie
+    de l'utilisateur, avec la quantité à commander calculée sur le stock actuel.
+    Par défaut seuls les produits à commander (quantité suggérée > 0).
+    """
+    previsions = (
+        PrevisionDemande.objects
+        .filter(pharmacie_id=request.user.pharmacie_id)
+        .select_related('produit')
+    )
+    suggestions = [(p, suggestion_prevision(p)) for p in previsions]
+    if not request.GET.get('tous'):
+        suggestions = [(p, qte) for p, qte in suggestions if qte > 0]
+    suggestions.sort(key=lambda s: s[1], reverse=True)
+
+    return Response([
+        {
+            "produit_id": str(p.produit_id),
+            "nom_medicament": p.produit.nom_medicament,
+            "stock": p.produit.quantite,
+            "methode": p.methode,
+            "demande_journaliere": float(p.demande_journaliere),
+            "coefficient_saisonnier": float(p.coefficient_saisonnier),
+            "demande_prevue": float(p.demande_prevue),
+            "quantite_suggeree": qte,
+            "calcule_le": p.calcule_le,
+        }
+        for p, qte in suggestions
+    ])
+
 #####################--Rapport Mensuell Marge Progression---###################################
 from datetime import datetime
 from rest_framework.decorators import api_view, permission_classes
@@ -1687,3 +2247,67 @@ class ApprovisionnementRapideView(APIView):
             "produit_id": produit.id,
             "quantite_stock": produit.quantite
         }, status=status.HTTP_201_CREATED)
+
+
+########### 📡 Événements en direct (SSE) ###########################
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from .utils import ouvrir_flux_sse, RECONNEXION_SATURE_SSE
+
+
+def _utilisateur_sse(request):
+    """
+    Utilisateur du jeton d'accès JWT : en-tête Authorization, ou paramètre ?token=
+    (EventSource ne permet pas d'envoyer d'en-tête). None si absent ou invalide.
+    """
+    authentification = JWTAuthentication()
+    try:
+        resultat = authentification.authenticate(request)
+        if resultat is not None:
+            return resultat[0]
+        jeton = request.GET.get('token')
+        if not jeton:
+            return None
+        return authentification.get_user(authentification.get_validated_token(jeton))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+@require_GET
+def flux_evenements(request):
+    """
+    API : /api/evenements/?token=<jeton d'accès>
+    Flux text/event-stream de la pharmacie de l'utilisateur, à la place des
+    rafraîchissements périodiques des tableaux de bord :
+    - vente : {id, date_vente, montant_total, benefice, caissier}
+    - stock : {produits: [{id, quantite, en_alerte}]}
+    - alerte : {produits: [{id, quantite, en_alerte, nom_medicament}]} (seuil franchi)
+    - reception : {id, commande}
+    Vue Django simple : la négociation de contenu de DRF refuserait Accept: text/event-stream.
+    Sous WSGI chaque flux garde un thread : au-delà de MAX_ABONNES_SSE flux par processus,
+    503 avec retry: pour laisser les threads aux caisses.
+    """
+    utilisateur = _utilisateur_sse(request)
+    if utilisateur is None or not utilisateur.is_active:
+        return JsonResponse({'error': 'Authentification requise'}, status=401)
+    if utilisateur.pharmacie_id is None:
+        return JsonResponse({'error': "Aucune pharmacie associée à l'utilisateur"}, status=403)
+
+    flux = ouvrir_flux_sse(utilisateur.pharmacie_id)
+    if flux is None:
+        reponse = HttpResponse(f"retry: {RECONNEXION_SATURE_SSE}\n\n", status=503, content_type='text/event-stream')
+        reponse['Retry-After'] = RECONNEXION_SATURE_SSE // 1000
+        return reponse
+
+    # Le flux ne lit plus la base : rendre la connexion avant de streamer (sauf dans une transaction)
+    if not connection.in_atomic_block:
+        connection.close()
+
+    reponse = StreamingHttpResponse(flux, content_type='text/event-stream')
+    reponse['Cache-Control'] = 'no-cache'
+    reponse['X-Accel-Buffering'] = 'no'  # nginx : transmettre chaque événement sans tampon
+    return reponse